@@ -2,208 +2,2627 @@
 
 # This is the backend of roleplaychat, a web application that allows users to create and manage campaigns for role-playing games.
 # The application uses Flask for the backend, SQLAlchemy for database interactions, and Google GenAI for generating content.
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from google import genai
 from google.genai import types
-from sqlalchemy import text
+from sqlalchemy import DateTime, bindparam, column, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import Session
-from functools import wraps
+from functools import lru_cache, wraps
+from contextlib import contextmanager
+from contextvars import copy_context
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from cachetools import LRUCache, TTLCache
+from model_backend import ContextCache, ModelRouter, ModelTimeout, ModelUnavailable, Route, content_text, create_client
+from retrieval import ArchiveIndex
+from metrics import count_model_tokens, finish_request, instrument_engine, instrument_pool, render as render_metrics, start_request, timed
+import threading
+import atexit
+import hashlib
+import base64
+import re
+import json
+import logging
+import math
+import time
 import uuid
 import os
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 app = Flask(__name__)
 
 # ENV CONFIG
+# Required by create_app(), which can also be given them
 API_KEY = os.environ.get('API_KEY')
 DATABASE_URL = os.environ.get('DATABASE_URL')
-if not API_KEY:
-    raise ValueError("No API_KEY found for Flask application")  # Ensure API_KEY is set in the environment
-if not DATABASE_URL:
-    raise ValueError("No DATABASE_URL found for Flask application")  # Ensure DATABASE_URL is set in the environment
+# Read-only replica serving the campaign list and details and the chat listing (unset: all queries use DATABASE_URL),
+# and the seconds the reads of an API key stay on the primary after it writes, to cover the replication lag
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL') or None
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# GENAI_BACKEND=fake swaps Gemini for a deterministic local model, to run the API offline (see model_backend.py)
+GENAI_BACKEND = os.environ.get('GENAI_BACKEND', 'google')
+# Database connections kept open by each process, how many more it may open under load, the seconds after which
+# a connection is replaced (-1 never) and whether a connection is tested before use (e.g. when a proxy or firewall
+# closes idle connections)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', -1))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'false').lower() in ('1', 'true', 'yes')
 
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Minimum level of the log messages (DEBUG also logs chat inputs and summaries)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Bearer token required by GET /metrics, which is open when it is not set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
-db = SQLAlchemy(app)
+# Lifetime (in seconds) and maximum size of the in-process API key and campaign ownership caches
+AUTH_CACHE_TTL = float(os.environ.get('AUTH_CACHE_TTL', 60))
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+# Seconds the campaign list and details responses of an API key are cached by each process (0 disables the cache)
+CAMPAIGN_CACHE_TTL = float(os.environ.get('CAMPAIGN_CACHE_TTL', 5))
+
+# Estimated tokens of context (prompt, summary, recent turns and new message) sent to the model with each message
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 6000))
+# Maximum number of recent chat rows read to fill the token budget
+HISTORY_MAX_ROWS = int(os.environ.get('HISTORY_MAX_ROWS', 50))
+# Number of threads running background summary jobs
+SUMMARY_WORKERS = int(os.environ.get('SUMMARY_WORKERS', 2))
+# Number of threads generating the opening message of new campaigns
+OPENING_WORKERS = int(os.environ.get('OPENING_WORKERS', 4))
+# Default limits of an API key, used when its "ApiKey" columns are NULL (0 disables a limit): requests per minute,
+# estimated model tokens per minute, and generations in progress at once (per server process)
+RATE_LIMIT_REQUESTS = int(os.environ.get('RATE_LIMIT_REQUESTS_PER_MINUTE', 600))
+RATE_LIMIT_TOKENS = int(os.environ.get('RATE_LIMIT_TOKENS_PER_MINUTE', 200000))
+RATE_LIMIT_CONCURRENCY = int(os.environ.get('RATE_LIMIT_CONCURRENCY', 4))
+# Where the token buckets live: 'process' (in memory, per worker) or 'database' (shared by all workers)
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'process')
+# Write-behind of chat turns: when enabled, the turns of concurrent requests are inserted together, in one
+# multi-row INSERT and commit, once CHAT_BATCH_SIZE turns are waiting or CHAT_BATCH_DELAY seconds after the first
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+CHAT_BATCH_SIZE = int(os.environ.get('CHAT_BATCH_SIZE', 100))
+CHAT_BATCH_DELAY = float(os.environ.get('CHAT_BATCH_DELAY', 0.01))
+# Batches of chats (POST /campaigns/chats): items accepted per request, generations in progress per batch (also
+# capped by the concurrency limit of the API key), and threads running the items of all batches of a process
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 32))
+# Seconds the result of a request sent with an Idempotency-Key is kept for replay, and seconds a retry
+# waits for the original request to finish
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 60))
+# Seconds the prompt, opening and summary of a campaign stay in the model's context cache (0 disables it), and
+# the estimated tokens below which they are sent in full. Gemini refuses caches smaller than the minimum of the
+# model, 4096 tokens for gemini-2.0-flash and gemini-2.0-flash-lite (1024 for gemini-2.5-flash): a creation
+# failing on every turn would cost a request each time, so this should not be lower than the minimum of MODEL_NAME
+CONTEXT_CACHE_TTL = float(os.environ.get('CONTEXT_CACHE_TTL', 600))
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('CONTEXT_CACHE_MIN_TOKENS', 4096))
+# Pre-generated openings kept per prompt and model (0 disables the pool), the level below which it is refilled,
+# and the seconds after which an unused opening is discarded
+OPENING_POOL_DEPTH = int(os.environ.get('OPENING_POOL_DEPTH', 10))
+OPENING_POOL_LOW_WATER = int(os.environ.get('OPENING_POOL_LOW_WATER', 3))
+OPENING_POOL_TTL = float(os.environ.get('OPENING_POOL_TTL', 24 * 3600))
+# Archived turns injected into the context of a message when relevant to it (0 disables retrieval), the estimated
+# tokens they may use, and the number of campaigns whose retrieval index is kept in memory by each process
+RETRIEVAL_SNIPPETS = int(os.environ.get('RETRIEVAL_SNIPPETS', 3))
+RETRIEVAL_MAX_TOKENS = int(os.environ.get('RETRIEVAL_MAX_TOKENS', 600))
+RETRIEVAL_INDEXES = int(os.environ.get('RETRIEVAL_INDEXES', 32))
+# Model of every route (chat, summary, opening), the model tried once it fails, and per-route overrides of the
+# model calls as a JSON object, e.g. {"chat": {"deadline": 20, "hedge": false}, "summary": {"model": "..."}}
+# (see model_backend.Route for the settings)
+MODEL_NAME = os.environ.get('MODEL_NAME', 'gemini-2.0-flash')
+MODEL_FALLBACK = os.environ.get('MODEL_FALLBACK', 'gemini-2.0-flash-lite') or None
+MODEL_ROUTES = json.loads(os.environ.get('MODEL_ROUTES', '{}'))
+# Threads making synchronous model calls, so slow ones can be hedged or abandoned
+MODEL_WORKERS = int(os.environ.get('MODEL_WORKERS', 64))
+# How turns of a campaign are serialized: 'process' (in-memory lock) or 'database' (also across workers)
+TURN_LOCK_BACKEND = os.environ.get('TURN_LOCK_BACKEND', 'database')
+# Seconds a chat request waits for the previous turn of its campaign before giving up
+TURN_LOCK_TIMEOUT = float(os.environ.get('TURN_LOCK_TIMEOUT', 60))
+
+# Bound to the app by create_app()
+db = SQLAlchemy()
+
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('roleplaychat')
 
 # GENAI CLIENT SETUP
-client = genai.Client(api_key=API_KEY)
+# Created on first use by genai_client(), so starting a worker does not load the Gemini SDK
+client = None
+client_lock = threading.Lock()
+
+def genai_client():
+    """
+    Returns the model client of this process, created on first use.
+    """
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                client = create_client(GENAI_BACKEND, API_KEY)
+    return client
+
+# Model calls of each route: two attempts of the model, then the fallback within what remains of the deadline.
+# Chat turns are hedged since a user is waiting; summaries and openings are generated in the background.
+MODEL_ROUTE_DEFAULTS = {
+    'chat': {'deadline': 30, 'timeout': 10, 'hedge': True},
+    'summary': {'deadline': 120, 'timeout': 45},
+    'opening': {'deadline': 60, 'timeout': 20},
+}
+model_router = ModelRouter({
+    name: Route(**{'model': MODEL_NAME, 'fallback': MODEL_FALLBACK, **defaults, **MODEL_ROUTES.get(name, {})})
+    for name, defaults in MODEL_ROUTE_DEFAULTS.items()
+}, workers=MODEL_WORKERS)
+
+def model_error(error):
+    """
+    Returns the error message and status code of a model call that got no answer from any model of its route.
+    """
+    if isinstance(error, ModelTimeout):
+        return 'The model did not answer in time, please retry.', 504
+    return 'The model is unavailable, please retry later.', 503
+
+def model_unavailable(error):
+    """
+    Returns the error response of a model call that got no answer from any model of its route.
+    """
+    message, status = model_error(error)
+    return jsonify({'error': message}), status
 
 # Load the default prompt from a file to initialize the AI model's context
-with open('default_prompt.txt', 'r') as file:
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'default_prompt.txt'), 'r') as file:
     default_prompt = file.read()
 
-# Base context for AI interactions, used to maintain consistent behavior
-base_context = [
-    types.Content(role='user', parts=[types.Part(text=default_prompt)]),
-    types.Content(role='model', parts=[types.Part(text='Understood')]),
-    types.Content(role='user', parts=[types.Part(text='start')]),
-]
+def prompt_hash(prompt):
+    """
+    Returns the content hash identifying a prompt in the "Prompt" table.
+    """
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+DEFAULT_PROMPT_HASH = prompt_hash(default_prompt)
+
+# Base context for AI interactions, the campaign prompt itself is sent as the system instruction
+base_context = [
+    types.Content(role='user', parts=[types.Part(text='start')]),
+]
+
+# Model generating the opening message of new campaigns, the pool of pre-generated openings is kept per model
+OPENING_MODEL = model_router.routes['opening'].model
+# Leading chat rows that are always part of the context (opening message)
+PINNED_ROWS = 1
+# Share of the token budget the recent turns may use before the oldest ones get summarized
+SUMMARY_TRIGGER = 0.75
+# Message of the chat row holding the summary of the older turns
+SUMMARY_MESSAGE = 'This is a summary of the previous messages, used to keep the chat history manageable :'
+# A running job not updated for this long is considered abandoned (e.g. the worker crashed) and can be claimed again
+JOB_STALE_AFTER = timedelta(minutes=5)
+# A turn lock held for this long is considered abandoned (e.g. the worker crashed) and can be taken over
+TURN_LOCK_LEASE = timedelta(minutes=2)
+# An idempotent request running for this long is considered abandoned and can be run again by a retry
+IDEMPOTENCY_LEASE = timedelta(minutes=5)
+
+# --- QUERY STEPS ---
+# The database logic shared with api_async.py is written once, as generators of the steps to run ("..._steps"):
+# they yield a (statement, parameters) pair and get its result back, COMMIT, a Future to wait for, or a Pause.
+# run_steps drives them with a connection or session here, api_async.run_steps with an async one, and raises
+# the exception of a failed step inside the generator. The caches and locks are only touched between the steps.
+
+COMMIT = 'commit'
+
+class Pause:
+    """
+    Step waiting `seconds`, or until the event is set: a threading.Event here, an asyncio.Event in api_async.py.
+    """
+    def __init__(self, seconds, event=None):
+        self.seconds = seconds
+        self.event = event
+
+def run_steps(connection, steps):
+    """
+    Runs a steps generator with a connection or session, and returns what it returns.
+    """
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            if step is COMMIT:
+                connection.commit()
+            elif isinstance(step, Future):
+                result = step.result()
+            elif isinstance(step, Pause):
+                if step.event is not None:
+                    step.event.wait(step.seconds)
+                else:
+                    time.sleep(step.seconds)
+            else:
+                result = connection.execute(*step)
+        except Exception as e:
+            error = e
+
+# --- AUTH CACHE ---
+# Bounded LRU caches with a time-to-live, so repeated requests skip the auth queries.
+# cachetools caches are not thread-safe, every access goes through the lock.
+auth_cache_lock = threading.Lock()
+api_key_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)  # API key -> (API key ID, rate limits)
+campaign_owner_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)  # Campaign ID -> owning API key ID
+campaign_prompt_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)  # Campaign ID -> prompt hash
+
+def cache_get(cache, key):
+    """
+    Returns the cached value for the key, or None if it is missing or expired.
+    """
+    with auth_cache_lock:
+        return cache.get(key)
+
+def cache_set(cache, key, value):
+    """
+    Stores a value in one of the auth caches.
+    """
+    with auth_cache_lock:
+        cache[key] = value
+
+def evict_campaign(campaign_id):
+    """
+    Removes a campaign from the ownership cache, used when the campaign is deleted.
+    """
+    with auth_cache_lock:
+        campaign_owner_cache.pop(str(campaign_id), None)
+        campaign_prompt_cache.pop(str(campaign_id), None)
+
+def cache_campaign(campaign_id, owner, campaign_prompt_hash):
+    """
+    Caches the owner and the prompt hash of a campaign, fetched together.
+    Campaigns created before prompts were hashed have no hash and use the default prompt.
+    """
+    cache_set(campaign_owner_cache, str(campaign_id), owner)
+    cache_set(campaign_prompt_cache, str(campaign_id), campaign_prompt_hash or DEFAULT_PROMPT_HASH)
+
+# --- PROMPTS ---
+# Prompts are stored once in the "Prompt" table, keyed by their content hash, and referenced by campaigns.
+# The content behind a hash never changes, so the generation configs built from it are cached without expiry.
+prompt_config_lock = threading.Lock()
+prompt_configs = LRUCache(maxsize=256)  # Prompt hash -> GenerateContentConfig with the prompt as system instruction
+
+def cached_prompt_config(campaign_prompt_hash):
+    """
+    Returns the cached generation config of a prompt, or None if it is not cached yet.
+    """
+    with prompt_config_lock:
+        return prompt_configs.get(campaign_prompt_hash)
+
+def cache_prompt_config(campaign_prompt_hash, prompt):
+    """
+    Builds the generation config sending the prompt as system instruction, and caches it.
+    """
+    config = types.GenerateContentConfig(system_instruction=prompt)
+    with prompt_config_lock:
+        prompt_configs[campaign_prompt_hash] = config
+    return config
+
+cache_prompt_config(DEFAULT_PROMPT_HASH, default_prompt)
+
+PROMPT_QUERY = text("""SELECT content FROM "Prompt" WHERE hash = :hash""")
+
+def prompt_config_steps(campaign_prompt_hash):
+    """
+    Steps returning the generation config of a prompt, loading the prompt from the database on a cache miss.
+    """
+    config = cached_prompt_config(campaign_prompt_hash)
+    if config is not None:
+        return config
+    result = (yield PROMPT_QUERY, {'hash': campaign_prompt_hash}).fetchone()
+    if not result:
+        # The prompt is missing, fall back to the default one
+        return cached_prompt_config(DEFAULT_PROMPT_HASH)
+    return cache_prompt_config(campaign_prompt_hash, result[0])
+
+def campaign_prompt_config_steps(campaign_id):
+    """
+    Steps returning the generation config holding the prompt of the campaign.
+    """
+    campaign_prompt_hash = cache_get(campaign_prompt_cache, str(campaign_id))
+    if campaign_prompt_hash is None:
+        yield from campaign_owner_steps(campaign_id, cached=False)
+        campaign_prompt_hash = cache_get(campaign_prompt_cache, str(campaign_id)) or DEFAULT_PROMPT_HASH
+    return (yield from prompt_config_steps(campaign_prompt_hash))
+
+def prompt_config(campaign_prompt_hash):
+    """
+    Returns the generation config of a prompt, see prompt_config_steps.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, prompt_config_steps(campaign_prompt_hash))
+
+def campaign_prompt_config(campaign_id):
+    """
+    Returns the generation config holding the prompt of the campaign.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, campaign_prompt_config_steps(campaign_id))
+
+# --- API KEY AUTH (NOW FROM HEADER) ---
+def api_key_from_header(auth_header):
+    """
+    Extracts the API key from an Authorization header.
+    Returns the API key, or an error message if the header is missing or malformed.
+    """
+    if not auth_header:
+        return None, "Missing Authorization header."
+
+    if not auth_header.startswith('Bearer '):
+        return None, "Invalid Authorization header format."
+
+    return auth_header.replace('Bearer ', '').strip(), None
+
+# The rate limits of the key are read along, and the campaign owner when a campaign ID is given
+API_KEY_QUERY = text("""
+    SELECT id, NULL, NULL, "requestsPerMinute", "tokensPerMinute", "maxConcurrent" FROM "ApiKey" WHERE key = :key
+""")
+API_KEY_CAMPAIGN_QUERY = text("""
+    SELECT k.id, c."apiKeyId", c."promptHash", k."requestsPerMinute", k."tokensPerMinute", k."maxConcurrent"
+    FROM "ApiKey" k
+    LEFT JOIN "Campaign" c ON c.id = :campaignid
+    WHERE k.key = :key
+""")
+
+def api_key_limits(requests_per_minute, tokens_per_minute, max_concurrent):
+    """
+    Returns the rate limits of an API key from its "ApiKey" columns, the NULL ones replaced by the server defaults.
+    """
+    return tuple(
+        default if value is None else value
+        for value, default in zip(
+            (requests_per_minute, tokens_per_minute, max_concurrent),
+            (RATE_LIMIT_REQUESTS, RATE_LIMIT_TOKENS, RATE_LIMIT_CONCURRENCY)
+        )
+    )
+
+def verify_api_key_steps(auth_header, campaign_id=None):
+    """
+    Steps verifying the API key of an Authorization header.
+    Returns the API key ID and its rate limits if valid, or an error message if invalid.
+    When a campaign ID is given, its owner is fetched in the same query and cached,
+    so a cold cache costs a single round trip for both checks.
+    """
+    api_key, error = api_key_from_header(auth_header)
+    if error:
+        return None, None, error
+
+    cached = cache_get(api_key_cache, api_key)
+    if cached is not None:
+        return cached[0], cached[1], None
+
+    try:
+        # Query the database to check if the API key exists
+        if campaign_id is None:
+            result = (yield API_KEY_QUERY, {'key': api_key}).fetchone()
+        else:
+            # Fetch the campaign owner alongside the key so require_campaign hits the cache
+            result = (yield API_KEY_CAMPAIGN_QUERY, {'key': api_key, 'campaignid': str(campaign_id)}).fetchone()
+    except Exception as e:
+        return None, None, f"Database error: {e}"
+    if not result:
+        return None, None, "Invalid API key."
+    limits = api_key_limits(*result[3:])
+    cache_set(api_key_cache, api_key, (result[0], limits))
+    if result[1] is not None:
+        cache_campaign(campaign_id, result[1], result[2])
+    return result[0], limits, None
+
+def verify_api_key(campaign_id=None):
+    """
+    Verifies the API key provided in the Authorization header, see verify_api_key_steps.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, verify_api_key_steps(request.headers.get('Authorization'), campaign_id))
+
+CAMPAIGN_OWNER_QUERY = text("""SELECT "apiKeyId", "promptHash" FROM "Campaign" WHERE id = :campaignid""")
+
+def campaign_owner_steps(campaign_id, cached=True):
+    """
+    Steps returning the API key ID owning the campaign, or None if the campaign does not exist.
+    Served from the ownership cache when possible, the campaign prompt hash is cached along.
+    """
+    owner = cache_get(campaign_owner_cache, str(campaign_id)) if cached else None
+    if owner is not None:
+        return owner
+    result = (yield CAMPAIGN_OWNER_QUERY, {'campaignid': str(campaign_id)}).fetchone()
+    if not result:
+        return None
+    cache_campaign(campaign_id, result[0], result[1])
+    return result[0]
+
+def get_campaign_owner(campaign_id, cached=True):
+    """
+    Returns the API key ID owning the campaign, see campaign_owner_steps.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, campaign_owner_steps(campaign_id, cached))
+    
+# --- RATE LIMITS ---
+# Each API key has token buckets holding up to one minute of its limit and refilled continuously: one for requests,
+# one for estimated model tokens. A generation is admitted while the token bucket is positive and charged once its
+# size is known, so a large turn puts the key in debt until the bucket refills. Generations in progress are also
+# capped per key. The limits are cached with the API key, so with the in-memory buckets this costs no query.
+
+# Routes generating a model response, counted against the model token and concurrency limits
+GENERATION_ENDPOINTS = {'campaign_chat', 'campaign_chat_stream'}
+
+RATE_LIMIT_TAKE = text("""
+    INSERT INTO "RateLimitBucket" ("apiKeyId", bucket, tokens, "updatedAt")
+    VALUES (:apikeyid, :bucket, :rate - :cost, :now)
+    ON CONFLICT ("apiKeyId", bucket) DO UPDATE
+    SET tokens = CASE WHEN "RateLimitBucket".tokens + (:now - "RateLimitBucket"."updatedAt") * :refill > :rate THEN :rate
+                      ELSE "RateLimitBucket".tokens + (:now - "RateLimitBucket"."updatedAt") * :refill END - :cost,
+        "updatedAt" = :now
+    WHERE :minimum IS NULL
+       OR "RateLimitBucket".tokens + (:now - "RateLimitBucket"."updatedAt") * :refill >= :minimum
+    RETURNING tokens
+""")
+RATE_LIMIT_SELECT = text("""
+    SELECT tokens, "updatedAt" FROM "RateLimitBucket" WHERE "apiKeyId" = :apikeyid AND bucket = :bucket
+""")
+
+class RateLimited(Exception):
+    """
+    Raised when a request exceeds a rate limit of its API key.
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+rate_buckets = LRUCache(maxsize=AUTH_CACHE_SIZE * 2)  # (API key ID, bucket) -> (tokens, Unix time of the last update)
+rate_buckets_lock = threading.Lock()
+generations = {}  # API key ID -> number of generations in progress in this process
+generations_lock = threading.Lock()
+
+def take_tokens(api_key_id, bucket, rate, cost, minimum=None):
+    """
+    Takes `cost` tokens from a bucket of the API key, holding at most `rate` tokens and refilled by `rate` per minute.
+    With a minimum, nothing is taken unless that many tokens are available, otherwise the bucket may go negative.
+    Returns 0 if the tokens were taken, or the number of seconds until the minimum is available.
+    """
+    now = time.time()
+    if RATE_LIMIT_BACKEND == 'database':
+        params = {'apikeyid': str(api_key_id), 'bucket': bucket, 'rate': rate, 'refill': rate / 60, 'cost': cost, 'minimum': minimum, 'now': now}
+        # Also called from the async mode, outside of a Flask app context
+        with app.app_context(), Session(db.engine) as session:
+            taken = session.execute(RATE_LIMIT_TAKE, params).first()
+            session.commit()
+            if taken:
+                return 0
+            tokens, updated = session.execute(RATE_LIMIT_SELECT, params).first()
+        tokens = min(rate, tokens + (now - updated) * rate / 60)
+    else:
+        with rate_buckets_lock:
+            tokens, updated = rate_buckets.get((api_key_id, bucket), (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate / 60)
+            if minimum is None or tokens >= minimum:
+                rate_buckets[(api_key_id, bucket)] = (tokens - cost, now)
+                return 0
+    return (minimum - tokens) * 60 / rate
+
+def admit_request(api_key_id, limits, generation):
+    """
+    Checks the rate limits of the API key for the current request, raises RateLimited if one is exceeded.
+    Returns True if a generation slot was taken, to give back with release_generation.
+    """
+    requests_per_minute, tokens_per_minute, max_concurrent = limits
+    if requests_per_minute:
+        wait = take_tokens(api_key_id, 'requests', requests_per_minute, 1, minimum=1)
+        if wait:
+            raise RateLimited('Too many requests for this API key.', wait)
+    if not generation:
+        return False
+    if tokens_per_minute:
+        wait = take_tokens(api_key_id, 'tokens', tokens_per_minute, 0, minimum=1)
+        if wait:
+            raise RateLimited('Model token limit reached for this API key.', wait)
+    if not max_concurrent:
+        return False
+    with generations_lock:
+        if generations.get(api_key_id, 0) >= max_concurrent:
+            raise RateLimited('Too many messages in progress for this API key.', 1)
+        generations[api_key_id] = generations.get(api_key_id, 0) + 1
+    return True
+
+def release_generation(api_key_id):
+    """
+    Gives back the generation slot taken by admit_request.
+    """
+    with generations_lock:
+        generations[api_key_id] -= 1
+        if generations[api_key_id] == 0:
+            del generations[api_key_id]
+
+def context_tokens(contents, config):
+    """
+    Estimates the model tokens sent for a generation: its system instruction and contents.
+    """
+    return estimate_prompt_tokens(content_text(config.system_instruction)) + sum(
+        estimate_tokens(content_text(content)) for content in contents
+    )
+
+def record_generation(api_key_id, limits, model, contents, config, response):
+    """
+    Records the estimated model tokens of a chat generation and charges them to the API key.
+    """
+    tokens_in, tokens_out = context_tokens(contents, config), estimate_tokens(response)
+    count_model_tokens(model, tokens_in, tokens_out)
+    if limits and limits[1]:
+        try:
+            take_tokens(api_key_id, 'tokens', limits[1], tokens_in + tokens_out)
+        except Exception as e:
+            logger.error("Error charging model tokens: %s", e)
+
+def rate_limited(error):
+    """
+    Returns the 429 response of a RateLimited error, telling the client when to retry.
+    """
+    result = jsonify({'error': str(error)})
+    result.status_code = 429
+    result.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return result
+
+# --- DECORATORS ---
+def require_api_key(f):
+    """
+    Decorator to enforce API key authentication and rate limits for routes.
+    Attaches the API key ID and its rate limits to the request context if valid.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with timed('verify_api_key'):
+            api_key_id, limits, error = verify_api_key(kwargs.get('campaignid'))
+        if error:
+            return jsonify({'error': error}), 401
+        request.api_key_id = api_key_id  # Attach API key ID to the request context
+        request.rate_limits = limits
+        if getattr(f, 'idempotent', False) and request.headers.get('Idempotency-Key'):
+            # Admitted by idempotent once the key is claimed, see there
+            return f(*args, **kwargs)
+        return admitted(f, *args, **kwargs)
+    return decorated
+
+def admitted(f, *args, **kwargs):
+    """
+    Runs a view once the request is admitted by the rate limits of its API key, see admit_request.
+    The generation routes hold a generation slot until their response is sent.
+    """
+    api_key_id = request.api_key_id
+    try:
+        generation = admit_request(api_key_id, request.rate_limits, request.endpoint in GENERATION_ENDPOINTS)
+    except RateLimited as e:
+        return rate_limited(e)
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    if not generation:
+        return f(*args, **kwargs)
+
+    try:
+        result = app.make_response(f(*args, **kwargs))
+    except BaseException:
+        release_generation(api_key_id)
+        raise
+    if result.is_streamed:
+        # The generation goes on while the response is sent
+        result.call_on_close(lambda: release_generation(api_key_id))
+    else:
+        release_generation(api_key_id)
+    return result
+
+def require_campaign(f):
+    """
+    Decorator to enforce campaign ownership validation for routes.
+    Ensures the campaign belongs to the authenticated API key.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        api_key_id = request.api_key_id
+        if not api_key_id:
+            return jsonify({'error': 'API key is required.'}), 401
+        campaign_id = kwargs.get('campaignid')
+        if not campaign_id:
+            return jsonify({'error': 'Campaign ID is required.'}), 400
+        try:
+            # Check that the campaign exists and belongs to the API key (cached)
+            with timed('require_campaign'):
+                owner = get_campaign_owner(campaign_id)
+            if owner is None:
+                return jsonify({'error': 'Campaign not found.'}), 404
+            if owner != api_key_id:
+                return jsonify({'error': 'You do not have access'}), 401
+        except Exception as e:
+            return jsonify({'error': f"Database error: {e}"}), 500
+
+        return f(*args, **kwargs)
+    return decorated
+
+# --- DATABASE STORE FUNCTIONS ---
+
+CHAT_INSERT = text("""
+    INSERT INTO "Chat" (message, response, "campaignId", "tokenCount")
+    VALUES (:message, :response, :campaignId, :tokenCount)
+    RETURNING id, "createdAt"
+""").columns(column('id'), column('createdAt', DateTime))
+
+@lru_cache(maxsize=16)
+def chat_batch_insert(count):
+    """
+    Returns the multi-row INSERT of `count` chats, their parameters suffixed with their position (message_0, ...).
+    """
+    values = ', '.join(f'(:message_{i}, :response_{i}, :campaignId_{i}, :tokenCount_{i})' for i in range(count))
+    return text(f"""
+        INSERT INTO "Chat" (message, response, "campaignId", "tokenCount")
+        VALUES {values}
+        RETURNING id, "campaignId", "createdAt"
+    """).columns(column('id'), column('campaignId'), column('createdAt', DateTime))
+
+def insert_chat_steps(chat, token=None):
+    """
+    Steps inserting a chat and releasing the turn lease `token`, without committing.
+    Returns the id and createdAt of the new row.
+    """
+    row = (yield CHAT_INSERT, chat).first()
+    if token is not None:
+        yield TURN_LOCK_RELEASE, {'campaignid': chat['campaignId'], 'token': token}
+    return {'id': row.id, 'createdAt': row.createdAt}
+
+class ChatWriter:
+    """
+    Write-behind of chat turns (CHAT_WRITE_BEHIND): the turns submitted by concurrent requests are inserted by a
+    background thread in one multi-row INSERT, along with the release of their turn leases, and committed together.
+    A request waits for the commit of its batch, so a stored turn is durable when the response is sent.
+    Batches are flushed once `size` turns are waiting or `delay` seconds after the first one, and on shutdown.
+    """
+    def __init__(self, size, delay):
+        self.size = size
+        self.delay = delay
+        self.pending = []  # (chat, turn lease token, future)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def submit(self, chat, token=None):
+        """
+        Queues a chat for the next batch. Returns a future of its id and createdAt.
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The chat writer is closed.')
+            self.pending.append((chat, token, future))
+            # Started on first use, so importing the module starts no thread
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='chat-writer', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # Give concurrent turns some time to join the batch
+                deadline = time.monotonic() + self.delay
+                while len(self.pending) < self.size and not self.closed and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                batch, self.pending = self.pending[:self.size], self.pending[self.size:]
+            self.flush(batch)
+
+    def flush(self, batch):
+        """
+        Inserts a batch of chats in one transaction and resolves their futures.
+        """
+        with app.app_context():
+            try:
+                with Session(db.engine) as session:
+                    params = {}
+                    for i, (chat, _, _) in enumerate(batch):
+                        params.update({f'{name}_{i}': value for name, value in chat.items()})
+                    rows = session.execute(chat_batch_insert(len(batch)), params).fetchall()
+                    tokens = [token for _, token, _ in batch if token is not None]
+                    if tokens:
+                        session.execute(
+                            text("""DELETE FROM "TurnLock" WHERE token IN :tokens""").bindparams(bindparam('tokens', expanding=True)),
+                            {'tokens': tokens}
+                        )
+                    session.commit()
+            except IntegrityError:
+                # A campaign was deleted meanwhile, store the turns one by one so the others still succeed
+                for chat, token, future in batch:
+                    try:
+                        with Session(db.engine) as session:
+                            future.set_result(run_steps(session, insert_chat_steps(chat, token)))
+                            session.commit()
+                    except Exception as e:
+                        future.set_exception(e)
+                return
+            except Exception as e:
+                logger.error("Error storing chat batch: %s", e)
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+        # Rows of one campaign are matched to its turns in insertion order
+        rows_by_campaign = {}
+        for row in sorted(rows, key=lambda row: row.id):
+            rows_by_campaign.setdefault(str(row.campaignId), []).append(row)
+        for chat, _, future in batch:
+            row = rows_by_campaign[chat['campaignId']].pop(0)
+            future.set_result({'id': row.id, 'createdAt': row.createdAt})
+
+    def close(self):
+        """
+        Stores the waiting turns and stops the writer thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+def chat_writers():
+    """
+    Returns (chat_writer, batch_writer): the writer of chat turns, None without CHAT_WRITE_BEHIND, and the writer
+    of the turns of batch requests, which finish close together and are always written behind.
+    """
+    chat_writer = ChatWriter(CHAT_BATCH_SIZE, CHAT_BATCH_DELAY) if CHAT_WRITE_BEHIND else None
+    return chat_writer, chat_writer or ChatWriter(CHAT_BATCH_SIZE, CHAT_BATCH_DELAY)
+
+chat_writer, batch_writer = chat_writers()
+# Drain the waiting turns before the process exits (the writer of a forked worker is its own)
+atexit.register(lambda: batch_writer.close())
+
+def store_chat_steps(campaign_id, user_input, response, turn=None, batched=False):
+    """
+    Steps storing a chat message and its response, releasing the turn lease in the same commit.
+    Turns of batch requests are stored by batch_writer.
+    Returns the id and createdAt of the stored chat, or None if the campaign does not exist.
+    """
+    # Check if the campaign exists (served from the ownership cache on a warm turn)
+    if (yield from campaign_owner_steps(campaign_id)) is None:
+        return None
+    chat = {
+        'message': user_input,
+        'response': response,
+        'campaignId': str(campaign_id),
+        'tokenCount': estimate_tokens(user_input) + estimate_tokens(response)
+    }
+    token = turn.token if turn else None
+    writer = batch_writer if batched else chat_writer
+    try:
+        if writer:
+            # Ends the read of the owner, so no connection is held while the writer stores the turn
+            yield COMMIT
+            stored = yield writer.submit(chat, token)
+        else:
+            stored = yield from insert_chat_steps(chat, token)
+            yield COMMIT
+    except IntegrityError:
+        # The campaign was deleted during the turn
+        return None
+    if turn:
+        turn.token = None
+    return stored
+
+@timed('store_chat')
+def storeChat(campaign_id, user_input, response, turn=None, batched=False):
+    """
+    Stores a chat message and its response in the database, see store_chat_steps.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, store_chat_steps(campaign_id, user_input, response, turn, batched))
+
+ARCHIVE_INSERT = text("""
+    INSERT INTO "ChatArchive" (id, "campaignId", message, response, "createdAt")
+    SELECT id, "campaignId", message, response, "createdAt" FROM "Chat"
+    WHERE "campaignId" = :campaign_id AND id IN :chat_ids AND message <> :summary_message
+    ON CONFLICT (id) DO NOTHING
+""").bindparams(bindparam('chat_ids', expanding=True))
+
+# The summary row is dated this long after the last pinned row, so it sorts right after it: the "createdAt"
+# columns are TIMESTAMP(3), a smaller offset would be rounded away
+SUMMARY_OFFSET = timedelta(milliseconds=1)
+
+def storeSummary(campaign_id, summary, chat_ids):
+    """
+    Stores a summary of chat messages in the database.
+    Replaces the previous summary, and moves the summarized messages to "ChatArchive" to keep the chat history manageable.
+    Raises LookupError if the campaign has no messages, and the database errors as they are.
+    """
+    with Session(db.engine) as session:
+        # Fetch the timestamp of the last pinned message in the campaign
+        pinned_timestamp_result = session.execute(
+            text("""
+                SELECT "createdAt"
+                FROM "Chat"
+                WHERE "campaignId" = :campaign_id
+                ORDER BY "createdAt" ASC, id ASC
+                LIMIT 1
+                OFFSET :offset
+            """).columns(column('createdAt', DateTime)),
+            {'campaign_id': str(campaign_id), 'offset': PINNED_ROWS - 1}
+        ).fetchone()
+        if not pinned_timestamp_result:
+            raise LookupError('No messages found for the campaign.')
+        pinned_timestamp = pinned_timestamp_result[0]
+
+        # Archive the summarized messages, for retrieval, then delete them with the previous summary
+        session.execute(
+            ARCHIVE_INSERT,
+            {'campaign_id': str(campaign_id), 'chat_ids': list(chat_ids), 'summary_message': SUMMARY_MESSAGE}
+        )
+        session.execute(
+            text("""
+                DELETE FROM "Chat"
+                WHERE "campaignId" = :campaign_id
+                AND (id IN :chat_ids OR message = :summary_message)
+            """).bindparams(bindparam('chat_ids', expanding=True)),
+            {
+                'campaign_id': str(campaign_id),
+                'chat_ids': list(chat_ids),
+                'summary_message': SUMMARY_MESSAGE
+            }
+        )
+
+        # Insert the summary as a new chat message, right after the pinned messages
+        session.execute(
+            text("""
+                INSERT INTO "Chat" (message, response, "campaignId", "createdAt", "tokenCount")
+                VALUES (:message, :response, :campaignId, :createdAt, :tokenCount)
+            """),
+            {
+                'message': SUMMARY_MESSAGE,
+                'response': summary,
+                'campaignId': str(campaign_id),
+                'tokenCount': estimate_tokens(SUMMARY_MESSAGE) + estimate_tokens(summary),
+                'createdAt': pinned_timestamp + SUMMARY_OFFSET
+            }
+        )
+        session.commit()
+    # The cached prefix of the campaign ends with the previous summary
+    context_cache.invalidate(str(campaign_id))
+
+# --- CHAT HISTORY ---
+
+# Chat rows needed to build the model context: the pinned rows (opening message),
+# the latest summary and the most recent turns. Each part is an index-backed ordered scan with a LIMIT,
+# so the cost does not grow with the campaign.
+HISTORY_QUERY = text("""
+    SELECT id, message, response, "createdAt", "tokenCount" FROM (
+        SELECT id, message, response, "createdAt", "tokenCount" FROM "Chat"
+        WHERE "campaignId" = :campaignid
+        ORDER BY "createdAt" ASC, id ASC
+        LIMIT :pinned
+    ) AS pinned
+    UNION
+    SELECT id, message, response, "createdAt", "tokenCount" FROM (
+        SELECT id, message, response, "createdAt", "tokenCount" FROM "Chat"
+        WHERE "campaignId" = :campaignid AND message = :summary_message
+        ORDER BY "createdAt" DESC, id DESC
+        LIMIT 1
+    ) AS summary
+    UNION
+    SELECT id, message, response, "createdAt", "tokenCount" FROM (
+        SELECT id, message, response, "createdAt", "tokenCount" FROM "Chat"
+        WHERE "campaignId" = :campaignid
+        ORDER BY "createdAt" DESC, id DESC
+        LIMIT :window
+    ) AS recent
+    ORDER BY "createdAt" ASC, id ASC
+""")
+
+def history_params(campaign_id):
+    """
+    Returns the parameters of HISTORY_QUERY for a campaign.
+    """
+    return {
+        'campaignid': str(campaign_id),
+        'pinned': PINNED_ROWS,
+        'summary_message': SUMMARY_MESSAGE,
+        'window': HISTORY_MAX_ROWS
+    }
+
+def split_history(rows):
+    """
+    Splits the rows returned by HISTORY_QUERY into (pinned, summary, turns).
+    summary is None if the campaign has none yet.
+    """
+    pinned = rows[:PINNED_ROWS]
+    summary = next((row for row in rows[PINNED_ROWS:] if row.message == SUMMARY_MESSAGE), None)
+    turns = [row for row in rows[PINNED_ROWS:] if row is not summary]
+    return pinned, summary, turns
+
+@timed('fetch_history')
+def fetch_history(session, campaign_id):
+    """
+    Fetches the chat rows needed to build the model context.
+    Returns (pinned, summary, turns) where summary is None if the campaign has none yet.
+    """
+    rows = session.execute(HISTORY_QUERY, history_params(campaign_id)).fetchall()
+    return split_history(rows)
+
+# Words and punctuation marks, the units of the token estimate
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    """
+    Estimates the number of model tokens of a text locally, without calling the model.
+    Each word counts as one token per 4 characters (at least one), each punctuation mark as one token.
+    """
+    if not text:
+        return 0
+    return sum((len(token) + 3) // 4 for token in TOKEN_PATTERN.findall(text))
+
+# Prompts are few and long, their estimate is kept for the lifetime of the process
+estimate_prompt_tokens = lru_cache(maxsize=256)(estimate_tokens)
+
+def row_tokens(row):
+    """
+    Returns the estimated tokens of a chat row, from its "tokenCount" column when it is set.
+    """
+    if row.tokenCount is not None:
+        return row.tokenCount
+    return estimate_tokens(row.message) + estimate_tokens(row.response)
+
+def history_budget(config, pinned, summary, user_input=''):
+    """
+    Returns the tokens left for the recent turns once the prompt, the pinned rows,
+    the summary and the new message are accounted for.
+    """
+    used = estimate_prompt_tokens(config.system_instruction or '') + estimate_tokens(user_input)
+    used += sum(row_tokens(row) for row in pinned + ([summary] if summary else []))
+    return CONTEXT_TOKEN_BUDGET - used
+
+def split_overflow(turns, available):
+    """
+    Packs the most recent turns into the available token budget.
+    Returns (overflow, recent): recent are the newest turns that fit and are sent to the model,
+    overflow are the oldest turns beyond SUMMARY_TRIGGER of the budget, to be folded into the summary.
+    """
+    overflow, recent = [], []
+    used = 0
+    for row in reversed(turns):
+        used += row_tokens(row)
+        if used <= available:
+            recent.append(row)
+        if used > available * SUMMARY_TRIGGER:
+            overflow.append(row)
+    return overflow[::-1], recent[::-1]
+
+def build_contents(rows):
+    """
+    Converts chat rows into the content list expected by the AI model.
+    Every row is a user message followed by the model response.
+    """
+    contents = []
+    for row in rows:
+        # The opening message has no user message, it answers the 'start' of the base context
+        contents.append(types.Content(role='user', parts=[types.Part(text=row.message or 'start')]))
+        contents.append(types.Content(role='model', parts=[types.Part(text=row.response)]))
+    return contents
+
+@timed('summarize')
+def summarize(summary, rows):
+    """
+    Asks the AI model for a summary of the given chat rows, continuing the previous summary.
+    """
+    prompt = f"""
+        AI, please provide a detailed yet not too long summary of the messages provided below.
+        include all the important information in the summary.
+        provide the summary only, no introduction.
+        Do not include any other text than the summary itself and take part of the game master that talks. 
+        Write the text as if the user asked you a summary.
+        Describe the actions fully, both what the user choose to do and what happened aftewards.
+        The previous summary is: {summary.response if summary else 'none'}.
+        The messages are: {str([(row.message, row.response) for row in rows])}. The summary is:
+        """
+    response, model = model_router.generate('summary', lambda model: genai_client().models.generate_content(
+        model=model, contents=[types.Content(role='user', parts=[types.Part(text=prompt)])]
+    ))
+    count_model_tokens(model, estimate_tokens(prompt), estimate_tokens(response.text))
+    return response.text
+
+# Prompts of the turn contexts, sent to the model once per prompt and model and referenced by later turns
+context_cache = ContextCache(
+    genai_client, ttl=CONTEXT_CACHE_TTL, min_tokens=CONTEXT_CACHE_MIN_TOKENS, estimate=estimate_tokens
+)
+
+def turn_context_steps(campaign_id, user_input):
+    """
+    Steps reading the history (and archived turns) of a campaign for a new user message, on the connection of its turn.
+    Returns (contents, config, overflow, prefix), see assemble_context.
+    """
+    config = yield from campaign_prompt_config_steps(campaign_id)
+    # Fetch only the part of the chat history that goes into the model context
+    with timed('fetch_history'):
+        rows = (yield HISTORY_QUERY, history_params(campaign_id)).fetchall()
+    pinned, summary, turns = split_history(rows)
+    with timed('retrieve'):
+        snippets = yield from archive_snippets_steps(campaign_id, summary, user_input)
+    contents, overflow, prefix = assemble_context(pinned, summary, turns, with_snippets(user_input, snippets), config)
+    return contents, config, overflow, prefix
+
+def build_turn_context(campaign_id, user_input, connection):
+    """
+    Builds the contents and generation config sent to the AI model for a new user message,
+    reading the history with the connection of the turn, which is then closed.
+    Returns (contents, config, overflow, prefix), see assemble_context.
+    """
+    with connection:
+        return run_steps(connection, turn_context_steps(campaign_id, user_input))
+
+def assemble_context(pinned, summary, turns, user_input, config):
+    """
+    Converts the fetched history and the new user message into the contents sent to the AI model,
+    keeping them within CONTEXT_TOKEN_BUDGET.
+    Returns (contents, overflow, prefix) where overflow lists the turns waiting to be summarized, and prefix is
+    the number of leading contents (opening and summary) that only change with the next summary, cached with the prompt.
+    """
+    overflow, recent = split_overflow(turns, history_budget(config, pinned, summary, user_input))
+    if not pinned:
+        # Use the base context if no chat history exists
+        history, prefix = base_context, 0
+    else:
+        # Convert the chat history into the required format for the AI model.
+        # Turns waiting to be summarized stay in the context as long as they fit in the budget
+        history = build_contents(pinned + ([summary] if summary else []))
+        prefix = len(history)
+        history += build_contents(recent)
+    return history + [types.Content(role='user', parts=[types.Part(text=user_input)])], overflow, prefix
+
+def sse_event(event, data):
+    """
+    Formats a server-sent event with a JSON payload.
+    """
+    # Same encoding as the JSON responses (e.g. for dates)
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+# --- ARCHIVE RETRIEVAL ---
+# Turns folded into the summary are moved to "ChatArchive" rather than deleted. Each process keeps a BM25 index
+# (retrieval.ArchiveIndex) of the archive of recently active campaigns, and the archived turns most relevant to
+# a new message are quoted before it, so events older than the summary's detail can still be recalled.
+# An index is built on the worker pool the first time it is needed (the message goes without snippets meanwhile),
+# then kept up to date from the history: a new summary row means new archived turns, read by id from the last
+# indexed one, whichever worker archived them. A turn with snippets costs one more query, on its connection.
+
+ARCHIVE_BATCH = 1000  # Archived turns read at a time
+ARCHIVE_ROWS_QUERY = text("""
+    SELECT id, message, response FROM "ChatArchive"
+    WHERE "campaignId" = :campaignid AND id > :after
+    ORDER BY id LIMIT :limit
+""")
+ARCHIVE_SNIPPETS_QUERY = text("""
+    SELECT id, message, response FROM "ChatArchive" WHERE "campaignId" = :campaignid AND id IN :ids
+""").bindparams(bindparam('ids', expanding=True))
+# Introduces the archived turns quoted before a message
+ARCHIVE_HEADER = 'Earlier in this campaign (archived turns that may be relevant to the next message):'
+
+archive_indexes = LRUCache(maxsize=RETRIEVAL_INDEXES)  # Campaign ID -> ArchiveIndex
+building_indexes = set()  # Campaign IDs whose index is being built by this process
+archive_indexes_lock = threading.Lock()
+
+def archive_text(row):
+    """
+    Returns the indexed text of an archived turn.
+    """
+    return f"{row.message}\n{row.response}"
+
+def archive_rows_params(campaign_id, index):
+    """
+    Returns the parameters of ARCHIVE_ROWS_QUERY for the next archived turns missing from the index.
+    """
+    return {'campaignid': str(campaign_id), 'after': index.last_id, 'limit': ARCHIVE_BATCH}
+
+def index_archive_steps(campaign_id, index):
+    """
+    Steps adding the next archived turns of a campaign to its index. Returns False once there are no more.
+    """
+    rows = (yield ARCHIVE_ROWS_QUERY, archive_rows_params(campaign_id, index)).fetchall()
+    for row in rows:
+        index.add(row.id, archive_text(row))
+    return len(rows) == ARCHIVE_BATCH
+
+def build_archive_index(campaign_id):
+    """
+    Builds the retrieval index of a campaign from its archived turns. Runs on the worker pool.
+    """
+    try:
+        index = ArchiveIndex()
+        more = True
+        with app.app_context():
+            while more:
+                # A connection per batch, so a large archive does not hold one for the whole build
+                with db.engine.connect() as connection:
+                    more = run_steps(connection, index_archive_steps(campaign_id, index))
+        with archive_indexes_lock:
+            archive_indexes[campaign_id] = index
+    except Exception as e:
+        logger.error("Error building archive index: %s", e)
+    finally:
+        with archive_indexes_lock:
+            building_indexes.discard(campaign_id)
+
+def archive_index(campaign_id):
+    """
+    Returns the retrieval index of a campaign, or None while it is being built (the build is started here).
+    """
+    campaign_id = str(campaign_id)
+    with archive_indexes_lock:
+        index = archive_indexes.get(campaign_id)
+        if index is not None or campaign_id in building_indexes:
+            return index
+        building_indexes.add(campaign_id)
+    job_executor.submit(build_archive_index, campaign_id)
+    return None
+
+def drop_archive_index(campaign_id):
+    """
+    Forgets the retrieval index of a campaign whose archive was deleted.
+    """
+    with archive_indexes_lock:
+        archive_indexes.pop(str(campaign_id), None)
+
+def archive_snippets_steps(campaign_id, summary, user_input):
+    """
+    Steps returning the archived turns of the campaign most relevant to the user message, best first.
+    Campaigns without a summary have no archive.
+    """
+    if not RETRIEVAL_SNIPPETS or summary is None:
+        return []
+    index = archive_index(campaign_id)
+    if index is None:
+        return []
+    if index.synced != summary.id:
+        # Turns were archived with a newer summary (or the index was just built)
+        while (yield from index_archive_steps(campaign_id, index)):
+            pass
+        index.synced = summary.id
+    hits = index.search(user_input, RETRIEVAL_SNIPPETS)
+    if not hits:
+        return []
+    rows = yield ARCHIVE_SNIPPETS_QUERY, {'campaignid': str(campaign_id), 'ids': [doc_id for doc_id, _ in hits]}
+    rows = {row.id: row for row in rows}
+    return [rows[doc_id] for doc_id, _ in hits if doc_id in rows]
+
+def with_snippets(user_input, snippets):
+    """
+    Returns the user message preceded by the archived turns quoted for it, within RETRIEVAL_MAX_TOKENS.
+    """
+    if not snippets:
+        return user_input
+    # Long turns are cut so each snippet gets its share of the tokens (about 4 characters per token)
+    length = 4 * RETRIEVAL_MAX_TOKENS // len(snippets)
+    quotes = [f"- Player: {row.message}\n  Game master: {row.response}"[:length] for row in snippets]
+    return '\n'.join([ARCHIVE_HEADER] + quotes + ['', user_input])
+
+# --- CHAT PAGES ---
+# GET /chats reads the history newest-first in pages, with opaque cursors on ("createdAt", id) so a page
+# is found through the ("campaignId", "createdAt") index instead of an OFFSET scan.
+# Responses carry an ETag derived from the campaign's latest id and latest "createdAt", read from the ends of the
+# ("campaignId", id) and ("campaignId", "createdAt") indexes, so a poll with an unchanged history costs two index
+# lookups, whatever the length of the history, and returns 304 without reading any message.
+
+CHATS_PAGE_SIZE = 50
+CHATS_PAGE_MAX = 200
+CHATS_EXPORT_BATCH = 500  # Rows fetched at a time by the NDJSON export
+
+CHAT_VERSION_QUERY = text("""
+    SELECT MAX(id), MAX("createdAt") FROM "Chat" WHERE "campaignId" = :campaignid
+""")
+CHAT_COLUMNS = (column('id'), column('message'), column('response'), column('createdAt', DateTime))
+CHATS_LATEST_QUERY = text("""
+    SELECT id, message, response, "createdAt" FROM "Chat"
+    WHERE "campaignId" = :campaignid
+    ORDER BY "createdAt" DESC, id DESC LIMIT :limit
+""").columns(*CHAT_COLUMNS)
+CHATS_BEFORE_QUERY = text("""
+    SELECT id, message, response, "createdAt" FROM "Chat"
+    WHERE "campaignId" = :campaignid AND ("createdAt", id) < (:createdat, :id)
+    ORDER BY "createdAt" DESC, id DESC LIMIT :limit
+""").bindparams(bindparam('createdat', type_=DateTime)).columns(*CHAT_COLUMNS)
+CHATS_AFTER_QUERY = text("""
+    SELECT id, message, response, "createdAt" FROM "Chat"
+    WHERE "campaignId" = :campaignid AND ("createdAt", id) > (:createdat, :id)
+    ORDER BY "createdAt" ASC, id ASC LIMIT :limit
+""").bindparams(bindparam('createdat', type_=DateTime)).columns(*CHAT_COLUMNS)
+CHATS_EXPORT_QUERY = text("""
+    SELECT id, message, response, "createdAt" FROM "Chat"
+    WHERE "campaignId" = :campaignid
+    ORDER BY "createdAt" ASC, id ASC
+""").columns(*CHAT_COLUMNS)
+
+def encode_cursor(row):
+    """
+    Returns the opaque cursor pointing at a chat row.
+    """
+    return base64.urlsafe_b64encode(f"{row.createdAt.isoformat()}|{row.id}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, key=int):
+    """
+    Returns the (createdAt, id) pointed at by a cursor, raises ValueError if it is malformed.
+    key converts the id, an integer for chats.
+    """
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+        return datetime.fromisoformat(created_at), key(row_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+def page_limit(args, default, maximum):
+    """
+    Parses the limit argument of a paginated GET, default without it.
+    Raises ValueError unless it is an integer between 1 and maximum.
+    """
+    limit = args.get('limit')
+    if limit is None:
+        return default
+    if not limit.isdigit() or not 1 <= int(limit) <= maximum:
+        raise ValueError(f"limit must be an integer between 1 and {maximum}.")
+    return int(limit)
+
+def chats_etag(campaign_id, version, query_string):
+    """
+    Returns the ETag of a GET /chats response, from the result of CHAT_VERSION_QUERY.
+    Any insert (turn, summary or opening) changes the latest id, and DELETE /chats removes the latest rows,
+    which changes the latest "createdAt" (a full reset also inserts a new opening). The query string
+    is included because each page or format is a different representation.
+    """
+    last_id, last_created_at = version
+    key = f"{campaign_id}|{last_id}|{last_created_at}|{query_string.decode()}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def chats_number(args):
+    """
+    Parses the number argument of GET /chats, the oldest rows returned.
+    Returns None without it, raises ValueError unless it is a positive integer.
+    """
+    number = args.get('number')
+    if number is None:
+        return None
+    if not number.isdigit() or int(number) < 1:
+        raise ValueError('number must be a positive integer.')
+    return int(number)
+
+def chats_page_params(campaign_id, args):
+    """
+    Parses the pagination arguments of GET /chats.
+    Returns the query to run and its parameters, raises ValueError on invalid arguments.
+    """
+    limit = page_limit(args, CHATS_PAGE_SIZE, CHATS_PAGE_MAX)
+    before, after = args.get('before'), args.get('after')
+    if before and after:
+        raise ValueError('before and after cannot be used together.')
+
+    # One extra row tells whether another page exists
+    params = {'campaignid': str(campaign_id), 'limit': limit + 1}
+    if before or after:
+        params['createdat'], params['id'] = decode_cursor(before or after)
+    query = CHATS_BEFORE_QUERY if before else CHATS_AFTER_QUERY if after else CHATS_LATEST_QUERY
+    return query, params, limit
+
+def chats_page(rows, limit, args):
+    """
+    Builds the body of a GET /chats page from the rows of its query, newest first.
+    'before' is the cursor of the next older page (None at the start of the history), 'after' the
+    cursor to poll for newer chats.
+    """
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if args.get('after'):
+        rows = rows[::-1]
+        older = True
+    else:
+        older = more
+    return {
+        'chats': [{'message': row.message, 'response': row.response, 'createdAt': row.createdAt} for row in rows],
+        'before': encode_cursor(rows[-1]) if rows and older else None,
+        'after': encode_cursor(rows[0]) if rows else args.get('after'),
+    }
+
+def chat_line(row):
+    """
+    Formats a chat row as one line of the NDJSON export.
+    """
+    return app.json.dumps({'message': row.message, 'response': row.response, 'createdAt': row.createdAt}) + '\n'
+
+# --- CAMPAIGN READS ---
+# The read-only routes (campaign list and details, chat listing) run on DATABASE_REPLICA_URL when it is set, so
+# dashboards polling them do not compete with chat turns for primary connections. An API key that just wrote
+# reads from the primary for REPLICA_STICKY_SECONDS, so it sees its own writes despite the replication lag.
+# The campaign list and details responses of a key are also cached for CAMPAIGN_CACHE_TTL seconds, and dropped
+# when the key creates, edits or deletes a campaign (other processes may serve them until they expire).
+# Lists requested with a limit are paginated oldest first with cursors on ("createdAt", id), like chat pages.
+
+CAMPAIGNS_PAGE_SIZE = 50
+CAMPAIGNS_PAGE_MAX = 200
+
+CAMPAIGN_COLUMNS = (column('id'), column('name'), column('createdAt', DateTime))
+CAMPAIGN_INFO_QUERY = text("""
+    SELECT c.book, COALESCE(p.content, c.prompt), c.name, c."createdAt"
+    FROM "Campaign" c LEFT JOIN "Prompt" p ON p.hash = c."promptHash"
+    WHERE c.id = :campaignid
+""")
+
+campaign_responses = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=CAMPAIGN_CACHE_TTL)  # API key ID -> {request: (body, status)}
+primary_readers = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=REPLICA_STICKY_SECONDS)  # API key IDs that just wrote
+
+def reads_from_replica(api_key_id):
+    """
+    Returns whether the read-only routes of the API key run on the replica.
+    """
+    return DATABASE_REPLICA_URL is not None and cache_get(primary_readers, api_key_id) is None
+
+def read_engine(api_key_id):
+    """
+    Returns the engine of the read-only routes of the API key: the replica, unless the key just wrote.
+    """
+    return db.engines['replica'] if reads_from_replica(api_key_id) else db.engine
+
+def stick_to_primary(api_key_id):
+    """
+    Sends the reads of the API key to the primary for a while, after it wrote.
+    """
+    if DATABASE_REPLICA_URL is not None and REPLICA_STICKY_SECONDS > 0:
+        cache_set(primary_readers, api_key_id, True)
+
+def campaigns_changed(api_key_id):
+    """
+    Drops the cached campaign responses of the API key, when one of its campaigns is created, edited or deleted.
+    """
+    with auth_cache_lock:
+        campaign_responses.pop(api_key_id, None)
+
+@app.after_request
+def stick_writers_to_primary(response):
+    api_key_id = getattr(request, 'api_key_id', None)
+    if DATABASE_REPLICA_URL is not None and api_key_id and request.method != 'GET' and response.status_code < 400:
+        # Once the response is sent, when a streamed turn is stored
+        response.call_on_close(lambda: stick_to_primary(api_key_id))
+    return response
+
+def cached_campaign_response(api_key_id, key):
+    """
+    Returns the cached responses of the API key and the (body, status) cached for the request key, or None.
+    """
+    if not CAMPAIGN_CACHE_TTL:
+        return None, None
+    with auth_cache_lock:
+        responses = campaign_responses.get(api_key_id)
+        if responses is None:
+            responses = campaign_responses[api_key_id] = {}
+        return responses, responses.get(key)
+
+def cache_campaign_response(api_key_id, responses, key, response):
+    """
+    Caches the (body, status) of a request, unless the campaigns of the key changed since its responses were
+    returned by cached_campaign_response (the response might be older than the change).
+    """
+    with auth_cache_lock:
+        if responses is not None and campaign_responses.get(api_key_id) is responses:
+            responses[key] = response
+
+@lru_cache(maxsize=None)
+def campaigns_page_query(user, after):
+    """
+    Returns the query of a page of campaigns, optionally of one user and after a cursor.
+    """
+    query = text(f"""
+        SELECT id, name, "createdAt" FROM "Campaign"
+        WHERE "apiKeyId" = :id{' AND "userId" = :userId' if user else ''}{' AND ("createdAt", id) > (:createdat, :campaignid)' if after else ''}
+        ORDER BY "createdAt", id LIMIT :limit
+    """).columns(*CAMPAIGN_COLUMNS)
+    return query.bindparams(bindparam('createdat', type_=DateTime)) if after else query
+
+def campaigns_page_params(api_key_id, args):
+    """
+    Parses the pagination arguments of GET /campaigns.
+    Returns the query to run and its parameters, raises ValueError on invalid arguments.
+    """
+    limit = page_limit(args, CAMPAIGNS_PAGE_SIZE, CAMPAIGNS_PAGE_MAX)
+    user, after = args.get('userId'), args.get('after')
+    # One extra row tells whether another page exists
+    params = {'id': api_key_id, 'userId': user, 'limit': limit + 1}
+    if after:
+        params['createdat'], params['campaignid'] = decode_cursor(after, key=str)
+    return campaigns_page_query(bool(user), bool(after)), params, limit
+
+def campaigns_page(rows, limit):
+    """
+    Builds the body of a GET /campaigns page from the rows of its query, with the cursor of the next page
+    ('after', None on the last page).
+    """
+    return {
+        'campaigns': [{'id': str(row.id), 'name': row.name} for row in rows[:limit]],
+        'after': encode_cursor(rows[limit - 1]) if len(rows) > limit else None,
+    }
+
+def campaign_info(row):
+    """
+    Returns the body of GET /campaigns/<id> from the row of CAMPAIGN_INFO_QUERY.
+    """
+    return {'book': row[0], 'prompt': row[1], 'name': row[2], 'created_at': row[3]}
+
+# --- TURN SERIALIZATION ---
+# Turns of the same campaign run one at a time, otherwise concurrent requests (e.g. client retries)
+# would read the same history and interleave their writes. Different campaigns run in parallel.
+# Requests of one process queue on an in-memory lock; with TURN_LOCK_BACKEND=database they then
+# take a lease in the "TurnLock" table, which serializes turns across workers without holding a connection.
+# The connection that took the lease also reads the history of the turn, and the lease is released in the
+# transaction storing the turn: a turn costs one checkout before the model call and one commit after it.
+
+TURN_LOCK_ACQUIRE = text("""
+    INSERT INTO "TurnLock" ("campaignId", token, "expiresAt")
+    VALUES (:campaignid, :token, :expires)
+    ON CONFLICT ("campaignId") DO UPDATE
+    SET token = excluded.token, "expiresAt" = excluded."expiresAt"
+    WHERE "TurnLock"."expiresAt" < :now
+""")
+TURN_LOCK_RELEASE = text("""DELETE FROM "TurnLock" WHERE "campaignId" = :campaignid AND token = :token""")
+
+class TurnBusy(Exception):
+    """
+    Raised when the previous turn of a campaign did not finish within TURN_LOCK_TIMEOUT.
+    """
+
+def turn_lock_params(campaign_id, token):
+    """
+    Returns the parameters of TURN_LOCK_ACQUIRE for a campaign.
+    """
+    now = datetime.utcnow()
+    return {'campaignid': str(campaign_id), 'token': token, 'now': now, 'expires': now + TURN_LOCK_LEASE}
+
+def turn_lease_steps(campaign_id):
+    """
+    Steps taking the lease of a campaign turn in "TurnLock". Returns its token, or None if another worker has it.
+    """
+    token = str(uuid.uuid4())
+    acquired = (yield TURN_LOCK_ACQUIRE, turn_lock_params(campaign_id, token)).rowcount == 1
+    yield COMMIT
+    return token if acquired else None
+
+def turn_release_steps(turn):
+    """
+    Steps releasing the lease of a turn.
+    """
+    yield TURN_LOCK_RELEASE, {'campaignid': turn.campaign_id, 'token': turn.token}
+    yield COMMIT
+    turn.token = None
+
+def turn_poll_delays(deadline):
+    """
+    Yields the growing delays between the polls of a turn leased by another worker,
+    and raises TurnBusy once the next poll would come after the deadline.
+    """
+    delay = 0.05
+    while time.monotonic() + delay <= deadline:
+        yield delay
+        delay = min(delay * 2, 1.0)
+    raise TurnBusy()
+
+turn_locks = {}  # Campaign ID -> [lock, number of requests using it]
+turn_locks_lock = threading.Lock()
+
+def release_local_turn(campaign_id):
+    """
+    Releases the in-memory turn lock of a campaign, and forgets it once nobody uses it.
+    """
+    with turn_locks_lock:
+        entry = turn_locks[campaign_id]
+        entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del turn_locks[campaign_id]
+
+class Turn:
+    """
+    The turn of a campaign held by a request, see acquire_turn.
+    token is the lease in "TurnLock" (None without one, or once storeChat released it). With keep_connection,
+    connection is the open connection that took the lease, for the reads of the turn: close it before calling the model.
+    """
+    def __init__(self, campaign_id, token=None, connection=None):
+        self.campaign_id = campaign_id
+        self.token = token
+        self.connection = connection
+
+def acquire_turn(campaign_id, keep_connection=False):
+    """
+    Blocks until the request holds the turn of the campaign.
+    Returns a Turn to pass to release_turn, raises TurnBusy on timeout.
+    """
+    campaign_id = str(campaign_id)
+    deadline = time.monotonic() + TURN_LOCK_TIMEOUT
+    with turn_locks_lock:
+        entry = turn_locks.setdefault(campaign_id, [threading.Lock(), 0])
+        entry[1] += 1
+    if not entry[0].acquire(timeout=TURN_LOCK_TIMEOUT):
+        with turn_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del turn_locks[campaign_id]
+        raise TurnBusy()
+
+    turn = Turn(campaign_id)
+    delays = turn_poll_delays(deadline)
+    try:
+        # Checked out once the in-memory lock is held, so queued requests do not hold connections
+        turn.connection = db.engine.connect() if keep_connection or TURN_LOCK_BACKEND == 'database' else None
+        while TURN_LOCK_BACKEND == 'database':
+            turn.token = run_steps(turn.connection, turn_lease_steps(campaign_id))
+            if turn.token is not None:
+                break
+            delay = next(delays)
+            # Another worker has the turn, poll with a growing delay without holding the connection
+            turn.connection.close()
+            time.sleep(delay)
+            turn.connection = db.engine.connect()
+        if not keep_connection and turn.connection is not None:
+            turn.connection.close()
+        return turn
+    except BaseException:
+        if turn.connection is not None:
+            turn.connection.close()
+        release_local_turn(campaign_id)
+        raise
+
+def release_turn(turn):
+    """
+    Releases the turn of a campaign acquired with acquire_turn.
+    """
+    try:
+        if turn.connection is not None:
+            turn.connection.close()
+        if turn.token is not None:
+            # Also called once a streamed response is closed, outside of the request context
+            with app.app_context(), Session(db.engine) as session:
+                run_steps(session, turn_release_steps(turn))
+    except Exception as e:
+        # The lease expires on its own
+        logger.error("Error releasing turn lock: %s", e)
+    finally:
+        release_local_turn(turn.campaign_id)
+
+@contextmanager
+def campaign_turn(campaign_id, keep_connection=False):
+    """
+    Holds the turn of the campaign for the duration of the block, and yields its Turn.
+    """
+    turn = acquire_turn(campaign_id, keep_connection)
+    try:
+        yield turn
+    finally:
+        release_turn(turn)
+
+# --- BATCH CHATS ---
+# POST /campaigns/chats runs the messages of many campaigns in one request, e.g. for a game server relaying its
+# players. The API key is checked once and the owners of all the campaigns are read with one query. The turns of
+# the campaigns that are free are taken together (one statement for their leases), and their histories read on
+# the same connection with one windowed query. Busy campaigns are polled and started the same way once free.
+# Generations then run concurrently on a worker pool, and the turns are stored in shared multi-row batches by
+# batch_writer. Each item keeps its campaign turn until it is stored.
+
+BATCH_OWNERS_QUERY = text("""
+    SELECT id, "apiKeyId", "promptHash" FROM "Campaign" WHERE id IN :ids
+""").bindparams(bindparam('ids', expanding=True))
+# Same rows per campaign as HISTORY_QUERY: the pinned rows, the latest summary and the most recent turns.
+# The histories are kept short by the summaries, so ranking all their rows is cheap.
+BATCH_HISTORY_QUERY = text("""
+    SELECT "campaignId", id, message, response, "createdAt", "tokenCount" FROM (
+        SELECT "campaignId", id, message, response, "createdAt", "tokenCount",
+            ROW_NUMBER() OVER (PARTITION BY "campaignId" ORDER BY "createdAt" ASC, id ASC) AS head_rank,
+            ROW_NUMBER() OVER (PARTITION BY "campaignId" ORDER BY "createdAt" DESC, id DESC) AS tail_rank,
+            ROW_NUMBER() OVER (
+                PARTITION BY "campaignId", message = :summary_message ORDER BY "createdAt" DESC, id DESC
+            ) AS summary_rank
+        FROM "Chat"
+        WHERE "campaignId" IN :ids
+    ) AS ranked
+    WHERE head_rank <= :pinned OR tail_rank <= :window OR (message = :summary_message AND summary_rank = 1)
+    ORDER BY "campaignId", "createdAt" ASC, id ASC
+""").bindparams(bindparam('ids', expanding=True))
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+@lru_cache(maxsize=16)
+def turn_lock_batch_acquire(count):
+    """
+    Returns the TURN_LOCK_ACQUIRE of `count` campaigns, parameters suffixed with their position (campaignid_0, ...).
+    The campaigns whose lease was taken are returned.
+    """
+    values = ', '.join(f'(:campaignid_{i}, :token_{i}, :expires)' for i in range(count))
+    return text(f"""
+        INSERT INTO "TurnLock" ("campaignId", token, "expiresAt")
+        VALUES {values}
+        ON CONFLICT ("campaignId") DO UPDATE
+        SET token = excluded.token, "expiresAt" = excluded."expiresAt"
+        WHERE "TurnLock"."expiresAt" < :now
+        RETURNING "campaignId"
+    """)
+
+def turn_lock_batch_params(turns):
+    """
+    Returns the parameters of turn_lock_batch_acquire for the turns, setting their lease tokens.
+    """
+    now = datetime.utcnow()
+    params = {'now': now, 'expires': now + TURN_LOCK_LEASE}
+    for i, turn in enumerate(turns):
+        turn.token = str(uuid.uuid4())
+        params.update({f'campaignid_{i}': turn.campaign_id, f'token_{i}': turn.token})
+    return params
+
+def batch_items(body):
+    """
+    Validates the body of a batch request, {"items": [{"campaignId": ..., "input": ...}, ...]}.
+    Returns its items, raises ValueError if it is malformed.
+    """
+    items = body.get('items') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('items must be a non-empty list.')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f'A batch holds at most {BATCH_MAX_ITEMS} items.')
+    if not all(isinstance(item, dict) and isinstance(item.get('input', ''), str) for item in items):
+        raise ValueError('Each item must be an object with a campaignId and an input.')
+    return items
+
+def batch_line(index, campaign_id, status, **fields):
+    """
+    Formats the result of a batch item as one NDJSON line.
+    """
+    return app.json.dumps({'index': index, 'campaignId': campaign_id, 'status': status, **fields}) + '\n'
+
+def batch_owners_steps(campaign_ids):
+    """
+    Steps returning the owner of each campaign (None if it does not exist), reading the ones not cached with one query.
+    """
+    owners = {campaign_id: cache_get(campaign_owner_cache, campaign_id) for campaign_id in campaign_ids}
+    missing = [campaign_id for campaign_id, owner in owners.items() if owner is None]
+    if missing:
+        for row in (yield BATCH_OWNERS_QUERY, {'ids': missing}):
+            cache_campaign(row.id, row.apiKeyId, row.promptHash)
+            owners[str(row.id)] = row.apiKeyId
+    return owners
+
+def parse_batch(items):
+    """
+    Returns the result lines of the batch items with an invalid campaign ID, and the (index, campaign ID, input)
+    of the others.
+    """
+    refused, accepted = [], []
+    for index, item in enumerate(items):
+        try:
+            accepted.append((index, str(uuid.UUID(str(item.get('campaignId')))), item.get('input', '')))
+        except ValueError:
+            refused.append(batch_line(index, item.get('campaignId'), 400, error='Invalid campaign ID.'))
+    return refused, accepted
+
+def check_batch(accepted, owners, api_key_id):
+    """
+    Checks the campaign of each parsed batch item against the owners of the campaigns.
+    Returns the result lines of the items refused, and the items to run.
+    """
+    refused, pending, seen = [], [], set()
+    for index, campaign_id, user_input in accepted:
+        if owners[campaign_id] is None:
+            refused.append(batch_line(index, campaign_id, 404, error='Campaign not found.'))
+        elif owners[campaign_id] != api_key_id:
+            refused.append(batch_line(index, campaign_id, 401, error='You do not have access'))
+        elif campaign_id in seen:
+            # Its history would depend on the other message, send it in a later batch
+            refused.append(batch_line(index, campaign_id, 409, error='The batch has another message for this campaign.'))
+        else:
+            seen.add(campaign_id)
+            pending.append((index, campaign_id, user_input))
+    return refused, pending
+
+def batch_settle_steps(items, api_key_id):
+    """
+    Steps checking the campaign of each batch item. Returns the result lines of the items refused, and the items to run.
+    """
+    refused, accepted = parse_batch(items)
+    with timed('require_campaign'):
+        owners = yield from batch_owners_steps({campaign_id for _, campaign_id, _ in accepted})
+    checked, pending = check_batch(accepted, owners, api_key_id)
+    return refused + checked, pending
+
+def batch_settle(items, api_key_id):
+    """
+    Checks the campaign of each batch item, see batch_settle_steps.
+    """
+    with Session(db.engine) as session:
+        return run_steps(session, batch_settle_steps(items, api_key_id))
+
+def batch_lease_steps(turns):
+    """
+    Steps taking the leases of the turns {campaign ID: Turn} in one statement.
+    Returns the campaign IDs whose lease was taken, another worker has the others.
+    """
+    rows = yield turn_lock_batch_acquire(len(turns)), turn_lock_batch_params(turns.values())
+    leased = {str(row.campaignId) for row in rows}
+    yield COMMIT
+    return leased
+
+def try_turns(campaign_ids):
+    """
+    Takes the turns of the campaigns that are free, without waiting.
+    Returns ({campaign ID: Turn}, connection): the connection took the leases and stays open for the reads
+    of the turns (None if no turn was taken).
+    """
+    turns = {}
+    with turn_locks_lock:
+        for campaign_id in campaign_ids:
+            entry = turn_locks.setdefault(campaign_id, [threading.Lock(), 0])
+            # Free only if no other request holds or waits for it, so queued requests go first
+            if entry[1] == 0:
+                entry[1] += 1
+                entry[0].acquire()
+                turns[campaign_id] = Turn(campaign_id)
+    if not turns:
+        return turns, None
+    connection = None
+    try:
+        connection = db.engine.connect()
+        if TURN_LOCK_BACKEND == 'database':
+            leased = run_steps(connection, batch_lease_steps(turns))
+            # Another worker has the others
+            for campaign_id in [campaign_id for campaign_id in turns if campaign_id not in leased]:
+                release_local_turn(campaign_id)
+                del turns[campaign_id]
+        return turns, connection
+    except BaseException:
+        if connection is not None:
+            connection.close()
+        for turn in turns.values():
+            turn.token = None  # Not committed
+            release_local_turn(turn.campaign_id)
+        raise
+
+def batch_history_params(campaign_ids):
+    """
+    Returns the parameters of BATCH_HISTORY_QUERY for the campaigns.
+    """
+    return {'ids': list(campaign_ids), 'pinned': PINNED_ROWS, 'summary_message': SUMMARY_MESSAGE, 'window': HISTORY_MAX_ROWS}
+
+def split_batch_history(rows, campaign_ids):
+    """
+    Splits the rows returned by BATCH_HISTORY_QUERY into {campaign ID: (pinned, summary, turns)}.
+    """
+    grouped = {campaign_id: [] for campaign_id in campaign_ids}
+    for row in rows:
+        grouped[str(row.campaignId)].append(row)
+    return {campaign_id: split_history(campaign_rows) for campaign_id, campaign_rows in grouped.items()}
+
+def batch_start_steps(pending, turns):
+    """
+    Steps reading the histories of the campaigns whose turn was taken with one query, and the archived turns quoted
+    for their items. Returns the started (item, turn, history, snippets).
+    """
+    with timed('fetch_history'):
+        rows = (yield BATCH_HISTORY_QUERY, batch_history_params(turns)).fetchall()
+    histories = split_batch_history(rows, turns)
+    started = []
+    for item in pending:
+        campaign_id, user_input = item[1], item[2]
+        if campaign_id in turns:
+            with timed('retrieve'):
+                snippets = yield from archive_snippets_steps(campaign_id, histories[campaign_id][1], user_input)
+            started.append((item, turns[campaign_id], histories[campaign_id], snippets))
+    return started
+
+def start_batch_items(pending):
+    """
+    Starts the batch items whose campaign is free: takes their turns, then reads their histories (and archived turns)
+    on the connection that took the leases. Returns the started (item, turn, history, snippets), and the items left.
+    """
+    turns, connection = try_turns({campaign_id for _, campaign_id, _ in pending})
+    if connection is None:
+        return [], pending
+    try:
+        with connection:
+            started = run_steps(connection, batch_start_steps(pending, turns))
+    except BaseException:
+        for turn in turns.values():
+            release_turn(turn)
+        raise
+    return started, [item for item in pending if item[1] not in turns]
+
+def batch_item_stored(response, stored):
+    """
+    Returns the status and fields of the result line of a batch item whose turn storeChat returned.
+    """
+    if stored is None:
+        return 404, {'error': 'Campaign not found.'}
+    return 200, {'response': response, 'id': stored['id'], 'createdAt': stored['createdAt']}
+
+def batch_item_failed(error):
+    """
+    Returns the status and fields of the result line of a batch item that failed with the error.
+    """
+    if isinstance(error, RateLimited):
+        return 429, {'error': str(error), 'retryAfter': max(1, math.ceil(error.retry_after))}
+    logger.error("Error in campaign_chats: %s", error)
+    if isinstance(error, ModelUnavailable):
+        message, status = model_error(error)
+        return status, {'error': message}
+    return 500, {'error': f"Generation error: {error}"}
+
+def run_batch_item(api_key_id, limits, item, turn, history, snippets):
+    """
+    Generates and stores the turn of a batch item, on the batch worker pool, then releases its campaign turn.
+    Returns the status and fields of its result line.
+    """
+    _, campaign_id, user_input = item
+    generation, overflow = False, None
+    try:
+        with app.app_context():
+            # Each item counts as a request and a generation of the API key
+            generation = admit_request(api_key_id, limits, True)
+            config = campaign_prompt_config(campaign_id)
+            pinned, summary, turns = history
+            contents, overflow, prefix = assemble_context(pinned, summary, turns, with_snippets(user_input, snippets), config)
+            with timed('generate'):
+                response, model = model_router.generate(
+                    'chat', lambda model: context_cache.generate_content(model, contents, config, prefix, campaign_id)
+                )
+            record_generation(api_key_id, limits, model, contents, config, response.text)
+            stored = storeChat(campaign_id, user_input, response.text, turn, batched=True)
+        return batch_item_stored(response.text, stored)
+    except Exception as e:
+        return batch_item_failed(e)
+    finally:
+        release_turn(turn)
+        if generation:
+            release_generation(api_key_id)
+        if overflow:
+            enqueue_summary(campaign_id)
+
+class BatchRun:
+    """
+    Schedule of the accepted items of a batch, see run_batch: pending items wait for the turn of their campaign
+    (polled up to TURN_LOCK_TIMEOUT), ready ones hold it, and at most BATCH_CONCURRENCY are running at once.
+    running maps the future (or task in api_async.py) of each running item to the item.
+    """
+    def __init__(self, limits, pending):
+        self.concurrency = min(BATCH_CONCURRENCY, limits[2]) if limits[2] else BATCH_CONCURRENCY
+        self.deadline = time.monotonic() + TURN_LOCK_TIMEOUT
+        self.pending, self.ready, self.running = pending, deque(), {}
+        self.poll, self.delay = 0, 0.05
+
+    def unfinished(self):
+        return bool(self.pending or self.ready or self.running)
+
+    def due(self):
+        """
+        Returns True if the busy campaigns of the pending items are to be polled.
+        """
+        return bool(self.pending) and time.monotonic() >= self.poll
+
+    def polled(self, started, pending):
+        """
+        Records the items started by a poll, see start_batch_items. Returns the result lines of the items given up.
+        """
+        self.ready.extend(started)
+        self.pending, lines = pending, []
+        if pending and time.monotonic() + self.delay > self.deadline:
+            lines = [
+                batch_line(index, campaign_id, 409, error='Another message is still being processed for this campaign.')
+                for index, campaign_id, _ in pending
+            ]
+            self.pending = []
+        # Busy campaigns are polled with a growing delay, short since a turn mostly waits on one model call
+        self.poll = time.monotonic() + self.delay
+        self.delay = min(self.delay * 2, 0.25)
+        return lines
+
+    def failed(self, error):
+        """
+        Gives up the pending items after a poll failed with the error. Returns their result lines.
+        """
+        logger.error("Error in campaign_chats: %s", error)
+        lines = [batch_line(index, campaign_id, 500, error=f"Database error: {error}") for index, campaign_id, _ in self.pending]
+        self.pending = []
+        return lines
+
+    def startable(self):
+        """
+        Yields the ready items to start now, the caller adds them to running.
+        """
+        while self.ready and len(self.running) < self.concurrency:
+            yield self.ready.popleft()
+
+    def timeout(self):
+        """
+        Returns how long to wait for running items before the next poll, None if nothing is pending.
+        """
+        return max(0, self.poll - time.monotonic()) if self.pending else None
+
+    def finished(self, handle, result):
+        """
+        Forgets a running item that returned the status and fields of its result line, and returns the line.
+        """
+        index, campaign_id, _ = self.running.pop(handle)
+        status, fields = result
+        return batch_line(index, campaign_id, status, **fields)
+
+def run_batch(api_key_id, limits, pending):
+    """
+    Runs the accepted items of a batch and yields their result lines as they finish.
+    Items wait for the turn of their campaign up to TURN_LOCK_TIMEOUT, and at most BATCH_CONCURRENCY generate at once.
+    """
+    batch = BatchRun(limits, pending)
+    try:
+        while batch.unfinished():
+            if batch.due():
+                try:
+                    lines = batch.polled(*start_batch_items(batch.pending))
+                except Exception as e:
+                    lines = batch.failed(e)
+                yield from lines
+            for entry in batch.startable():
+                # Run in the context of the request, so its queries are counted in its metrics
+                batch.running[batch_executor.submit(copy_context().run, run_batch_item, api_key_id, limits, *entry)] = entry[0]
+            if batch.running:
+                done, _ = wait(batch.running, timeout=batch.timeout(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield batch.finished(future, future.result())
+            elif batch.pending:
+                time.sleep(batch.timeout())
+    finally:
+        # Closed early by the client: the items not started give back their turns, running ones release their own
+        for entry in batch.ready:
+            release_turn(entry[1])
+
+# --- IDEMPOTENCY ---
+# POST requests sent with an Idempotency-Key header run once per API key and key. The first one records the
+# key in "IdempotencyKey" as running; retries wait for it, then get its stored response replayed. Only
+# successful responses are kept, so a retry of a failed request runs again. Recent results are also kept in memory.
+
+IDEMPOTENCY_CLAIM = text("""
+    INSERT INTO "IdempotencyKey" ("apiKeyId", key, fingerprint, status, "expiresAt")
+    VALUES (:apikeyid, :key, :fingerprint, 'running', :lease)
+    ON CONFLICT ("apiKeyId", key) DO UPDATE
+    SET fingerprint = excluded.fingerprint, status = 'running', "statusCode" = NULL, body = NULL, headers = NULL,
+        "expiresAt" = excluded."expiresAt"
+    WHERE "IdempotencyKey"."expiresAt" < :now
+""")
+IDEMPOTENCY_SELECT = text("""
+    SELECT fingerprint, status, "statusCode", body, headers FROM "IdempotencyKey"
+    WHERE "apiKeyId" = :apikeyid AND key = :key
+""")
+IDEMPOTENCY_STORE = text("""
+    UPDATE "IdempotencyKey"
+    SET status = 'done', "statusCode" = :statuscode, body = :body, headers = :headers, "expiresAt" = :expires
+    WHERE "apiKeyId" = :apikeyid AND key = :key
+""")
+IDEMPOTENCY_RELEASE = text("""DELETE FROM "IdempotencyKey" WHERE "apiKeyId" = :apikeyid AND key = :key AND status = 'running'""")
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+idempotency_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)  # (API key ID, key) -> completed record
+# (API key ID, key) -> event set when the request running in this process finishes. Only single dict operations
+# are used on it, so it needs no lock.
+idempotency_events = {}
+
+def request_fingerprint(method, path, body):
+    """
+    Returns the hash identifying a request, so a key reused for a different request is detected.
+    """
+    return hashlib.sha256(method.encode() + b' ' + path.encode() + b'\n' + body).hexdigest()
+
+def idempotency_params(scope, fingerprint=None):
+    """
+    Returns the parameters of the idempotency queries for an (API key ID, key) scope.
+    """
+    now = datetime.utcnow()
+    return {'apikeyid': scope[0], 'key': scope[1], 'fingerprint': fingerprint, 'now': now, 'lease': now + IDEMPOTENCY_LEASE}
+
+def idempotency_record(fingerprint, status_code, body, headers):
+    """
+    Returns the record stored for a response to replay it later.
+    """
+    headers = {name: headers[name] for name in REPLAYED_HEADERS if name in headers}
+    return {'fingerprint': fingerprint, 'status': 'done', 'statusCode': status_code, 'body': body, 'headers': json.dumps(headers)}
+
+def idempotency_store_params(scope, record):
+    """
+    Returns the parameters of IDEMPOTENCY_STORE for a completed record.
+    """
+    return dict(
+        idempotency_params(scope), statuscode=record['statusCode'], body=record['body'], headers=record['headers'],
+        expires=datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL)
+    )
+
+def claim_idempotency_steps(scope, fingerprint, events, new_event):
+    """
+    Steps recording the key as running for this request, with an event from new_event in events while it runs.
+    Returns None if this request got it, otherwise the record of the request that has it.
+    """
+    claimed = (yield IDEMPOTENCY_CLAIM, idempotency_params(scope, fingerprint)).rowcount == 1
+    yield COMMIT
+    if claimed:
+        events.setdefault(scope, new_event())
+        return None
+    row = (yield IDEMPOTENCY_SELECT, idempotency_params(scope)).first()
+    # Ends the read, so no connection is held while waiting for the request that has the key
+    yield COMMIT
+    # The key expired and was taken over between both queries, try again
+    record = dict(row._mapping) if row else {'fingerprint': fingerprint, 'status': 'running'}
+    if record['status'] == 'done':
+        cache_set(idempotency_cache, scope, record)
+    return record
+
+def idempotency_steps(scope, fingerprint, events, new_event):
+    """
+    Steps claiming the key for this request, waiting up to IDEMPOTENCY_WAIT while another request has it.
+    Returns (record, error): both None once this request has the key, the record of the completed request to
+    replay, or the message and status code of the error response.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    delay = 0.05
+    while True:
+        record = cache_get(idempotency_cache, scope) or (yield from claim_idempotency_steps(scope, fingerprint, events, new_event))
+        if record is None:
+            return None, None
+        if record['fingerprint'] != fingerprint:
+            return None, ('Idempotency-Key was already used for a different request.', 422)
+        if record['status'] == 'done':
+            return record, None
+        if time.monotonic() >= deadline:
+            return None, ('A request with this Idempotency-Key is still being processed.', 409)
+        # The original request is running, here or in another worker
+        event = events.get(scope)
+        if event:
+            yield Pause(max(0, deadline - time.monotonic()), event)
+        else:
+            yield Pause(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, 1.0)
+
+def finish_idempotency_steps(scope, record, events):
+    """
+    Steps storing the record of a successful request for replay, or freeing the key for a retry (record None),
+    then waking up the requests waiting for it in this process.
+    """
+    try:
+        if record is not None:
+            yield IDEMPOTENCY_STORE, idempotency_store_params(scope, record)
+            cache_set(idempotency_cache, scope, record)
+        else:
+            yield IDEMPOTENCY_RELEASE, idempotency_params(scope)
+        yield COMMIT
+    except Exception as e:
+        # Retries wait for the lease to expire
+        logger.error("Error storing idempotent response: %s", e)
+    finally:
+        event = events.pop(scope, None)
+        if event:
+            event.set()
+
+def finish_idempotency_key(scope, fingerprint, response):
+    """
+    Stores the response of a successful request for replay, or frees the key for a retry otherwise.
+    """
+    record = None
+    if response is not None and response.status_code < 400:
+        record = idempotency_record(fingerprint, response.status_code, response.get_data(as_text=True), response.headers)
+    with Session(db.engine) as session:
+        run_steps(session, finish_idempotency_steps(scope, record, idempotency_events))
+
+def replay(record):
+    """
+    Returns the stored response of an idempotent request.
+    """
+    result = Response(record['body'], status=record['statusCode'], headers=json.loads(record['headers'] or '{}'))
+    result.headers['Idempotent-Replayed'] = 'true'
+    return result
+
+def idempotent(f):
+    """
+    Decorator running a POST route once per Idempotency-Key header, must come after require_api_key.
+    Requests without the header are not affected. With it, the request is only admitted by the rate limits
+    once it claimed the key: a retry waiting for the original request or replaying it takes no generation slot.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key must be at most 255 characters.'}), 400
+        scope = (str(request.api_key_id), key)
+        fingerprint = request_fingerprint(request.method, request.path, request.get_data())
+        try:
+            with Session(db.engine) as session:
+                record, error = run_steps(session, idempotency_steps(scope, fingerprint, idempotency_events, threading.Event))
+        except Exception as e:
+            return jsonify({'error': f"Database error: {e}"}), 500
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+        if record:
+            return replay(record)
+
+        result = None
+        try:
+            result = app.make_response(admitted(f, *args, **kwargs))
+            return result
+        finally:
+            finish_idempotency_key(scope, fingerprint, result)
+    decorated.idempotent = True  # Seen by require_api_key through the decorators in between
+    return decorated
+
+# --- BACKGROUND JOBS ---
+# Summaries and campaign openings are generated off the request path, on bounded worker pools.
+# Each campaign has at most one job of a kind in the "CampaignJob" table, so the work survives
+# restarts and is never done twice in parallel. No connection is held while a job waits on the model.
+
+job_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='summary')
+opening_executor = ThreadPoolExecutor(max_workers=OPENING_WORKERS, thread_name_prefix='opening')
+queued_jobs = set()  # (campaign ID, kind) of the jobs already submitted to this process
+queued_jobs_lock = threading.Lock()
+
+def submit_job(campaign_id, kind):
+    """
+    Submits the recorded job of a campaign to the worker pool of its kind, unless it already was.
+    """
+    campaign_id = str(campaign_id)
+    with queued_jobs_lock:
+        if (campaign_id, kind) in queued_jobs:
+            return
+        queued_jobs.add((campaign_id, kind))
+    executor, run = JOB_KINDS[kind]
+    executor().submit(run, campaign_id)
+
+def enqueue_summary(campaign_id):
+    """
+    Records a pending summary job for the campaign and submits it to the worker pool.
+    Does nothing if the campaign already has a job waiting or running.
+    """
+    campaign_id = str(campaign_id)
+    with queued_jobs_lock:
+        if (campaign_id, 'summary') in queued_jobs:
+            return
+    try:
+        with app.app_context(), Session(db.engine) as session:
+            session.execute(
+                text("""
+                    INSERT INTO "CampaignJob" ("campaignId", kind, status, "updatedAt")
+                    VALUES (:campaignid, 'summary', 'pending', :now)
+                    ON CONFLICT ("campaignId", kind) DO UPDATE
+                    SET status = 'pending', "updatedAt" = :now
+                    WHERE "CampaignJob".status NOT IN ('pending', 'running')
+                """),
+                {'campaignid': campaign_id, 'now': datetime.utcnow()}
+            )
+            session.commit()
+        submit_job(campaign_id, 'summary')
+    except Exception as e:
+        logger.error("Error enqueuing summary job: %s", e)
+
+def claim_job(session, campaign_id, kind):
+    """
+    Marks a pending (or abandoned) job as running.
+    Returns True if this worker got the job, False if another one has it or it is already done.
+    """
+    now = datetime.utcnow()
+    result = session.execute(
+        text("""
+            UPDATE "CampaignJob"
+            SET status = 'running', attempts = attempts + 1, "updatedAt" = :now
+            WHERE "campaignId" = :campaignid AND kind = :kind
+            AND (status = 'pending' OR (status = 'running' AND "updatedAt" < :stale))
+        """),
+        {'campaignid': campaign_id, 'kind': kind, 'now': now, 'stale': now - JOB_STALE_AFTER}
+    )
+    session.commit()
+    return result.rowcount == 1
 
-# --- API KEY AUTH (NOW FROM HEADER) ---
-def verify_api_key():
+def finish_job(session, campaign_id, kind, status):
     """
-    Verifies the API key provided in the Authorization header.
-    Returns the API key ID if valid, or an error message if invalid.
+    Records the final status ('done' or 'failed') of a job.
     """
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return None, "Missing Authorization header."
+    session.execute(
+        text("""UPDATE "CampaignJob" SET status = :status, "updatedAt" = :now WHERE "campaignId" = :campaignid AND kind = :kind"""),
+        {'campaignid': campaign_id, 'kind': kind, 'status': status, 'now': datetime.utcnow()}
+    )
+    session.commit()
 
-    if not auth_header.startswith('Bearer '):
-        return None, "Invalid Authorization header format."
+def run_summary_job(campaign_id):
+    """
+    Folds the turns that fell out of the history window into the campaign summary.
+    Runs on the worker pool, outside of any request.
+    """
+    with queued_jobs_lock:
+        queued_jobs.discard((campaign_id, 'summary'))
+    with app.app_context():
+        try:
+            with Session(db.engine) as session:
+                if not claim_job(session, campaign_id, 'summary'):
+                    return
+                pinned, summary, turns = fetch_history(session, campaign_id)
+            # The session is released while the model generates the summary
+            config = campaign_prompt_config(campaign_id)
+            overflow, _ = split_overflow(turns, history_budget(config, pinned, summary))
+            status = 'done'
+            if overflow:
+                summary_text = summarize(summary, overflow)
+                logger.debug("Summary of campaign %s: %s", campaign_id, summary_text)
+                storeSummary(campaign_id, summary_text, [row.id for row in overflow])
+        except Exception as e:
+            logger.error("Error in summary job: %s", e)
+            status = 'failed'
+        try:
+            with Session(db.engine) as session:
+                finish_job(session, campaign_id, 'summary', status)
+        except Exception as e:
+            logger.error("Error finishing summary job: %s", e)
 
-    api_key = auth_header.replace('Bearer ', '').strip()
+@timed('generate_opening')
+def generate_opening(config):
+    """
+    Generates the opening message of a campaign with the given prompt config.
+    """
+    response, model = model_router.generate(
+        'opening', lambda model: genai_client().models.generate_content(model=model, contents=base_context, config=config)
+    )
+    count_model_tokens(model, context_tokens(base_context, config), estimate_tokens(response.text))
+    return response
 
-    try:
-        # Query the database to check if the API key exists
-        with Session(db.engine) as session:
-            result = session.execute(
-                text("""SELECT id FROM "ApiKey" WHERE key = :key"""),
-                {'key': api_key}
-            ).fetchone()
-            if not result:
-                return None, "Invalid API key."
-            return result[0], None
-    except Exception as e:
-        return None, f"Database error: {e}"
-    
-# --- DECORATORS ---
-def require_api_key(f):
+def run_opening_job(campaign_id):
     """
-    Decorator to enforce API key authentication for routes.
-    Attaches the API key ID to the request context if valid.
+    Generates the AI opening message of a new campaign and stores it as its first chat.
+    Runs on the worker pool, outside of any request.
     """
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        api_key_id, error = verify_api_key()
-        if error:
-            return jsonify({'error': error}), 401
-        request.api_key_id = api_key_id  # Attach API key ID to the request context
-        return f(*args, **kwargs)
-    return decorated
+    with queued_jobs_lock:
+        queued_jobs.discard((campaign_id, 'opening'))
+    with app.app_context():
+        status = 'failed'
+        try:
+            with Session(db.engine) as session:
+                if not claim_job(session, campaign_id, 'opening'):
+                    return
+                campaign = session.execute(
+                    text("""SELECT "promptHash", "createdAt" FROM "Campaign" WHERE id = :campaignid""").columns(
+                        column('promptHash'), column('createdAt', DateTime)
+                    ),
+                    {'campaignid': campaign_id}
+                ).first()
+            if campaign:
+                # Holding the turn makes a message sent meanwhile wait for the opening, and
+                # dating the opening like the campaign keeps it first in the history regardless
+                with campaign_turn(campaign_id) as turn:
+                    config = prompt_config(campaign.promptHash or DEFAULT_PROMPT_HASH)
+                    response = generate_opening(config)
+                    with Session(db.engine) as session:
+                        session.execute(
+                            text("""INSERT INTO "Chat" (message, response, "campaignId", "createdAt", "tokenCount")
+                                    VALUES (:message, :response, :campaignId, :createdAt, :tokenCount)"""),
+                            {
+                                'message': '',
+                                'response': response.text,
+                                'campaignId': campaign_id,
+                                'createdAt': campaign.createdAt,
+                                'tokenCount': estimate_tokens(response.text)
+                            }
+                        )
+                        # Released with the opening, in one commit
+                        if turn.token is not None:
+                            session.execute(TURN_LOCK_RELEASE, {'campaignid': campaign_id, 'token': turn.token})
+                        session.commit()
+                    turn.token = None
+                status = 'done'
+        except Exception as e:
+            logger.error("Error in opening job: %s", e)
+        try:
+            with Session(db.engine) as session:
+                finish_job(session, campaign_id, 'opening', status)
+        except Exception as e:
+            logger.error("Error finishing opening job: %s", e)
 
-def require_campaign(f):
+# Worker pool (looked up on each submit, a forked worker has its own) and function running each kind of job
+JOB_KINDS = {
+    'summary': (lambda: job_executor, run_summary_job),
+    'opening': (lambda: opening_executor, run_opening_job),
+}
+
+def resume_jobs():
     """
-    Decorator to enforce campaign ownership validation for routes.
-    Ensures the campaign belongs to the authenticated API key.
+    Resubmits the jobs left pending or abandoned by a previous run of the server.
     """
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        api_key_id = request.api_key_id
-        if not api_key_id:
-            return jsonify({'error': 'API key is required.'}), 401
-        campaign_id = kwargs.get('campaignid')
-        if not campaign_id:
-            return jsonify({'error': 'Campaign ID is required.'}), 400
+    with app.app_context():
         try:
-            # Query the database to check if the campaign exists and belongs to the API key
             with Session(db.engine) as session:
                 result = session.execute(
-                    text("""SELECT "apiKeyId" FROM "Campaign" WHERE id = :campaignid"""),
-                    {'campaignid': str(campaign_id)}
-                ).fetchone()
-                if not result:
-                    return jsonify({'error': 'Campaign not found.'}), 404
-                if result[0] != api_key_id:
-                    return jsonify({'error': 'You do not have access'}), 401
+                    text("""
+                        SELECT "campaignId", kind FROM "CampaignJob"
+                        WHERE status = 'pending' OR (status = 'running' AND "updatedAt" < :stale)
+                    """),
+                    {'stale': datetime.utcnow() - JOB_STALE_AFTER}
+                ).fetchall()
         except Exception as e:
-            return jsonify({'error': f"Database error: {e}"}), 500
+            logger.error("Error resuming jobs: %s", e)
+            return
+    for row in result:
+        if row[1] in JOB_KINDS:
+            submit_job(row[0], row[1])
 
-        return f(*args, **kwargs)
-    return decorated
+def purge_idempotency_keys():
+    """
+    Deletes the expired idempotency keys.
+    """
+    with app.app_context():
+        try:
+            with Session(db.engine) as session:
+                session.execute(text('DELETE FROM "IdempotencyKey" WHERE "expiresAt" < :now'), {'now': datetime.utcnow()})
+                session.commit()
+        except Exception as e:
+            logger.error("Error purging idempotency keys: %s", e)
 
-# --- DATABASE STORE FUNCTIONS ---
+# --- OPENING POOL ---
+# The opening of a campaign only depends on its prompt, so openings for the default prompt are generated
+# ahead of time and stored in "OpeningPool", shared by all workers. A campaign created with that prompt takes
+# one in its creation transaction and starts with its first message, without a model call.
+
+POOLED_PROMPTS = {DEFAULT_PROMPT_HASH}
 
-def storeChat(campaign_id, user_input, response):
+@lru_cache(maxsize=None)
+def opening_pool_take(dialect):
     """
-    Stores a chat message and its response in the database.
-    Ensures the campaign exists before inserting the chat.
+    Returns the query taking the oldest fresh opening of a prompt from the pool, for the database dialect.
     """
-    try:
-        with Session(db.engine) as session:
-            # Check if the campaign exists
-            result = session.execute(
-                text("""SELECT id FROM "Campaign" WHERE id = :campaign_id"""),
-                {'campaign_id': str(campaign_id)}
-            ).fetchone()
-            if not result:
-                return jsonify({'error': 'Campaign not found.'}), 404
-            # Insert the new chat into the "Chat" table
-            new_chat = {
-                'message': user_input,
-                'response': response,
-                'campaignId': campaign_id
-            }
-            session.execute(
-                text("""INSERT INTO "Chat" (message, response, "campaignId") 
-                        VALUES (:message, :response, :campaignId)"""),
-                new_chat
-            )
-            session.commit()
-            return jsonify({'success': 'Chat stored successfully.'}), 201
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    # On Postgres, concurrent creations take different rows instead of waiting on the same one
+    skip_locked = ' FOR UPDATE SKIP LOCKED' if dialect == 'postgresql' else ''
+    return text(f"""
+        DELETE FROM "OpeningPool" WHERE id = (
+            SELECT id FROM "OpeningPool"
+            WHERE "promptHash" = :hash AND model = :model AND "createdAt" > :fresh
+            ORDER BY "createdAt" LIMIT 1{skip_locked}
+        )
+        RETURNING response
+    """)
+
+refilling_pools = set()  # Prompt hashes with a refill submitted to this process
+refilling_pools_lock = threading.Lock()
 
-def storeSummary(campaign_id, summary):
+def opening_pool_params(campaign_prompt_hash):
     """
-    Stores a summary of chat messages in the database.
-    Deletes older messages to maintain a manageable chat history.
+    Returns the parameters selecting the unexpired openings of a prompt.
     """
-    try:
-        with Session(db.engine) as session:
-            # Fetch the timestamp of the second message in the campaign
-            second_message_timestamp_result = session.execute(
-                text("""
-                    SELECT "createdAt"
-                    FROM "Chat"
-                    WHERE "campaignId" = :campaign_id
-                    ORDER BY "createdAt" ASC
-                    OFFSET 1 
-                    LIMIT 1
-                """),
-                {'campaign_id': str(campaign_id)}
-            ).fetchone()
-            if not second_message_timestamp_result:
-                return jsonify({'error': 'No messages found for the campaign.'}), 404
-            second_message_timestamp = second_message_timestamp_result[0]
+    return {
+        'hash': campaign_prompt_hash,
+        'model': OPENING_MODEL,
+        'fresh': datetime.utcnow() - timedelta(seconds=OPENING_POOL_TTL)
+    }
 
-            # Delete older messages beyond a certain limit
-            session.execute(
-                text("""
-                    DELETE FROM "Chat"
-                    WHERE "campaignId" = :campaign_id
-                    AND id IN (
-                        SELECT id FROM "Chat"
-                        WHERE "campaignId" = :campaign_id
-                        ORDER BY "createdAt" ASC
-                        OFFSET 2
-                        LIMIT 5
+def pooled(campaign_prompt_hash):
+    """
+    Returns True if openings of the prompt are pre-generated.
+    """
+    return OPENING_POOL_DEPTH > 0 and campaign_prompt_hash in POOLED_PROMPTS
+
+def take_opening_steps(campaign_prompt_hash, dialect):
+    """
+    Steps removing an opening of the prompt from the pool, within the caller's transaction.
+    Returns its text, or None if the prompt is not pooled or the pool is empty.
+    """
+    if not pooled(campaign_prompt_hash):
+        return None
+    result = (yield opening_pool_take(dialect), opening_pool_params(campaign_prompt_hash)).first()
+    return result[0] if result else None
+
+# A reset history starts again with an opening: one from the pool, or a new opening job (the previous one is done)
+CAMPAIGN_PROMPT_HASH_QUERY = text("""SELECT "promptHash" FROM "Campaign" WHERE id = :campaignid""")
+OPENING_INSERT = text("""
+    INSERT INTO "Chat" (message, response, "campaignId", "tokenCount") VALUES ('', :response, :campaignid, :tokencount)
+""")
+OPENING_JOB_RESTART = text("""
+    INSERT INTO "CampaignJob" ("campaignId", kind, status, "updatedAt")
+    VALUES (:campaignid, 'opening', 'pending', :now)
+    ON CONFLICT ("campaignId", kind) DO UPDATE
+    SET status = 'pending', attempts = 0, "updatedAt" = :now
+    WHERE "CampaignJob".status NOT IN ('pending', 'running')
+""")
+
+def restore_opening_steps(campaign_id, dialect):
+    """
+    Steps giving a campaign whose history was emptied a new opening, within the caller's transaction: a pooled one,
+    or a pending opening job to submit once committed. Returns the prompt hash of the campaign and the pooled
+    opening (None when a job was recorded).
+    """
+    campaign_prompt_hash = (yield CAMPAIGN_PROMPT_HASH_QUERY, {'campaignid': str(campaign_id)}).scalar() or DEFAULT_PROMPT_HASH
+    opening = yield from take_opening_steps(campaign_prompt_hash, dialect)
+    if opening is not None:
+        yield OPENING_INSERT, {'response': opening, 'campaignid': str(campaign_id), 'tokencount': estimate_tokens(opening)}
+    else:
+        yield OPENING_JOB_RESTART, {'campaignid': str(campaign_id), 'now': datetime.utcnow()}
+    return campaign_prompt_hash, opening
+
+def schedule_pool_refill(campaign_prompt_hash):
+    """
+    Submits a refill of the prompt's pool to the opening workers, unless one is already submitted.
+    """
+    if not pooled(campaign_prompt_hash):
+        return
+    with refilling_pools_lock:
+        if campaign_prompt_hash in refilling_pools:
+            return
+        refilling_pools.add(campaign_prompt_hash)
+    opening_executor.submit(refill_opening_pool, campaign_prompt_hash)
+
+def refill_opening_pool(campaign_prompt_hash):
+    """
+    Discards the expired openings of the prompt and, once fewer than OPENING_POOL_LOW_WATER are left,
+    generates new ones up to OPENING_POOL_DEPTH. Runs on the worker pool, outside of any request.
+    """
+    with app.app_context():
+        try:
+            with Session(db.engine) as session:
+                params = opening_pool_params(campaign_prompt_hash)
+                session.execute(
+                    text("""DELETE FROM "OpeningPool" WHERE "promptHash" = :hash AND model = :model AND "createdAt" <= :fresh"""),
+                    params
+                )
+                session.commit()
+            low = True
+            while True:
+                with Session(db.engine) as session:
+                    count = session.execute(
+                        text("""SELECT COUNT(*) FROM "OpeningPool" WHERE "promptHash" = :hash AND model = :model AND "createdAt" > :fresh"""),
+                        opening_pool_params(campaign_prompt_hash)
+                    ).scalar()
+                # Counted again before each opening, since other workers may refill the same pool
+                if count >= OPENING_POOL_DEPTH or (low and count >= OPENING_POOL_LOW_WATER):
+                    break
+                low = False
+                # No connection is held while the model generates
+                config = prompt_config(campaign_prompt_hash)
+                response = generate_opening(config)
+                with Session(db.engine) as session:
+                    session.execute(
+                        text("""INSERT INTO "OpeningPool" ("promptHash", model, response, "createdAt")
+                                VALUES (:hash, :model, :response, :now)"""),
+                        {'hash': campaign_prompt_hash, 'model': OPENING_MODEL, 'response': response.text, 'now': datetime.utcnow()}
                     )
-                """),
-                {'campaign_id': str(campaign_id)}
-            )
+                    session.commit()
+        except Exception as e:
+            logger.error("Error refilling opening pool: %s", e)
+        finally:
+            with refilling_pools_lock:
+                refilling_pools.discard(campaign_prompt_hash)
 
-            # Insert the summary as a new chat message
-            session.execute(
-                text("""
-                    INSERT INTO "Chat" (message, response, "campaignId", "createdAt")
-                    VALUES (:message, :response, :campaignId, :createdAt)
-                """),
-                {
-                    'message': 'This is a summary of the previous messages, used to keep the chat history manageable :',
-                    'response': summary,
-                    'campaignId': str(campaign_id),
-                    'createdAt': second_message_timestamp + timedelta(seconds=1)  # Add a small offset
-                }
-            )
-            session.commit()
-            return jsonify({'success': 'Summary stored successfully.'}), 201
-    except Exception as e:
-        print(e)
-        return jsonify({'error': str(e)}), 500
+# --- APP FACTORY ---
+# Importing this module only defines the app: create_app() binds the database and runs once per process, and
+# nothing connects, calls the model or starts a thread until the first request. A server can then import and
+# create the app once and fork its workers (gunicorn --preload), each opening its own connections and model client
+# and starting its own background work.
+
+factory_lock = threading.Lock()
+background_started = False  # Whether this process started its background work
+background_lock = threading.Lock()
+
+def engine_options(url):
+    """
+    Returns the options of the database engine (connection pool) for the database URL.
+    """
+    options = {'pool_recycle': DB_POOL_RECYCLE, 'pool_pre_ping': DB_POOL_PRE_PING}
+    url = make_url(url)
+    # An in-memory SQLite database has a single connection, without a pool to size
+    if url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+    return options
+
+def create_app(config=None):
+    """
+    Configures the app for this process and returns it. Settings of config (API_KEY, DATABASE_URL,
+    DATABASE_REPLICA_URL, GENAI_BACKEND and DB_POOL_*) override the environment. Later calls return the app as configured by the first one.
+    """
+    global API_KEY, DATABASE_URL, DATABASE_REPLICA_URL, GENAI_BACKEND, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+    with factory_lock:
+        if 'sqlalchemy' in app.extensions:
+            return app
+        config = config or {}
+        API_KEY = config.get('API_KEY', API_KEY)
+        DATABASE_URL = config.get('DATABASE_URL', DATABASE_URL)
+        DATABASE_REPLICA_URL = config.get('DATABASE_REPLICA_URL', DATABASE_REPLICA_URL) or None
+        GENAI_BACKEND = config.get('GENAI_BACKEND', GENAI_BACKEND)
+        DB_POOL_SIZE = config.get('DB_POOL_SIZE', DB_POOL_SIZE)
+        DB_MAX_OVERFLOW = config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)
+        DB_POOL_RECYCLE = config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE)
+        DB_POOL_PRE_PING = config.get('DB_POOL_PRE_PING', DB_POOL_PRE_PING)
+        if not API_KEY:
+            raise ValueError("No API_KEY found for Flask application")  # Ensure API_KEY is set in the environment
+        if not DATABASE_URL:
+            raise ValueError("No DATABASE_URL found for Flask application")  # Ensure DATABASE_URL is set in the environment
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DATABASE_URL)
+        if DATABASE_REPLICA_URL is not None:
+            app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': DATABASE_REPLICA_URL, **engine_options(DATABASE_REPLICA_URL)}}
+        # The engines are created here, their connections on first use
+        db.init_app(app)
+        with app.app_context():
+            # Query timings and per-request query counts for GET /metrics
+            for engine in db.engines.values():
+                instrument_engine(engine)
+        os.register_at_fork(after_in_child=after_fork)
+    return app
+
+def after_fork():
+    """
+    Resets what a forked worker must not share with its parent: the pooled database connections (left open for
+    the parent), the model client and the background work, started again by its first request. The threads of
+    the parent do not exist in the child, so its worker pools and chat writers are replaced (work submitted to
+    them would never run), and the work it had in progress is forgotten, with the locks guarding it.
+    """
+    global client, background_started, background_lock
+    global job_executor, opening_executor, batch_executor, chat_writer, batch_writer
+    global queued_jobs, queued_jobs_lock, refilling_pools, refilling_pools_lock, turn_locks, turn_locks_lock
+    global building_indexes, archive_indexes_lock, generations, generations_lock, idempotency_events
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+            instrument_pool(engine)
+    client = None
+    background_started, background_lock = False, threading.Lock()
+    job_executor = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='summary')
+    opening_executor = ThreadPoolExecutor(max_workers=OPENING_WORKERS, thread_name_prefix='opening')
+    batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+    model_router.after_fork()
+    chat_writer, batch_writer = chat_writers()
+    queued_jobs, queued_jobs_lock = set(), threading.Lock()
+    refilling_pools, refilling_pools_lock = set(), threading.Lock()
+    turn_locks, turn_locks_lock = {}, threading.Lock()
+    building_indexes, archive_indexes_lock = set(), threading.Lock()
+    generations, generations_lock = {}, threading.Lock()
+    idempotency_events = {}
+
+def start_background_work():
+    """
+    Starts the background work of this process once: resuming the jobs left by a previous run, purging the
+    expired idempotency keys and refilling the opening pools.
+    """
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    job_executor.submit(resume_jobs)
+    job_executor.submit(purge_idempotency_keys)
+    for pooled_prompt_hash in POOLED_PROMPTS:
+        schedule_pool_refill(pooled_prompt_hash)
+
+@app.before_request
+def start_background():
+    if not background_started:
+        start_background_work()
+
+# --- METRICS ---
+# Every request is timed and its database queries counted, see metrics.py. Streamed responses are measured
+# until they are closed, so the duration of a chat stream includes its generation.
+
+@app.before_request
+def start_request_metrics():
+    request.stats = start_request()
+
+@app.after_request
+def finish_request_metrics(response):
+    stats, method, endpoint = request.stats, request.method, request.endpoint
+    response.call_on_close(lambda: finish_request(stats, method, endpoint, response.status_code))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Invalid metrics token.'}), 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 # --- ROUTES ---
 
@@ -211,14 +2630,26 @@ def storeSummary(campaign_id, summary):
 @require_api_key
 def get_campaigns():
     """
-    Retrieves all campaigns associated with the authenticated API key.
+    Retrieves all campaigns associated with the authenticated API key, or a page of them with a limit.
     Optionally filters by user ID if provided.
     """
     api_key_id = request.api_key_id
     userId = request.args.get('userId', None)
+    paginated = any(arg in request.args for arg in ('limit', 'after'))
+    if paginated:
+        try:
+            query, params, limit = campaigns_page_params(api_key_id, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    responses, cached = cached_campaign_response(api_key_id, request.query_string)
+    if cached is not None:
+        return jsonify(cached[0]), cached[1]
     try:
-        with Session(db.engine) as session:
-            if userId:
+        with Session(read_engine(api_key_id)) as session:
+            if paginated:
+                page = campaigns_page(session.execute(query, params).fetchall(), limit)
+            elif userId:
                 # Fetch campaigns for the specific user
                 result = session.execute(
                     text("""SELECT id, name FROM "Campaign" WHERE "apiKeyId" = :id AND "userId" = :userId"""),
@@ -230,115 +2661,222 @@ def get_campaigns():
                     text("""SELECT id, name FROM "Campaign" WHERE "apiKeyId" = :id"""),
                     {'id': api_key_id}
                 ).fetchall()
-            # Convert the query result into a list of dictionaries for JSON response
-            campaigns = [{'id': str(row[0]), 'name': row[1]} for row in result]
+            if not paginated:
+                # Convert the query result into a list of dictionaries for JSON response
+                campaigns = [{'id': str(row[0]), 'name': row[1]} for row in result]
     except Exception as e:
-        print(f"Error fetching campaigns: {e}")
+        logger.error("Error fetching campaigns: %s", e)
         return jsonify({'error': f"Database error: {e}"}), 500
 
-    if len(campaigns) == 0: 
+    if paginated:
+        response = page, 200
+    elif len(campaigns) == 0:
         # Return a 204 status if no campaigns are found
-        return jsonify({'message': 'You have no campaigns yet.'}), 204
-    return jsonify(campaigns)
+        response = {'message': 'You have no campaigns yet.'}, 204
+    else:
+        response = campaigns, 200
+    cache_campaign_response(api_key_id, responses, request.query_string, response)
+    return jsonify(response[0]), response[1]
+
+def campaign_created(campaign_id, complete):
+    """
+    Returns the body, status code and headers of a campaign creation: 201 if the campaign already has its
+    opening message, 202 with the status URL in the Location header if it is still being generated.
+    """
+    status_url = f"/campaigns/{campaign_id}/status"
+    body = {
+        'status': 'success',
+        'message': 'Campaign created successfully.' if complete else 'Campaign created successfully, its opening message is being generated.',
+        'id': campaign_id,
+        'statusUrl': status_url
+    }
+    return body, 201 if complete else 202, {'Location': f"/campaigns/{campaign_id}" if complete else status_url}
+
+def chats_reset(campaign_id, complete):
+    """
+    Returns the body, status code and headers of a full chat reset: 200 if the campaign already has its new
+    opening message, 202 with the status URL in the Location header while it is being generated.
+    """
+    status_url = f"/campaigns/{campaign_id}/status"
+    body = {
+        'status': 'success',
+        'message': 'Chats deleted and history reset successfully.' if complete else 'Chats deleted and history reset successfully, the opening message is being generated.',
+        'statusUrl': status_url
+    }
+    return body, 200 if complete else 202, {} if complete else {'Location': status_url}
+
+def campaign_fields(data):
+    """
+    Returns the name, book, prompt and user ID of a campaign creation request, raises ValueError if one is missing.
+    """
+    name = data.get('name', '')
+    book = data.get('book', '')
+    prompt = data.get('prompt', default_prompt)  # Use default prompt if none is provided
+    userId = data.get('userId', None)
+    if not name or not book or not prompt:
+        raise ValueError('Missing required fields.')
+    return name, book, prompt, userId
+
+def create_campaign_steps(api_key_id, fields, dialect):
+    """
+    Steps storing a new campaign with its prompt and its opening: a pooled one, or a pending opening job
+    submitted once committed. Returns the body, status code and headers of the response, see campaign_created.
+    """
+    name, book, prompt, userId = fields
+    campaign_prompt_hash = prompt_hash(prompt)
+    # Store the prompt once, campaigns sharing a prompt reference the same row
+    yield (
+        text("""INSERT INTO "Prompt" (hash, content) VALUES (:hash, :content)
+                ON CONFLICT (hash) DO NOTHING"""),
+        {'hash': campaign_prompt_hash, 'content': prompt}
+    )
+    # Prepare the new campaign data
+    new_campaign = {
+        'id': str(uuid.uuid4()),  # Generate a unique ID for the campaign
+        'name': name,
+        'book': book,
+        'promptHash': campaign_prompt_hash,
+        'userId': userId,
+        'apiKeyId': api_key_id
+    }
+    # Insert the new campaign into the database
+    yield (
+        text("""INSERT INTO "Campaign" (id, name, book, "promptHash", "userId", "apiKeyId") 
+                VALUES (:id, :name, :book, :promptHash, :userId, :apiKeyId)"""),
+        new_campaign
+    )
+    opening = yield from take_opening_steps(campaign_prompt_hash, dialect)
+    if opening is not None:
+        # A pre-generated opening, the campaign is complete right away
+        yield (
+            text("""INSERT INTO "Chat" (message, response, "campaignId", "tokenCount")
+                    VALUES (:message, :response, :campaignId, :tokenCount)"""),
+            {'message': '', 'response': opening, 'campaignId': new_campaign['id'], 'tokenCount': estimate_tokens(opening)}
+        )
+    else:
+        # Recorded with the campaign, so the opening is generated even if this process stops
+        yield (
+            text("""INSERT INTO "CampaignJob" ("campaignId", kind, status, "updatedAt")
+                    VALUES (:campaignid, 'opening', 'pending', :now)"""),
+            {'campaignid': new_campaign['id'], 'now': datetime.utcnow()}
+        )
+    yield COMMIT
+    cache_campaign(new_campaign['id'], api_key_id, campaign_prompt_hash)
+    campaigns_changed(api_key_id)
+    if not cached_prompt_config(campaign_prompt_hash):
+        cache_prompt_config(campaign_prompt_hash, prompt)
+    if opening is None:
+        submit_job(new_campaign['id'], 'opening')
+    schedule_pool_refill(campaign_prompt_hash)
+    return campaign_created(new_campaign['id'], opening is not None)
+
+def delete_campaign_steps(campaign_id, api_key_id):
+    """
+    Steps deleting a campaign and its associated data, then forgetting what this process cached about it
+    (except its context prefix, see each app).
+    """
+    yield text("""DELETE FROM "Campaign" WHERE id = :campaignid"""), {'campaignid': str(campaign_id)}
+    yield COMMIT
+    evict_campaign(campaign_id)
+    campaigns_changed(api_key_id)
+    drop_archive_index(campaign_id)
+
+CHATS_DELETE_LATEST = text("""
+    DELETE FROM "Chat"
+    WHERE id IN (
+        SELECT id FROM "Chat"
+        WHERE "campaignId" = :campaignid
+        ORDER BY "createdAt" DESC
+        LIMIT :number
+    )
+""")
+
+def delete_chats_steps(campaign_id, number, dialect):
+    """
+    Steps deleting the `number` latest chats of a campaign, or resetting its history when number is None.
+    Returns the body, status code and headers of the response.
+    """
+    if number:
+        yield CHATS_DELETE_LATEST, {'campaignid': str(campaign_id), 'number': number}
+        yield COMMIT
+        return {'status': 'success', 'message': 'Chats deleted and history reset successfully.'}, 200, {}
+    # A reset empties the history and its archive, and starts again with a new opening
+    yield text("""DELETE FROM "Chat" WHERE "campaignId" = :campaignid"""), {'campaignid': str(campaign_id)}
+    yield text("""DELETE FROM "ChatArchive" WHERE "campaignId" = :campaignid"""), {'campaignid': str(campaign_id)}
+    campaign_prompt_hash, opening = yield from restore_opening_steps(campaign_id, dialect)
+    yield COMMIT
+    drop_archive_index(campaign_id)
+    if opening is None:
+        submit_job(campaign_id, 'opening')
+    schedule_pool_refill(campaign_prompt_hash)
+    return chats_reset(campaign_id, opening is not None)
 
 @app.route('/campaigns', methods=['POST'])
 @require_api_key
+@idempotent
 def create_campaign():
     """
     Creates a new campaign for the authenticated API key.
-    Initializes the campaign with a default prompt and stores it in the database.
+    The campaign references its prompt (the default one if none is provided). Its AI opening message is
+    generated in the background: the response is 202, with the campaign status URL in the Location header.
     """
-    
-    api_key_id = request.api_key_id
-    name = request.json.get('name', '')
-    book = request.json.get('book', '')
-    prompt = request.json.get('prompt', default_prompt)  # Use default prompt if none is provided
-    userId = request.json.get('userId', None)
-
-    if not name or not book or not prompt:
+    try:
+        fields = campaign_fields(request.json)
+    except ValueError as e:
         # Ensure all required fields are provided
-        return jsonify({'error': 'Missing required fields.'}), 400
+        return jsonify({'error': str(e)}), 400
 
     try:
         with Session(db.engine) as session:
-            # Prepare the new campaign data
-            new_campaign = {
-                'id': str(uuid.uuid4()),  # Generate a unique ID for the campaign
-                'name': name,
-                'book': book,
-                'prompt': prompt,
-                'userId': userId,
-                'apiKeyId': api_key_id
-            }
-            # Insert the new campaign into the database
-            session.execute(
-                text("""INSERT INTO "Campaign" (id, name, book, prompt, "userId", "apiKeyId") 
-                        VALUES (:id, :name, :book, :prompt, :userId, :apiKeyId)"""),
-                new_campaign
-            )
-            # Add the default prompt as the first chat message
-            session.execute(
-                text("""INSERT INTO "Chat" (message, response, "campaignId") 
-                        VALUES (:message, :response, :campaignId)"""),
-                {
-                    'message': default_prompt,
-                    'response': 'Understood',
-                    'campaignId': new_campaign['id']
-                }
-            )
-            session.commit()
+            body, status, headers = run_steps(session, create_campaign_steps(request.api_key_id, fields, db.engine.dialect.name))
+    except Exception as e:
+        logger.error("Error creating campaign: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+    return jsonify(body), status, headers
 
-            # Generate an initial AI response for the campaign
-            response = client.models.generate_content(
-                model='gemini-2.0-flash', contents=base_context
-            )
-            # Store the AI response in the chat history
-            session.execute(
-                text("""INSERT INTO "Chat" (message, response, "campaignId") 
-                        VALUES (:message, :response, :campaignId)"""),
-                {
-                    'message': '',
-                    'response': response.text,
-                    'campaignId': new_campaign['id']
-                }
-            )
-            session.commit()
+@app.route('/campaigns/<uuid:campaignid>/status', methods=['GET'])
+@require_api_key
+@require_campaign
+def get_campaign_status(campaignid):
+    """
+    Returns the progress of the campaign opening message: 'pending', 'running', 'done' or 'failed'.
+    """
+    try:
+        with Session(db.engine) as session:
+            result = session.execute(
+                text("""SELECT status FROM "CampaignJob" WHERE "campaignId" = :campaignid AND kind = 'opening'"""),
+                {'campaignid': str(campaignid)}
+            ).first()
     except Exception as e:
-        print(f"Error creating campaign: {e}")
         return jsonify({'error': f"Database error: {e}"}), 500
-    
-    return jsonify({'status': 'success', 'message': 'Campaign created successfully.'}), 201
+
+    # Campaigns created before openings were generated in the background have no job
+    return jsonify({'id': str(campaignid), 'opening': result[0] if result else 'done'})
 
 @app.route('/campaigns/<uuid:campaignid>', methods=['GET'])
 @require_api_key
+@require_campaign
 def get_campaign_info(campaignid):
     """
     Retrieves detailed information about a specific campaign.
     Ensures the campaign belongs to the authenticated API key.
     """
     api_key_id = request.api_key_id
+    responses, cached = cached_campaign_response(api_key_id, str(campaignid))
+    if cached is not None:
+        return jsonify(cached[0]), cached[1]
     try: 
-        with Session(db.engine) as session:
+        with Session(read_engine(api_key_id)) as session:
             # Query the campaign details from the database
-            result = session.execute(
-                text("""SELECT "apiKeyId", book, prompt, name, "createdAt" FROM "Campaign" WHERE id = :campaignid"""),
-                {'campaignid': str(campaignid)}
-            ).fetchone()
-            if not result:
-                # Return 404 if the campaign is not found
-                return jsonify({'error': 'Campaign not found.'}), 404
-            if result[0] != api_key_id:
-                # Return 401 if the campaign does not belong to the API key
-                return jsonify({'error': 'You do not have access'}), 401
-            # Return the campaign details as JSON
-            return jsonify({
-                'book': result[1],
-                'prompt': result[2],
-                'name': result[3],
-                'created_at': result[4]
-            })
+            result = session.execute(CAMPAIGN_INFO_QUERY, {'campaignid': str(campaignid)}).fetchone()
     except Exception as e:
         return jsonify({'error': f"Database error: {e}"}), 500
+    if not result:
+        # Deleted since the ownership check, or not replicated yet
+        return jsonify({'error': 'Campaign not found.'}), 404
+    response = campaign_info(result), 200
+    cache_campaign_response(api_key_id, responses, str(campaignid), response)
+    return jsonify(response[0]), response[1]
     
 @app.route('/campaigns/<uuid:campaignid>', methods=['PUT'])
 @require_api_key
@@ -358,6 +2896,7 @@ def edit_campaign_info(campaignid):
                     {'name': name, 'campaignid': str(campaignid)}
                 )
                 session.commit()
+                campaigns_changed(request.api_key_id)
     except Exception as e:
         return jsonify({'error': f"Database error: {e}"}), 500
     return jsonify({'status': 'success', 'message': 'Campaign updated successfully.'}), 200
@@ -371,13 +2910,12 @@ def delete_campaign(campaignid):
     Ensures the campaign belongs to the authenticated API key.
     """
     try: 
-        with Session(db.engine) as session:
-            # Delete the campaign from the database
-            session.execute(
-                text("""DELETE FROM "Campaign" WHERE id = :campaignid"""),
-                {'campaignid': str(campaignid)}
-            )
-            session.commit()
+        # Waits for a turn in progress, which would otherwise store its chat into a deleted campaign
+        with campaign_turn(campaignid), Session(db.engine) as session:
+            run_steps(session, delete_campaign_steps(campaignid, request.api_key_id))
+        context_cache.invalidate(str(campaignid))
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
     except Exception as e:
         return jsonify({'error': f"Database error: {e}"}), 500
     
@@ -386,82 +2924,191 @@ def delete_campaign(campaignid):
 @app.route('/campaigns/<uuid:campaignid>/chats', methods=['POST'])
 @require_api_key
 @require_campaign
+@idempotent
 def campaign_chat(campaignid):
     """
     Handles user input for a campaign and generates an AI response.
     Stores the chat history and manages chat summarization if needed.
     """
     user_input = request.json.get('input', '')
-    print(f"User input: {user_input}")
+    logger.debug("Chat input for campaign %s: %s", campaignid, user_input)
 
     try:
-        with Session(db.engine) as session:
-            # Fetch the chat history for the campaign
-            history_result = session.execute(
-                text("""SELECT message, response FROM "Chat" WHERE "campaignId" = :campaignid ORDER BY "createdAt" DESC"""),
-                {'campaignid': str(campaignid)}
-            ).fetchall()
-
-            if history_result and len(history_result) > 8:
-                # Summarize older chat messages if the history exceeds 8 messages
-                summary = client.models.generate_content(
-                    model='gemini-2.0-flash', contents=[types.Content(role='user', parts=[types.Part(text=f"""
-                    AI, please provide a detailed yet not too long summary of the messages provided below.
-                    include all the important information in the summary.
-                    provide the summary only, no introduction.
-                    Do not include any other text than the summary itself and take part of the game master that talks. 
-                    Write the text as if the user asked you a summary.
-                    Describe the actions fully, both what the user choose to do and what happened aftewards. The messages are: {str(history_result[-6:-2])}. The summary is:
-                    """)])])
-                
-                print(f"input : {history_result[-2:-6]}")  # Debugging: Print the input for summarization
-                print(f"Summary: {summary.text}")  # Debugging: Print the generated summary
-                storeSummary(campaignid, summary.text)
-            if not history_result:
-                # Use the base context if no chat history exists
-                history = base_context
-            else:
-                # Convert the chat history into the required format for the AI model
-                history = [
-                    types.Content(role='user', parts=[types.Part(text=row[0])]) if i % 2 == 0 else
-                    types.Content(role='model', parts=[types.Part(text=row[1])])
-                    for i, row in enumerate(reversed(history_result))
-                ]
+        # Wait for the previous turn of the campaign, so this one sees its result
+        with campaign_turn(campaignid, keep_connection=True) as turn:
+            contents, config, overflow, prefix = build_turn_context(campaignid, user_input, turn.connection)
             # Generate an AI response based on the chat history and user input
-            response = client.models.generate_content(
-                model='gemini-2.0-flash', contents=history + ([types.Content(role='user', parts=[types.Part(text=user_input)])] if history_result else None)
-            )
+            with timed('generate'):
+                response, model = model_router.generate(
+                    'chat', lambda model: context_cache.generate_content(model, contents, config, prefix, str(campaignid))
+                )
             # Store the user input and AI response in the database
-            storeChat(campaignid, user_input, response.text)
-            return jsonify({'response': response.text})
+            stored = storeChat(campaignid, user_input, response.text, turn)
+        if stored is None:
+            return jsonify({'error': 'Campaign not found.'}), 404
+        record_generation(request.api_key_id, request.rate_limits, model, contents, config, response.text)
+        result = jsonify({'response': response.text, 'id': stored['id'], 'createdAt': stored['createdAt']})
+        if overflow:
+            # Summarize in the background once the response has been sent
+            result.call_on_close(lambda: enqueue_summary(campaignid))
+        return result
+
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except ModelUnavailable as e:
+        logger.error("Error in campaign_chat: %s", e)
+        return model_unavailable(e)
+    except Exception as e:
+        logger.error("Error in campaign_chat: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+@app.route('/campaigns/<uuid:campaignid>/chats/stream', methods=['POST'])
+@require_api_key
+@require_campaign
+def campaign_chat_stream(campaignid):
+    """
+    Streaming variant of campaign_chat, sending the AI response as server-sent events.
+    Each chunk is sent as soon as the model produces it, the completed turn is then stored.
+    """
+    user_input = request.json.get('input', '')
+    logger.debug("Chat input for campaign %s: %s", campaignid, user_input)
+
+    try:
+        # The turn is held until the response is closed, see below
+        turn = acquire_turn(campaignid, keep_connection=True)
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except Exception as e:
+        logger.error("Error in campaign_chat_stream: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+    try:
+        contents, config, overflow, prefix = build_turn_context(campaignid, user_input, turn.connection)
+    except Exception as e:
+        release_turn(turn)
+        logger.error("Error in campaign_chat_stream: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    api_key_id, limits = request.api_key_id, request.rate_limits
+
+    def generate():
+        chunks = []
+        try:
+            with timed('generate'):
+                stream, model = model_router.stream(
+                    'chat', lambda model: context_cache.generate_content_stream(model, contents, config, prefix, str(campaignid))
+                )
+                for chunk in stream:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield sse_event('token', {'text': chunk.text})
+            # Store the completed turn before telling the client it is done
+            response = ''.join(chunks)
+            record_generation(api_key_id, limits, model, contents, config, response)
+            stored = storeChat(campaignid, user_input, response, turn)
+            if stored is None:
+                yield sse_event('error', {'error': 'Failed to store the chat.'})
+                return
+            yield sse_event('done', {'response': response, 'id': stored['id'], 'createdAt': stored['createdAt']})
+        except Exception as e:
+            logger.error("Error in campaign_chat_stream: %s", e)
+            yield sse_event('error', {'error': f"Generation error: {e}"})
 
+    result = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # Disable proxy buffering
+    )
+    # Closing happens even if the client disconnects before the stream is consumed
+    result.call_on_close(lambda: release_turn(turn))
+    if overflow:
+        # Summarize in the background once the stream is over
+        result.call_on_close(lambda: enqueue_summary(campaignid))
+    return result
+
+@app.route('/campaigns/chats', methods=['POST'])
+@require_api_key
+def campaign_chats():
+    """
+    Handles the messages of many campaigns in one request, see BATCH CHATS.
+    The result of each item is streamed as an NDJSON line as soon as it is known, in order of completion.
+    """
+    try:
+        items = batch_items(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        refused, pending = batch_settle(items, request.api_key_id)
     except Exception as e:
-        print(f"Error in campaign_chat: {e}")
+        logger.error("Error in campaign_chats: %s", e)
         return jsonify({'error': f"Database error: {e}"}), 500
 
+    api_key_id, limits = request.api_key_id, request.rate_limits
+
+    def generate():
+        yield from refused
+        yield from run_batch(api_key_id, limits, pending)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/campaigns/<uuid:campaignid>/chats', methods=['GET'])
 @require_api_key
 @require_campaign
 def get_chats(campaignid):
-    number = request.args.get('number', None)
+    export = request.args.get('format') == 'ndjson'
+    paginated = any(arg in request.args for arg in ('limit', 'before', 'after'))
+    try:
+        number = chats_number(request.args)
+        if paginated and not export:
+            query, params, limit = chats_page_params(campaignid, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    engine = read_engine(request.api_key_id)
     try: 
-        with Session(db.engine) as session:
-            if number:
-                result = session.execute(
+        with Session(engine) as session:
+            # Unchanged history since the client's last poll, nothing to read or serialize
+            etag = chats_etag(campaignid, session.execute(CHAT_VERSION_QUERY, {'campaignid': str(campaignid)}).one(), request.query_string)
+            if request.if_none_match.contains(etag):
+                result = Response(status=304)
+                result.set_etag(etag)
+                return result
+            if export:
+                pass  # Streamed below, with its own session
+            elif paginated:
+                page = chats_page(session.execute(query, params).fetchall(), limit, request.args)
+            elif number:
+                rows = session.execute(
                     text("""SELECT message, response, "createdAt" FROM "Chat" WHERE "campaignId" = :campaignid ORDER BY "createdAt" ASC LIMIT :number"""),
                     {'campaignid': str(campaignid), 'number': number}
                 ).fetchall()
             else:
-                result = session.execute(
+                rows = session.execute(
                     text("""SELECT message, response, "createdAt" FROM "Chat" WHERE "campaignId" = :campaignid ORDER BY "createdAt" ASC"""),
                     {'campaignid': str(campaignid)}
                 ).fetchall()
-            chats = [{'message': row[0], 'response': row[1], 'createdAt': row[2]} for row in result]
     except Exception as e:
         return jsonify({'error': f"Database error: {e}"}), 500
 
-    if len(chats) == 0: return jsonify({'message': 'No chats found for this campaign.'}), 204
-    return jsonify(chats)
+    if export:
+        def generate():
+            # Rows are fetched and sent in batches, the full history is never held in memory
+            with Session(engine) as session:
+                rows = session.execute(
+                    CHATS_EXPORT_QUERY.execution_options(yield_per=CHATS_EXPORT_BATCH),
+                    {'campaignid': str(campaignid)}
+                )
+                for row in rows:
+                    yield chat_line(row)
+
+        result = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    elif paginated:
+        result = jsonify(page)
+    else:
+        chats = [{'message': row[0], 'response': row[1], 'createdAt': row[2]} for row in rows]
+        if len(chats) == 0: return jsonify({'message': 'No chats found for this campaign.'}), 204
+        result = jsonify(chats)
+    result.set_etag(etag)
+    return result
 
 @app.route('/campaigns/<uuid:campaignid>/chats', methods=['DELETE'])
 @require_api_key
@@ -469,40 +3116,17 @@ def get_chats(campaignid):
 def delete_chats(campaignid):
     number = request.args.get('count', None, type=int)
     try:
-        with Session(db.engine) as session:
-            if number:
-                session.execute(
-                    text("""
-                        DELETE FROM "Chat"
-                        WHERE id IN (
-                            SELECT id FROM "Chat"
-                            WHERE "campaignId" = :campaignid
-                            ORDER BY "createdAt" DESC
-                            LIMIT :number
-                        )
-                    """),
-                    {'campaignid': str(campaignid), 'number': number}
-                )
-            else:
-                session.execute(
-                    text("""DELETE FROM "Chat" WHERE "campaignId" = :campaignid"""),
-                    {'campaignid': str(campaignid)}
-                )
-                session.execute(
-                    text("""INSERT INTO "Chat" (message, response, "campaignId") 
-                            VALUES (:message, :response, :campaignId)"""),
-                    {
-                        'message': default_prompt,
-                        'response': 'Understood',
-                        'campaignId': str(campaignid)
-                    }
-                )
-
-            session.commit()
+        # Waits for a turn in progress, so its chat is not stored into the history being deleted
+        with campaign_turn(campaignid), Session(db.engine) as session:
+            body, status, headers = run_steps(session, delete_chats_steps(campaignid, number, db.engine.dialect.name))
+        # The opening or summary of the cached prefix may be gone
+        context_cache.invalidate(str(campaignid))
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
     except Exception as e:
         return jsonify({'error': f"Database error: {e}"}), 500
-    return jsonify({'status': 'success', 'message': 'Chats deleted and history reset successfully.'}), 200
+    return jsonify(body), status, headers
     
 # --- START ---
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
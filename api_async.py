@@ -0,0 +1,1003 @@
+# Asynchronous (ASGI) serving mode of the roleplaychat backend.
+# It exposes the same routes and responses as api.py, but runs on Quart with the async GenAI client
+# and an async SQLAlchemy engine, so a request waiting on Gemini or on the database does not pin a thread.
+# Run it with an ASGI server, for example: hypercorn api_async:app
+# Caches, history assembly, background summary jobs and the database logic of the routes (see QUERY STEPS in
+# api.py) are shared with api.py.
+from quart import Quart, Response, request, jsonify
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from functools import wraps
+from contextlib import asynccontextmanager
+from concurrent.futures import Future
+import asyncio
+import time
+import json
+import math
+import os
+
+import api
+from metrics import finish_request, instrument_engine, instrument_pool, render as render_metrics, start_request, timed
+from api import (
+    CAMPAIGN_INFO_QUERY,
+    CHAT_VERSION_QUERY,
+    CHATS_EXPORT_QUERY,
+    COMMIT,
+    GENERATION_ENDPOINTS,
+    METRICS_TOKEN,
+    RATE_LIMIT_BACKEND,
+    TURN_LOCK_BACKEND,
+    TURN_LOCK_TIMEOUT,
+    BatchRun,
+    ModelUnavailable,
+    Pause,
+    RateLimited,
+    Turn,
+    TurnBusy,
+    admit_request,
+    assemble_context,
+    batch_item_failed,
+    batch_item_stored,
+    batch_items,
+    batch_lease_steps,
+    batch_settle_steps,
+    batch_start_steps,
+    cache_campaign_response,
+    cached_campaign_response,
+    campaign_fields,
+    campaign_info,
+    campaign_owner_steps,
+    campaign_prompt_config_steps,
+    campaigns_changed,
+    campaigns_page,
+    campaigns_page_params,
+    chat_line,
+    chats_etag,
+    chats_number,
+    chats_page,
+    chats_page_params,
+    context_cache,
+    create_campaign_steps,
+    delete_campaign_steps,
+    delete_chats_steps,
+    enqueue_summary,
+    finish_idempotency_steps,
+    idempotency_record,
+    idempotency_steps,
+    logger,
+    model_error,
+    model_router,
+    reads_from_replica,
+    record_generation,
+    release_generation,
+    request_fingerprint,
+    sse_event,
+    stick_to_primary,
+    store_chat_steps,
+    turn_context_steps,
+    turn_lease_steps,
+    turn_poll_delays,
+    turn_release_steps,
+    verify_api_key_steps,
+    with_snippets,
+)
+
+app = Quart(__name__)
+
+# Async drivers used when ASYNC_DATABASE_URL is not set, derived from DATABASE_URL
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+def async_database_url(url):
+    """
+    Converts a synchronous database URL into the same URL with an async driver.
+    """
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+# The sync engine of api.py runs the background jobs shared with it
+api.create_app()
+
+# ENV CONFIG
+ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL') or async_database_url(api.DATABASE_URL)
+# Connections kept open by the async engine, and how many more it may open under load
+ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', 10))
+ASYNC_MAX_OVERFLOW = int(os.environ.get('ASYNC_MAX_OVERFLOW', 20))
+# Replica of the read-only routes, derived from DATABASE_REPLICA_URL (see api.py)
+ASYNC_DATABASE_REPLICA_URL = api.DATABASE_REPLICA_URL and (
+    os.environ.get('ASYNC_DATABASE_REPLICA_URL') or async_database_url(api.DATABASE_REPLICA_URL)
+)
+
+engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=ASYNC_POOL_SIZE, max_overflow=ASYNC_MAX_OVERFLOW)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+replica_engine = ASYNC_DATABASE_REPLICA_URL and create_async_engine(
+    ASYNC_DATABASE_REPLICA_URL, pool_size=ASYNC_POOL_SIZE, max_overflow=ASYNC_MAX_OVERFLOW
+)
+ReplicaSession = async_sessionmaker(replica_engine, expire_on_commit=False) if replica_engine else Session
+engines = [engine, replica_engine] if replica_engine else [engine]
+# Query timings and per-request query counts for GET /metrics
+for async_engine in engines:
+    instrument_engine(async_engine.sync_engine)
+
+def read_sessionmaker(api_key_id):
+    """
+    Returns the session factory of the read-only routes of the API key: the replica, unless the key just wrote.
+    """
+    return ReplicaSession if reads_from_replica(api_key_id) else Session
+
+def after_fork():
+    """
+    Leaves the pooled connections of the async engines to the parent of a forked worker, and forgets the turns and
+    idempotent requests it had in progress, whose locks and events belong to its event loop.
+    The worker pools, chat writers and model router are reset by api.after_fork.
+    """
+    global turn_locks, idempotency_events
+    for async_engine in engines:
+        async_engine.sync_engine.dispose(close=False)
+        instrument_pool(async_engine.sync_engine)
+    turn_locks = {}
+    idempotency_events = {}
+
+os.register_at_fork(after_in_child=after_fork)
+
+@app.before_serving
+async def start_background_work():
+    api.start_background_work()
+
+# --- QUERY STEPS ---
+# The database logic shared with api.py runs here as the same steps generators, see QUERY STEPS in api.py.
+
+async def run_steps(connection, steps):
+    """
+    Runs a steps generator of api.py with an async connection or session, and returns what it returns.
+    """
+    result, error = None, None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            if step is COMMIT:
+                await connection.commit()
+            elif isinstance(step, Future):
+                result = await asyncio.wrap_future(step)
+            elif isinstance(step, Pause):
+                if step.event is not None:
+                    try:
+                        await asyncio.wait_for(step.event.wait(), step.seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(step.seconds)
+            else:
+                result = await connection.execute(*step)
+        except Exception as e:
+            error = e
+
+async def in_session(steps):
+    """
+    Runs a steps generator of api.py in a new session.
+    """
+    async with Session() as session:
+        return await run_steps(session, steps)
+
+# --- API KEY AUTH (NOW FROM HEADER) ---
+async def verify_api_key(campaign_id=None):
+    """
+    Verifies the API key provided in the Authorization header, see api.verify_api_key_steps.
+    """
+    return await in_session(verify_api_key_steps(request.headers.get('Authorization'), campaign_id))
+
+async def get_campaign_owner(campaign_id, cached=True):
+    """
+    Returns the API key ID owning the campaign, see api.campaign_owner_steps.
+    """
+    return await in_session(campaign_owner_steps(campaign_id, cached))
+
+async def campaign_prompt_config(campaign_id):
+    """
+    Returns the generation config holding the prompt of the campaign, see api.campaign_prompt_config_steps.
+    """
+    return await in_session(campaign_prompt_config_steps(campaign_id))
+
+# --- RATE LIMITS ---
+# Same limits as api.py. The in-memory buckets are used directly, the database ones from a thread.
+
+async def admit(api_key_id, limits, generation):
+    """
+    Checks the rate limits of the API key for the current request, see admit_request.
+    """
+    if RATE_LIMIT_BACKEND == 'database':
+        return await asyncio.to_thread(admit_request, api_key_id, limits, generation)
+    return admit_request(api_key_id, limits, generation)
+
+async def record(api_key_id, limits, model, contents, config, response):
+    """
+    Records the estimated model tokens of a chat generation and charges them to the API key.
+    """
+    if RATE_LIMIT_BACKEND == 'database':
+        await asyncio.to_thread(record_generation, api_key_id, limits, model, contents, config, response)
+    else:
+        record_generation(api_key_id, limits, model, contents, config, response)
+
+def rate_limited(error):
+    """
+    Returns the 429 response of a RateLimited error, telling the client when to retry.
+    """
+    result = jsonify({'error': str(error)})
+    result.status_code = 429
+    result.headers['Retry-After'] = str(max(1, math.ceil(error.retry_after)))
+    return result
+
+def release_when_sent(body):
+    """
+    Wraps the body of a streamed response so the generation slot taken by require_api_key, if any, is given
+    back once the body has been sent or the client went away, rather than when the route returns.
+    """
+    api_key_id, generation = request.api_key_id, request.generation
+    request.generation = None  # Released by the body
+
+    async def iterate():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await body.aclose()
+            if generation:
+                release_generation(api_key_id)
+
+    return iterate()
+
+# --- DECORATORS ---
+def require_api_key(f):
+    """
+    Decorator to enforce API key authentication and rate limits for routes.
+    Attaches the API key ID and its rate limits to the request context if valid.
+    """
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        with timed('verify_api_key'):
+            api_key_id, limits, error = await verify_api_key(kwargs.get('campaignid'))
+        if error:
+            return jsonify({'error': error}), 401
+        request.api_key_id = api_key_id  # Attach API key ID to the request context
+        request.rate_limits = limits
+        if getattr(f, 'idempotent', False) and request.headers.get('Idempotency-Key'):
+            # Admitted by idempotent once the key is claimed, see there
+            return await f(*args, **kwargs)
+        return await admitted(f, *args, **kwargs)
+    return decorated
+
+async def admitted(f, *args, **kwargs):
+    """
+    Runs a view once the request is admitted by the rate limits of its API key, see admit_request.
+    The generation routes hold a generation slot until they return (or their body is sent, see release_when_sent).
+    """
+    api_key_id = request.api_key_id
+    try:
+        generation = await admit(api_key_id, request.rate_limits, request.endpoint in GENERATION_ENDPOINTS)
+    except RateLimited as e:
+        return rate_limited(e)
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    # A streamed route hands the slot over to its body with release_when_sent
+    request.generation = generation
+    try:
+        return await f(*args, **kwargs)
+    finally:
+        if request.generation:
+            release_generation(api_key_id)
+
+def require_campaign(f):
+    """
+    Decorator to enforce campaign ownership validation for routes.
+    Ensures the campaign belongs to the authenticated API key.
+    """
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        api_key_id = request.api_key_id
+        if not api_key_id:
+            return jsonify({'error': 'API key is required.'}), 401
+        campaign_id = kwargs.get('campaignid')
+        if not campaign_id:
+            return jsonify({'error': 'Campaign ID is required.'}), 400
+        try:
+            # Check that the campaign exists and belongs to the API key (cached)
+            with timed('require_campaign'):
+                owner = await get_campaign_owner(campaign_id)
+            if owner is None:
+                return jsonify({'error': 'Campaign not found.'}), 404
+            if owner != api_key_id:
+                return jsonify({'error': 'You do not have access'}), 401
+        except Exception as e:
+            return jsonify({'error': f"Database error: {e}"}), 500
+
+        return await f(*args, **kwargs)
+    return decorated
+
+# --- DATABASE STORE FUNCTIONS ---
+
+async def storeChat(campaign_id, user_input, response, turn=None, batched=False):
+    """
+    Stores a chat message and its response in the database, see api.store_chat_steps.
+    """
+    with timed('store_chat'):
+        return await in_session(store_chat_steps(campaign_id, user_input, response, turn, batched))
+
+async def build_turn_context(campaign_id, user_input, connection):
+    """
+    Builds the contents and generation config sent to the AI model for a new user message,
+    reading the history with the connection of the turn, which is then closed.
+    Returns (contents, config, overflow, prefix), see api.turn_context_steps.
+    """
+    try:
+        return await run_steps(connection, turn_context_steps(campaign_id, user_input))
+    finally:
+        await connection.close()
+
+def model_unavailable(error):
+    """
+    Returns the error response of a model call that got no answer from any model of its route.
+    """
+    message, status = model_error(error)
+    return jsonify({'error': message}), status
+
+# --- TURN SERIALIZATION ---
+# Same scheme as api.py: an asyncio lock per campaign, then a lease in "TurnLock" across workers.
+
+turn_locks = {}  # Campaign ID -> [lock, number of requests using it]
+
+def release_local_turn(campaign_id):
+    """
+    Releases the in-memory turn lock of a campaign, and forgets it once nobody uses it.
+    """
+    entry = turn_locks[campaign_id]
+    entry[0].release()
+    entry[1] -= 1
+    if entry[1] == 0:
+        del turn_locks[campaign_id]
+
+async def acquire_turn(campaign_id, keep_connection=False):
+    """
+    Waits until the request holds the turn of the campaign.
+    Returns a Turn to pass to release_turn, raises TurnBusy on timeout.
+    """
+    campaign_id = str(campaign_id)
+    deadline = time.monotonic() + TURN_LOCK_TIMEOUT
+    entry = turn_locks.setdefault(campaign_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        await asyncio.wait_for(entry[0].acquire(), TURN_LOCK_TIMEOUT)
+    except asyncio.TimeoutError:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del turn_locks[campaign_id]
+        raise TurnBusy()
+
+    turn = Turn(campaign_id)
+    delays = turn_poll_delays(deadline)
+    try:
+        turn.connection = await engine.connect() if keep_connection or TURN_LOCK_BACKEND == 'database' else None
+        while TURN_LOCK_BACKEND == 'database':
+            turn.token = await run_steps(turn.connection, turn_lease_steps(campaign_id))
+            if turn.token is not None:
+                break
+            delay = next(delays)
+            # Another worker has the turn, poll with a growing delay without holding the connection
+            await turn.connection.close()
+            await asyncio.sleep(delay)
+            turn.connection = await engine.connect()
+        if not keep_connection and turn.connection is not None:
+            await turn.connection.close()
+        return turn
+    except BaseException:
+        if turn.connection is not None:
+            await turn.connection.close()
+        release_local_turn(campaign_id)
+        raise
+
+async def release_turn(turn):
+    """
+    Releases the turn of a campaign acquired with acquire_turn.
+    """
+    try:
+        if turn.connection is not None:
+            await turn.connection.close()
+        if turn.token is not None:
+            await in_session(turn_release_steps(turn))
+    except Exception as e:
+        # The lease expires on its own
+        logger.error("Error releasing turn lock: %s", e)
+    finally:
+        release_local_turn(turn.campaign_id)
+
+@asynccontextmanager
+async def campaign_turn(campaign_id, keep_connection=False):
+    """
+    Holds the turn of the campaign for the duration of the block, and yields its Turn.
+    """
+    turn = await acquire_turn(campaign_id, keep_connection)
+    try:
+        yield turn
+    finally:
+        await release_turn(turn)
+
+def drop_cached_prefix(campaign_id):
+    """
+    Deletes the cached context prefix of the campaign (see api.context_cache) once the response is sent,
+    without blocking the event loop.
+    """
+    app.add_background_task(asyncio.to_thread, context_cache.invalidate, str(campaign_id))
+
+def schedule_summary(campaign_id):
+    """
+    Hands the campaign over to the summary job queue of api.py, without blocking the event loop.
+    """
+    app.add_background_task(asyncio.to_thread, enqueue_summary, campaign_id)
+
+# --- BATCH CHATS ---
+# Same scheme as api.py: the free campaigns of a batch are started together, and their items run as tasks.
+
+async def batch_settle(items, api_key_id):
+    """
+    Checks the campaign of each batch item, see api.batch_settle_steps.
+    """
+    return await in_session(batch_settle_steps(items, api_key_id))
+
+async def try_turns(campaign_ids):
+    """
+    Takes the turns of the campaigns that are free, without waiting.
+    Returns ({campaign ID: Turn}, connection): the connection took the leases and stays open for the reads
+    of the turns (None if no turn was taken).
+    """
+    turns = {}
+    for campaign_id in campaign_ids:
+        entry = turn_locks.setdefault(campaign_id, [asyncio.Lock(), 0])
+        # Free only if no other request holds or waits for it, then acquired at once
+        if entry[1] == 0:
+            entry[1] += 1
+            await entry[0].acquire()
+            turns[campaign_id] = Turn(campaign_id)
+    if not turns:
+        return turns, None
+    connection = None
+    try:
+        connection = await engine.connect()
+        if TURN_LOCK_BACKEND == 'database':
+            leased = await run_steps(connection, batch_lease_steps(turns))
+            # Another worker has the others
+            for campaign_id in [campaign_id for campaign_id in turns if campaign_id not in leased]:
+                release_local_turn(campaign_id)
+                del turns[campaign_id]
+        return turns, connection
+    except BaseException:
+        if connection is not None:
+            await connection.close()
+        for turn in turns.values():
+            turn.token = None  # Not committed
+            release_local_turn(turn.campaign_id)
+        raise
+
+async def start_batch_items(pending):
+    """
+    Starts the batch items whose campaign is free, see api.start_batch_items.
+    """
+    turns, connection = await try_turns({campaign_id for _, campaign_id, _ in pending})
+    if connection is None:
+        return [], pending
+    try:
+        started = await run_steps(connection, batch_start_steps(pending, turns))
+    except BaseException:
+        for turn in turns.values():
+            await release_turn(turn)
+        raise
+    finally:
+        await connection.close()
+    return started, [item for item in pending if item[1] not in turns]
+
+async def run_batch_item(api_key_id, limits, item, turn, history, snippets):
+    """
+    Generates and stores the turn of a batch item, then releases its campaign turn.
+    Returns the status and fields of its result line.
+    """
+    _, campaign_id, user_input = item
+    generation, overflow = False, None
+    try:
+        # Each item counts as a request and a generation of the API key
+        generation = await admit(api_key_id, limits, True)
+        config = await campaign_prompt_config(campaign_id)
+        pinned, summary, turns = history
+        contents, overflow, prefix = assemble_context(pinned, summary, turns, with_snippets(user_input, snippets), config)
+        with timed('generate'):
+            response, model = await model_router.generate_async(
+                'chat', lambda model: context_cache.generate_content_async(model, contents, config, prefix, campaign_id)
+            )
+        await record(api_key_id, limits, model, contents, config, response.text)
+        stored = await storeChat(campaign_id, user_input, response.text, turn, batched=True)
+        return batch_item_stored(response.text, stored)
+    except Exception as e:
+        return batch_item_failed(e)
+    finally:
+        await release_turn(turn)
+        if generation:
+            release_generation(api_key_id)
+        if overflow:
+            schedule_summary(campaign_id)
+
+async def run_batch(api_key_id, limits, pending):
+    """
+    Runs the accepted items of a batch and yields their result lines as they finish, see api.run_batch.
+    """
+    batch = BatchRun(limits, pending)
+    try:
+        while batch.unfinished():
+            if batch.due():
+                try:
+                    lines = batch.polled(*await start_batch_items(batch.pending))
+                except Exception as e:
+                    lines = batch.failed(e)
+                for line in lines:
+                    yield line
+            for entry in batch.startable():
+                batch.running[asyncio.ensure_future(run_batch_item(api_key_id, limits, *entry))] = entry[0]
+            if batch.running:
+                done, _ = await asyncio.wait(batch.running, timeout=batch.timeout(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield batch.finished(task, task.result())
+            elif batch.pending:
+                await asyncio.sleep(batch.timeout())
+    finally:
+        # Closed early by the client: the items not started give back their turns, running ones release their own
+        for entry in batch.ready:
+            await release_turn(entry[1])
+
+# --- IDEMPOTENCY ---
+# Same scheme as api.py, with the same "IdempotencyKey" table and cache of completed records.
+
+idempotency_events = {}  # (API key ID, key) -> event set when the request running in this process finishes
+
+async def finish_idempotency_key(scope, fingerprint, response):
+    """
+    Stores the response of a successful request for replay, or frees the key for a retry otherwise.
+    """
+    record = None
+    if response is not None and response.status_code < 400:
+        record = idempotency_record(fingerprint, response.status_code, await response.get_data(as_text=True), response.headers)
+    await in_session(finish_idempotency_steps(scope, record, idempotency_events))
+
+def replay(record):
+    """
+    Returns the stored response of an idempotent request.
+    """
+    result = Response(record['body'], status=record['statusCode'], headers=json.loads(record['headers'] or '{}'))
+    result.headers['Idempotent-Replayed'] = 'true'
+    return result
+
+def idempotent(f):
+    """
+    Decorator running a POST route once per Idempotency-Key header, must come after require_api_key.
+    Requests without the header are not affected. With it, the request is only admitted by the rate limits
+    once it claimed the key, as in api.py.
+    """
+    @wraps(f)
+    async def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return await f(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key must be at most 255 characters.'}), 400
+        scope = (str(request.api_key_id), key)
+        fingerprint = request_fingerprint(request.method, request.path, await request.get_data())
+        try:
+            record, error = await in_session(idempotency_steps(scope, fingerprint, idempotency_events, asyncio.Event))
+        except Exception as e:
+            return jsonify({'error': f"Database error: {e}"}), 500
+        if error:
+            return jsonify({'error': error[0]}), error[1]
+        if record:
+            return replay(record)
+
+        result = None
+        try:
+            result = await app.make_response(await admitted(f, *args, **kwargs))
+            return result
+        finally:
+            await finish_idempotency_key(scope, fingerprint, result)
+    decorated.idempotent = True  # Seen by require_api_key through the decorators in between
+    return decorated
+
+# --- METRICS ---
+# Same metrics as api.py. Quart has no hook once a streamed body is sent, so requests are measured until
+# their response is ready (the generation of a chat stream is measured by its own stage).
+
+@app.before_request
+async def start_request_metrics():
+    request.stats = start_request()
+
+@app.after_request
+async def finish_request_metrics(response):
+    finish_request(request.stats, request.method, request.endpoint, response.status_code)
+    return response
+
+@app.after_request
+async def stick_writers_to_primary(response):
+    # Quart has no hook once a streamed body is sent, a streamed turn may be stored a little later
+    api_key_id = getattr(request, 'api_key_id', None)
+    if api_key_id and request.method != 'GET' and response.status_code < 400:
+        stick_to_primary(api_key_id)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Invalid metrics token.'}), 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- ROUTES ---
+
+@app.route('/campaigns', methods=['GET'])
+@require_api_key
+async def get_campaigns():
+    """
+    Retrieves all campaigns associated with the authenticated API key, or a page of them with a limit.
+    Optionally filters by user ID if provided.
+    """
+    api_key_id = request.api_key_id
+    userId = request.args.get('userId', None)
+    paginated = any(arg in request.args for arg in ('limit', 'after'))
+    if paginated:
+        try:
+            query, params, limit = campaigns_page_params(api_key_id, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    responses, cached = cached_campaign_response(api_key_id, request.query_string)
+    if cached is not None:
+        return jsonify(cached[0]), cached[1]
+    try:
+        async with read_sessionmaker(api_key_id)() as session:
+            if paginated:
+                page = campaigns_page((await session.execute(query, params)).fetchall(), limit)
+            elif userId:
+                # Fetch campaigns for the specific user
+                result = (await session.execute(
+                    text("""SELECT id, name FROM "Campaign" WHERE "apiKeyId" = :id AND "userId" = :userId"""),
+                    {'id': api_key_id, 'userId': userId}
+                )).fetchall()
+            else:
+                # Fetch all campaigns for the API key
+                result = (await session.execute(
+                    text("""SELECT id, name FROM "Campaign" WHERE "apiKeyId" = :id"""),
+                    {'id': api_key_id}
+                )).fetchall()
+            if not paginated:
+                campaigns = [{'id': str(row[0]), 'name': row[1]} for row in result]
+    except Exception as e:
+        logger.error("Error fetching campaigns: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    if paginated:
+        response = page, 200
+    elif len(campaigns) == 0:
+        response = {'message': 'You have no campaigns yet.'}, 204
+    else:
+        response = campaigns, 200
+    cache_campaign_response(api_key_id, responses, request.query_string, response)
+    return jsonify(response[0]), response[1]
+
+@app.route('/campaigns', methods=['POST'])
+@require_api_key
+@idempotent
+async def create_campaign():
+    """
+    Creates a new campaign for the authenticated API key.
+    The campaign references its prompt (the default one if none is provided). Its AI opening message is
+    generated in the background: the response is 202, with the campaign status URL in the Location header.
+    """
+    try:
+        fields = campaign_fields(await request.get_json())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        body, status, headers = await in_session(create_campaign_steps(request.api_key_id, fields, engine.dialect.name))
+    except Exception as e:
+        logger.error("Error creating campaign: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+    return jsonify(body), status, headers
+
+@app.route('/campaigns/<uuid:campaignid>/status', methods=['GET'])
+@require_api_key
+@require_campaign
+async def get_campaign_status(campaignid):
+    """
+    Returns the progress of the campaign opening message: 'pending', 'running', 'done' or 'failed'.
+    """
+    try:
+        async with Session() as session:
+            result = (await session.execute(
+                text("""SELECT status FROM "CampaignJob" WHERE "campaignId" = :campaignid AND kind = 'opening'"""),
+                {'campaignid': str(campaignid)}
+            )).first()
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    # Campaigns created before openings were generated in the background have no job
+    return jsonify({'id': str(campaignid), 'opening': result[0] if result else 'done'})
+
+@app.route('/campaigns/<uuid:campaignid>', methods=['GET'])
+@require_api_key
+@require_campaign
+async def get_campaign_info(campaignid):
+    """
+    Retrieves detailed information about a specific campaign.
+    Ensures the campaign belongs to the authenticated API key.
+    """
+    api_key_id = request.api_key_id
+    responses, cached = cached_campaign_response(api_key_id, str(campaignid))
+    if cached is not None:
+        return jsonify(cached[0]), cached[1]
+    try:
+        async with read_sessionmaker(api_key_id)() as session:
+            result = (await session.execute(CAMPAIGN_INFO_QUERY, {'campaignid': str(campaignid)})).fetchone()
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    if not result:
+        # Deleted since the ownership check, or not replicated yet
+        return jsonify({'error': 'Campaign not found.'}), 404
+    response = campaign_info(result), 200
+    cache_campaign_response(api_key_id, responses, str(campaignid), response)
+    return jsonify(response[0]), response[1]
+
+@app.route('/campaigns/<uuid:campaignid>', methods=['PUT'])
+@require_api_key
+@require_campaign
+async def edit_campaign_info(campaignid):
+    """
+    Updates the name of a specific campaign.
+    Ensures the campaign belongs to the authenticated API key.
+    """
+    name = (await request.get_json()).get('name', None)
+    try:
+        async with Session() as session:
+            if name:
+                await session.execute(
+                    text("""UPDATE "Campaign" SET name = :name WHERE id = :campaignid"""),
+                    {'name': name, 'campaignid': str(campaignid)}
+                )
+                await session.commit()
+                campaigns_changed(request.api_key_id)
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    return jsonify({'status': 'success', 'message': 'Campaign updated successfully.'}), 200
+
+@app.route('/campaigns/<uuid:campaignid>', methods=['DELETE'])
+@require_api_key
+@require_campaign
+async def delete_campaign(campaignid):
+    """
+    Deletes a specific campaign and its associated data.
+    Ensures the campaign belongs to the authenticated API key.
+    """
+    try:
+        # Waits for a turn in progress, which would otherwise store its chat into a deleted campaign
+        async with campaign_turn(campaignid):
+            await in_session(delete_campaign_steps(campaignid, request.api_key_id))
+        drop_cached_prefix(campaignid)
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    return jsonify({'status': 'success', 'message': 'Campaign deleted successfully.'}), 200
+
+@app.route('/campaigns/<uuid:campaignid>/chats', methods=['POST'])
+@require_api_key
+@require_campaign
+@idempotent
+async def campaign_chat(campaignid):
+    """
+    Handles user input for a campaign and generates an AI response.
+    Stores the chat history and schedules chat summarization if needed.
+    """
+    user_input = (await request.get_json()).get('input', '')
+
+    try:
+        # Wait for the previous turn of the campaign, so this one sees its result
+        async with campaign_turn(campaignid, keep_connection=True) as turn:
+            contents, config, overflow, prefix = await build_turn_context(campaignid, user_input, turn.connection)
+            with timed('generate'):
+                response, model = await model_router.generate_async(
+                    'chat', lambda model: context_cache.generate_content_async(model, contents, config, prefix, str(campaignid))
+                )
+            stored = await storeChat(campaignid, user_input, response.text, turn)
+        if stored is None:
+            return jsonify({'error': 'Campaign not found.'}), 404
+        await record(request.api_key_id, request.rate_limits, model, contents, config, response.text)
+        if overflow:
+            schedule_summary(campaignid)
+        return jsonify({'response': response.text, 'id': stored['id'], 'createdAt': stored['createdAt']})
+
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except ModelUnavailable as e:
+        logger.error("Error in campaign_chat: %s", e)
+        return model_unavailable(e)
+    except Exception as e:
+        logger.error("Error in campaign_chat: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+@app.route('/campaigns/<uuid:campaignid>/chats/stream', methods=['POST'])
+@require_api_key
+@require_campaign
+async def campaign_chat_stream(campaignid):
+    """
+    Streaming variant of campaign_chat, sending the AI response as server-sent events.
+    """
+    user_input = (await request.get_json()).get('input', '')
+
+    try:
+        # The turn is held until the stream ends
+        turn = await acquire_turn(campaignid, keep_connection=True)
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except Exception as e:
+        logger.error("Error in campaign_chat_stream: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+    try:
+        contents, config, overflow, prefix = await build_turn_context(campaignid, user_input, turn.connection)
+    except Exception as e:
+        await release_turn(turn)
+        logger.error("Error in campaign_chat_stream: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    api_key_id, limits = request.api_key_id, request.rate_limits
+
+    async def generate():
+        chunks = []
+        try:
+            with timed('generate'):
+                stream, model = await model_router.stream_async(
+                    'chat', lambda model: context_cache.generate_content_stream_async(model, contents, config, prefix, str(campaignid))
+                )
+                async for chunk in stream:
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        yield sse_event('token', {'text': chunk.text})
+            response = ''.join(chunks)
+            await record(api_key_id, limits, model, contents, config, response)
+            stored = await storeChat(campaignid, user_input, response, turn)
+            if stored is None:
+                yield sse_event('error', {'error': 'Failed to store the chat.'})
+                return
+            if overflow:
+                schedule_summary(campaignid)
+            yield sse_event('done', {'response': response, 'id': stored['id'], 'createdAt': stored['createdAt']})
+        except Exception as e:
+            logger.error("Error in campaign_chat_stream: %s", e)
+            yield sse_event('error', {'error': f"Generation error: {e}"})
+        finally:
+            await release_turn(turn)
+
+    # The generation goes on while the response is sent
+    return Response(
+        release_when_sent(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/campaigns/chats', methods=['POST'])
+@require_api_key
+async def campaign_chats():
+    """
+    Handles the messages of many campaigns in one request, see BATCH CHATS in api.py.
+    The result of each item is streamed as an NDJSON line as soon as it is known, in order of completion.
+    """
+    try:
+        items = batch_items(await request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        refused, pending = await batch_settle(items, request.api_key_id)
+    except Exception as e:
+        logger.error("Error in campaign_chats: %s", e)
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    api_key_id, limits = request.api_key_id, request.rate_limits
+
+    async def generate():
+        for line in refused:
+            yield line
+        async for line in run_batch(api_key_id, limits, pending):
+            yield line
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/campaigns/<uuid:campaignid>/chats', methods=['GET'])
+@require_api_key
+@require_campaign
+async def get_chats(campaignid):
+    export = request.args.get('format') == 'ndjson'
+    paginated = any(arg in request.args for arg in ('limit', 'before', 'after'))
+    try:
+        number = chats_number(request.args)
+        if paginated and not export:
+            query, params, limit = chats_page_params(campaignid, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    ReadSession = read_sessionmaker(request.api_key_id)
+    try:
+        async with ReadSession() as session:
+            # Unchanged history since the client's last poll, nothing to read or serialize
+            version = (await session.execute(CHAT_VERSION_QUERY, {'campaignid': str(campaignid)})).one()
+            etag = chats_etag(campaignid, version, request.query_string)
+            if request.if_none_match.contains(etag):
+                result = Response(status=304)
+                result.set_etag(etag)
+                return result
+            if export:
+                pass  # Streamed below, with its own session
+            elif paginated:
+                page = chats_page((await session.execute(query, params)).fetchall(), limit, request.args)
+            elif number:
+                rows = (await session.execute(
+                    text("""SELECT message, response, "createdAt" FROM "Chat" WHERE "campaignId" = :campaignid ORDER BY "createdAt" ASC LIMIT :number"""),
+                    {'campaignid': str(campaignid), 'number': number}
+                )).fetchall()
+            else:
+                rows = (await session.execute(
+                    text("""SELECT message, response, "createdAt" FROM "Chat" WHERE "campaignId" = :campaignid ORDER BY "createdAt" ASC"""),
+                    {'campaignid': str(campaignid)}
+                )).fetchall()
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+
+    if export:
+        async def generate():
+            # Rows are read through a server-side cursor, the full history is never held in memory
+            async with ReadSession() as session:
+                rows = await session.stream(CHATS_EXPORT_QUERY, {'campaignid': str(campaignid)})
+                async for row in rows:
+                    yield chat_line(row)
+
+        result = Response(generate(), mimetype='application/x-ndjson')
+    elif paginated:
+        result = jsonify(page)
+    else:
+        chats = [{'message': row[0], 'response': row[1], 'createdAt': row[2]} for row in rows]
+        if len(chats) == 0: return jsonify({'message': 'No chats found for this campaign.'}), 204
+        result = jsonify(chats)
+    result.set_etag(etag)
+    return result
+
+@app.route('/campaigns/<uuid:campaignid>/chats', methods=['DELETE'])
+@require_api_key
+@require_campaign
+async def delete_chats(campaignid):
+    number = request.args.get('count', None, type=int)
+    try:
+        # Waits for a turn in progress, so its chat is not stored into the history being deleted
+        async with campaign_turn(campaignid):
+            body, status, headers = await in_session(delete_chats_steps(campaignid, number, engine.dialect.name))
+        # The opening or summary of the cached prefix may be gone
+        drop_cached_prefix(campaignid)
+    except TurnBusy:
+        return jsonify({'error': 'Another message is still being processed for this campaign.'}), 409
+    except Exception as e:
+        return jsonify({'error': f"Database error: {e}"}), 500
+    return jsonify(body), status, headers
+
+# --- START ---
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,84 @@
+# Offline harness shared by test.py and benchmarks/load.py.
+# It runs api.py in-process with the fake model backend, against a fresh SQLite database (default)
+# or a local Postgres migrated with migrations/, and counts the database queries of each request.
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import uuid
+
+from sqlalchemy import event, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SQLITE_SCHEMA = os.path.join(ROOT, 'benchmarks', 'schema_sqlite.sql')
+# api.py and model_backend.py live at the repository root
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# API key seeded in the "ApiKey" table, for the Authorization header of offline requests
+TEST_API_KEY = 'offline-test-key'
+
+
+def sqlite_database():
+    """
+    Creates an SQLite database with the schema in a temporary file, and returns its URL.
+    """
+    handle, path = tempfile.mkstemp(prefix='roleplaychat-', suffix='.db')
+    os.close(handle)
+    with sqlite3.connect(path) as connection, open(SQLITE_SCHEMA) as schema:
+        connection.executescript(schema.read())
+    return f'sqlite:///{path}'
+
+
+def load_app(database_url=None, replica=False, **env):
+    """
+    Imports api.py configured for offline runs, and returns the module.
+    Without a database_url a fresh SQLite database is created. With replica, the database is also configured as
+    the read replica (DATABASE_REPLICA_URL), through a second engine. Extra keyword arguments are set as
+    environment variables (e.g. TURN_LOCK_BACKEND='process') before the import, since api.py reads them then.
+    """
+    database_url = database_url or sqlite_database()
+    os.environ.update(
+        API_KEY=os.environ.get('API_KEY', 'offline'),
+        DATABASE_URL=database_url,
+        DATABASE_REPLICA_URL=database_url if replica else '',
+        GENAI_BACKEND='fake',
+        **{name: str(value) for name, value in env.items()}
+    )
+    import api
+
+    api.create_app()
+    # The fake model client, created now so tests and benchmarks can swap or inspect it
+    api.genai_client()
+    with api.app.app_context(), api.db.engine.begin() as connection:
+        if not connection.execute(text('SELECT id FROM "ApiKey" WHERE key = :key'), {'key': TEST_API_KEY}).first():
+            # Without rate limits, so the tests and benchmarks measure the server rather than the limits
+            connection.execute(
+                text("""INSERT INTO "ApiKey" (id, key, "requestsPerMinute", "tokensPerMinute", "maxConcurrent")
+                        VALUES (:id, :key, 0, 0, 0)"""),
+                {'id': str(uuid.uuid4()), 'key': TEST_API_KEY}
+            )
+    return api
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed by the current thread on the API engine.
+    The Flask test client runs each request in the calling thread, so the count between start() and
+    stop() is the number of queries of that request (background jobs run on other threads).
+    """
+
+    def __init__(self, api):
+        self.local = threading.local()
+        with api.app.app_context():
+            event.listen(api.db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def start(self):
+        self.local.queries = 0
+
+    def stop(self):
+        return getattr(self.local, 'queries', 0)
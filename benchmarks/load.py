@@ -0,0 +1,184 @@
+# Load benchmark of the API, run offline: api.py is driven in-process through the Flask test client with
+# the fake model backend, so the numbers only depend on this code and the database, not on Gemini.
+# Each workload runs its requests at the given concurrency and reports p50/p95/p99 latency, throughput
+# and database queries per request. Run it before and after a change to compare:
+#   python benchmarks/load.py --concurrency 16 --requests 400 --latency 0.05
+#   python benchmarks/load.py --database-url postgresql://localhost/roleplaychat_bench --json results.json
+# --slow-rate and --error-rate inject a latency tail and failures, to measure the model router (hedging, retries):
+#   python benchmarks/load.py --workloads chat --latency 0.05 --slow-rate 0.03 --slow-latency 2
+# The batch workload sends --batch-size turns per request to POST /campaigns/chats, compare it with chat:
+#   python benchmarks/load.py --workloads chat,batch --campaigns 64 --batch-size 16 --latency 0.05
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import TEST_API_KEY, QueryCounter, load_app
+
+from model_backend import FakeClient
+
+HEADERS = {'Authorization': f'Bearer {TEST_API_KEY}'}
+WORKLOADS = ['create', 'chat', 'stream', 'batch', 'list', 'info', 'history', 'delete']
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def create_campaigns(client, count, prefix):
+    """
+    Creates campaigns for the workloads and returns their IDs.
+    """
+    for i in range(count):
+        client.post('/campaigns', json={'name': f'{prefix} {i}', 'book': 'benchmark', 'userId': prefix}, headers=HEADERS)
+    campaigns = client.get('/campaigns', query_string={'userId': prefix}, headers=HEADERS).get_json()
+    return [campaign['id'] for campaign in campaigns]
+
+
+def delete_campaigns(client, prefix):
+    """
+    Deletes the campaigns created by the benchmark under a userId.
+    """
+    response = client.get('/campaigns', query_string={'userId': prefix}, headers=HEADERS)
+    if response.status_code != 200:
+        return
+    for campaign in response.get_json():
+        client.delete(f'/campaigns/{campaign["id"]}', headers=HEADERS)
+
+
+def workload_requests(name, campaign_ids, prefix, batch_size=1):
+    """
+    Returns a function sending the i-th request of a workload with a test client.
+    Chat workloads spread their turns over the campaigns, since turns of one campaign are serialized.
+    """
+    if name == 'create':
+        return lambda client, i: client.post('/campaigns', json={'name': f'load {i}', 'book': 'benchmark', 'userId': f'{prefix}-create'}, headers=HEADERS)
+    if name == 'chat':
+        return lambda client, i: client.post(f'/campaigns/{campaign_ids[i % len(campaign_ids)]}/chats', json={'input': f'turn {i}'}, headers=HEADERS)
+    if name == 'stream':
+        return lambda client, i: client.post(f'/campaigns/{campaign_ids[i % len(campaign_ids)]}/chats/stream', json={'input': f'streamed turn {i}'}, headers=HEADERS)
+    if name == 'batch':
+        return lambda client, i: client.post('/campaigns/chats', json={'items': [
+            {'campaignId': campaign_ids[(i * batch_size + j) % len(campaign_ids)], 'input': f'batched turn {i}.{j}'}
+            for j in range(batch_size)
+        ]}, headers=HEADERS)
+    if name == 'list':
+        return lambda client, i: client.get('/campaigns', headers=HEADERS)
+    if name == 'info':
+        return lambda client, i: client.get(f'/campaigns/{campaign_ids[i % len(campaign_ids)]}', headers=HEADERS)
+    if name == 'history':
+        return lambda client, i: client.get(f'/campaigns/{campaign_ids[i % len(campaign_ids)]}/chats', query_string={'limit': 50}, headers=HEADERS)
+    if name == 'delete':
+        return lambda client, i: client.delete(f'/campaigns/{campaign_ids[i]}', headers=HEADERS)
+    raise ValueError(f"Unknown workload: {name}")
+
+
+def run_workload(api, counter, send, requests, concurrency):
+    """
+    Sends the requests of a workload with `concurrency` threads, each with its own test client.
+    Returns the latency and query count of every successful request, the number of failed ones and the elapsed time.
+    """
+    latencies, queries, errors = [], [], 0
+
+    def run(i):
+        nonlocal errors
+        client = api.app.test_client()
+        counter.start()
+        start = time.perf_counter()
+        response = send(client, i)
+        # Reading the body consumes streamed responses, closing it runs their call_on_close hooks
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+        if response.status_code < 400:
+            latencies.append(elapsed)
+            queries.append(counter.stop())
+        else:
+            errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, range(requests)))
+    return latencies, queries, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark of the API with the fake model.')
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'), help='Migrated database to use (default: a fresh SQLite file)')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='Comma separated workloads to run, in order')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per workload')
+    parser.add_argument('--campaigns', type=int, default=16, help='Campaigns the chat and history workloads are spread over')
+    parser.add_argument('--batch-size', type=int, default=8, help='Turns per request of the batch workload (each request counts them all)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Mean fake model latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the fake model latency')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Share of model calls taking --slow-latency instead (tail latency)')
+    parser.add_argument('--slow-latency', type=float, default=2.0, help='Fake model latency of the slow calls in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of model calls failing')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the latency distribution')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    # Turns are serialized in-process only; the database lease is measured when a Postgres URL is given
+    api = load_app(args.database_url, TURN_LOCK_BACKEND='database' if args.database_url else 'process')
+    rng = random.Random(args.seed)
+
+    def latency():
+        if rng.random() < args.slow_rate:
+            return args.slow_latency
+        return max(0.0, rng.gauss(args.latency, args.jitter))
+    api.client = FakeClient(latency=latency, failure=(lambda model: rng.random() < args.error_rate) if args.error_rate else None)
+    counter = QueryCounter(api)
+    client = api.app.test_client()
+    run_id = f'load-{os.getpid()}-{int(time.time())}'
+    campaign_ids = create_campaigns(client, args.campaigns, run_id)
+
+    results = {}
+    print(f"{'workload':<8} {'ok':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'queries':>8}")
+    for name in args.workloads.split(','):
+        ids = campaign_ids
+        if name == 'delete':
+            ids = create_campaigns(client, args.requests, f'{run_id}-delete')
+        requests = min(args.requests, len(ids)) if name == 'delete' else args.requests
+        if name == 'batch':
+            # The same number of turns as the chat workload
+            requests = max(1, requests // args.batch_size)
+        send = workload_requests(name, ids, run_id, args.batch_size)
+        latencies, queries, errors, elapsed = run_workload(api, counter, send, requests, args.concurrency)
+        if not latencies:
+            print(f"{name:<8} {0:>6} {errors:>6}")
+            results[name] = {'ok': 0, 'errors': errors}
+            continue
+        results[name] = {
+            'ok': len(latencies),
+            'errors': errors,
+            'p50': statistics.median(latencies),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'throughput': len(latencies) / elapsed,
+            'queries_per_request': statistics.mean(queries),
+        }
+        result = results[name]
+        print(
+            f"{name:<8} {result['ok']:>6} {errors:>6} {result['p50']:>8.4f} {result['p95']:>8.4f} {result['p99']:>8.4f} "
+            f"{result['throughput']:>8.1f} {result['queries_per_request']:>8.2f}"
+        )
+
+    for prefix in (run_id, f'{run_id}-create', f'{run_id}-delete'):
+        delete_campaigns(client, prefix)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
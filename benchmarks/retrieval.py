@@ -0,0 +1,66 @@
+# Benchmark of the archive retrieval index (retrieval.py) on a synthetic campaign: builds the index of
+# --turns archived turns with a Zipf-like vocabulary, then reports the build time and the p50/p99 latency
+# of searches with short messages, which is what each chat turn pays:
+#   python benchmarks/retrieval.py --turns 100000
+import argparse
+import itertools
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retrieval import ArchiveIndex
+
+# Words every campaign keeps using, on top of the long tail of the vocabulary
+THEMES = ['sword', 'door', 'dragon', 'tavern', 'gold', 'king', 'forest', 'attack', 'look', 'open', 'spell', 'guard', 'castle', 'night']
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and query the archive retrieval index of a synthetic campaign.')
+    parser.add_argument('--turns', type=int, default=100000, help='Archived turns of the campaign')
+    parser.add_argument('--words', type=int, default=80, help='Words per turn (message and response)')
+    parser.add_argument('--vocabulary', type=int, default=30000, help='Distinct words of the campaign')
+    parser.add_argument('--queries', type=int, default=500, help='Searches to time')
+    parser.add_argument('--snippets', type=int, default=3, help='Turns returned per search')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = [f'word{i}' for i in range(args.vocabulary)]
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.vocabulary)))
+
+    def text(words):
+        return ' '.join(rng.choices(vocabulary, cum_weights=weights, k=words) + rng.choices(THEMES, k=words // 8))
+
+    turns = [text(args.words) for _ in range(args.turns)]
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = ArchiveIndex()
+    start = time.perf_counter()
+    for doc_id, turn in enumerate(turns, 1):
+        index.add(doc_id, turn)
+    build = time.perf_counter() - start
+    # Peak resident memory grows by the size of the index (kilobytes on Linux)
+    memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory) / 1024
+
+    latencies = []
+    for _ in range(args.queries):
+        query = text(12)
+        start = time.perf_counter()
+        index.search(query, args.snippets)
+        latencies.append(time.perf_counter() - start)
+    print(f"{args.turns} turns indexed in {build:.1f}s ({len(index.postings)} terms, ~{memory:.0f} MB)")
+    print(f"search p50 {percentile(latencies, 50) * 1000:.2f}ms p99 {percentile(latencies, 99) * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+-- SQLite equivalent of the production schema with every file of migrations/ applied.
+-- Used by benchmarks/harness.py to run the API offline; Postgres databases are migrated with migrations/ instead.
+-- Timestamps default to microsecond strings, the format SQLAlchemy reads and writes for SQLite.
+PRAGMA journal_mode = WAL;
+
+CREATE TABLE IF NOT EXISTS "ApiKey" (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    "requestsPerMinute" INTEGER,
+    "tokensPerMinute" INTEGER,
+    "maxConcurrent" INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS "Prompt" (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    "createdAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now'))
+);
+
+CREATE TABLE IF NOT EXISTS "Campaign" (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    book TEXT NOT NULL,
+    prompt TEXT,
+    "promptHash" TEXT REFERENCES "Prompt"(hash),
+    "userId" TEXT,
+    "apiKeyId" TEXT NOT NULL REFERENCES "ApiKey"(id),
+    "createdAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now'))
+);
+
+CREATE INDEX IF NOT EXISTS "Campaign_apiKeyId_createdAt_idx" ON "Campaign" ("apiKeyId", "createdAt", id);
+
+CREATE TABLE IF NOT EXISTS "Chat" (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL,
+    response TEXT NOT NULL,
+    "campaignId" TEXT NOT NULL REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    "createdAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now')),
+    "tokenCount" INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS "Chat_campaignId_createdAt_idx" ON "Chat" ("campaignId", "createdAt");
+CREATE INDEX IF NOT EXISTS "Chat_campaignId_id_idx" ON "Chat" ("campaignId", id);
+
+CREATE TABLE IF NOT EXISTS "ChatArchive" (
+    id INTEGER PRIMARY KEY,
+    "campaignId" TEXT NOT NULL REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    message TEXT NOT NULL,
+    response TEXT NOT NULL,
+    "createdAt" TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "ChatArchive_campaignId_id_idx" ON "ChatArchive" ("campaignId", id);
+
+CREATE TABLE IF NOT EXISTS "CampaignJob" (
+    "campaignId" TEXT NOT NULL REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    "updatedAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now')),
+    PRIMARY KEY ("campaignId", kind)
+);
+
+CREATE INDEX IF NOT EXISTS "CampaignJob_status_idx" ON "CampaignJob" (status);
+
+CREATE TABLE IF NOT EXISTS "TurnLock" (
+    "campaignId" TEXT PRIMARY KEY REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    token TEXT NOT NULL,
+    "expiresAt" TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS "OpeningPool" (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    "promptHash" TEXT NOT NULL,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    "createdAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now'))
+);
+
+CREATE INDEX IF NOT EXISTS "OpeningPool_promptHash_model_createdAt_idx" ON "OpeningPool" ("promptHash", model, "createdAt");
+
+CREATE TABLE IF NOT EXISTS "IdempotencyKey" (
+    "apiKeyId" TEXT NOT NULL REFERENCES "ApiKey"(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    "statusCode" INTEGER,
+    body TEXT,
+    headers TEXT,
+    "createdAt" TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f000', 'now')),
+    "expiresAt" TIMESTAMP NOT NULL,
+    PRIMARY KEY ("apiKeyId", key)
+);
+
+CREATE INDEX IF NOT EXISTS "IdempotencyKey_expiresAt_idx" ON "IdempotencyKey" ("expiresAt");
+
+CREATE TABLE IF NOT EXISTS "RateLimitBucket" (
+    "apiKeyId" TEXT NOT NULL REFERENCES "ApiKey"(id) ON DELETE CASCADE,
+    bucket TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    "updatedAt" REAL NOT NULL,
+    PRIMARY KEY ("apiKeyId", bucket)
+);
@@ -0,0 +1,176 @@
+# Compares the synchronous (WSGI, api.py) and asynchronous (ASGI, api_async.py) serving modes.
+# Each mode is started as a server process with the fake model (GENAI_BACKEND=fake) and a configurable
+# model latency, then hammered with concurrent chat turns. The turns are spread over --campaigns campaigns (one per
+# turn in flight by default), since the turns of one campaign are serialized and would measure its queue instead.
+#
+# Requires DATABASE_URL to point to a database with the schema applied. The turns are sent with an API key seeded
+# for the run without rate limits, like benchmarks/harness.py does, so they measure the server rather than the limits
+# (the default RATE_LIMIT_CONCURRENCY of 4 would refuse most of them with 429):
+#   python benchmarks/serving_modes.py --concurrency 200 --requests 1000 --latency 1.0
+# With --api-key, that existing key and its limits are used instead.
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+from sqlalchemy import create_engine, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Server command of each mode, {port} and {threads} are filled in
+MODES = {
+    'sync': 'gunicorn --workers 1 --threads {threads} --bind 127.0.0.1:{port} api:create_app()',
+    'async': 'hypercorn --workers 1 --bind 127.0.0.1:{port} api_async:app',
+}
+
+
+def seed_api_key(database_url):
+    """
+    Inserts an API key without rate limits in the "ApiKey" table, and returns its id and key.
+    """
+    key_id, key = str(uuid.uuid4()), f'benchmark-{uuid.uuid4()}'
+    with create_engine(database_url).begin() as connection:
+        connection.execute(
+            text("""INSERT INTO "ApiKey" (id, key, "requestsPerMinute", "tokensPerMinute", "maxConcurrent")
+                    VALUES (:id, :key, 0, 0, 0)"""),
+            {'id': key_id, 'key': key}
+        )
+    return key_id, key
+
+
+def delete_api_key(database_url, key_id):
+    """
+    Deletes the API key inserted by seed_api_key.
+    """
+    with create_engine(database_url).begin() as connection:
+        connection.execute(text('DELETE FROM "ApiKey" WHERE id = :id'), {'id': key_id})
+
+
+def free_port():
+    """
+    Returns a TCP port nobody is listening on.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, args):
+    """
+    Starts the server of a mode with the fake model and waits until it accepts connections.
+    """
+    env = dict(os.environ, GENAI_BACKEND='fake', FAKE_MODEL_LATENCY=str(args.latency), API_KEY=os.environ.get('API_KEY', 'fake'))
+    command = MODES[mode].format(port=port, threads=args.threads).split()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def run_load(base_url, args):
+    """
+    Creates the campaigns, sends args.requests chat turns over them with args.concurrency in flight, then deletes them.
+    Returns the latency of every successful turn and the number of failed ones.
+    """
+    headers = {'Authorization': f'Bearer {args.api_key}'}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=None) as client:
+        created = await asyncio.gather(*(
+            client.post('/campaigns', json={'name': f'benchmark {i}', 'book': 'benchmark', 'userId': 'benchmark'})
+            for i in range(args.campaigns or args.concurrency)
+        ))
+        campaign_ids = [response.json()['id'] for response in created]
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies, errors = [], 0
+
+        async def turn(i):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                campaign_id = campaign_ids[i % len(campaign_ids)]
+                response = await client.post(f'/campaigns/{campaign_id}/chats', json={'input': f'turn {i}'})
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(turn(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        for campaign_id in campaign_ids:
+            await client.delete(f'/campaigns/{campaign_id}')
+    return latencies, errors, elapsed
+
+
+def run_modes(args):
+    """
+    Runs the load against each mode in turn and prints a line of results per mode.
+    """
+    print(f"{'mode':<6} {'ok':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8}")
+    for mode in args.modes.split(','):
+        port = free_port()
+        server = start_server(mode, port, args)
+        try:
+            latencies, errors, elapsed = asyncio.run(run_load(f'http://127.0.0.1:{port}', args))
+        finally:
+            server.terminate()
+            server.wait()
+        if not latencies:
+            print(f"{mode:<6} {0:>6} {errors:>6}")
+            continue
+        print(
+            f"{mode:<6} {len(latencies):>6} {errors:>6} "
+            f"{statistics.median(latencies):>8.3f} {percentile(latencies, 95):>8.3f} {percentile(latencies, 99):>8.3f} "
+            f"{len(latencies) / elapsed:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sync and async serving modes against the fake model.')
+    parser.add_argument('--api-key', default=os.environ.get('BENCH_API_KEY'), help='Existing API key to use, with its rate limits (default: a key without limits, seeded for the run)')
+    parser.add_argument('--modes', default='sync,async', help='Comma separated modes to run')
+    parser.add_argument('--concurrency', type=int, default=200, help='Chat turns in flight')
+    parser.add_argument('--requests', type=int, default=1000, help='Total chat turns per mode')
+    parser.add_argument('--campaigns', type=int, help='Campaigns the turns are spread over (default: --concurrency)')
+    parser.add_argument('--latency', type=float, default=1.0, help='Fake model latency in seconds')
+    parser.add_argument('--threads', type=int, default=16, help='Worker threads of the sync server')
+    args = parser.parse_args()
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit('DATABASE_URL is required.')
+
+    seeded = None
+    if not args.api_key:
+        seeded, args.api_key = seed_api_key(database_url)
+    try:
+        run_modes(args)
+    finally:
+        if seeded:
+            delete_api_key(database_url, seeded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Startup benchmark: what a new worker costs before it serves, from a fresh interpreter to its first answered
+# request. Each run is a new process importing api.py, calling create_app() and serving GET /campaigns through
+# the test client; with --fork it also forks a worker after create_app(), as `gunicorn --preload` does, and times
+# the first request of that worker. Reports the median and p90 of each stage over --runs processes:
+#   python benchmarks/startup.py --runs 10 --fork
+#   python benchmarks/startup.py --database-url postgresql://localhost/roleplaychat_bench
+# The Google backend is imported by default (without calling the model), since that is what production pays.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import ROOT, TEST_API_KEY, sqlite_database
+
+from sqlalchemy import create_engine, text
+
+HEADERS = {'Authorization': f'Bearer {TEST_API_KEY}'}
+STAGES = ['import', 'create_app', 'first_request', 'total', 'process', 'fork_first_request']
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values (nearest rank).
+    """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def seed_api_key(database_url):
+    """
+    Adds the test API key to the database, without limits.
+    """
+    engine = create_engine(database_url)
+    with engine.begin() as connection:
+        if not connection.execute(text('SELECT id FROM "ApiKey" WHERE key = :key'), {'key': TEST_API_KEY}).first():
+            connection.execute(
+                text("""INSERT INTO "ApiKey" (id, key, "requestsPerMinute", "tokensPerMinute", "maxConcurrent")
+                        VALUES (:id, :key, 0, 0, 0)"""),
+                {'id': str(uuid.uuid4()), 'key': TEST_API_KEY}
+            )
+    engine.dispose()
+
+
+def first_request(app):
+    """
+    Serves GET /campaigns and returns its duration.
+    """
+    start = time.perf_counter()
+    response = app.test_client().get('/campaigns', headers=HEADERS)
+    # 204 while the key has no campaigns
+    assert response.status_code in (200, 204), response.status_code
+    return time.perf_counter() - start
+
+
+def child(fork):
+    """
+    Runs in the measured process: times the import, the app creation and the first request, and prints them.
+    """
+    start = time.perf_counter()
+    import api
+    imported = time.perf_counter()
+    app = api.create_app()
+    created = time.perf_counter()
+    timings = {}
+    if fork:
+        read, write = os.pipe()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(read)
+                os.write(write, json.dumps(time.perf_counter() - forked + first_request(app)).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            timings['fork_first_request'] = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+    served = first_request(app)
+    timings.update({
+        'import': imported - start, 'create_app': created - imported, 'first_request': served,
+        'total': created - start + served
+    })
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the startup of api.py up to its first request.')
+    parser.add_argument('--runs', type=int, default=10, help='Processes started')
+    parser.add_argument('--database-url', help='Migrated database to use instead of a fresh SQLite file')
+    parser.add_argument('--backend', default='google', help='GENAI_BACKEND of the workers (google or fake)')
+    parser.add_argument('--fork', action='store_true', help='Also time the first request of a forked worker')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.fork)
+
+    database_url = args.database_url or sqlite_database()
+    seed_api_key(database_url)
+    env = dict(
+        os.environ, API_KEY=os.environ.get('API_KEY', 'offline'), DATABASE_URL=database_url,
+        GENAI_BACKEND=args.backend, OPENING_POOL_DEPTH='0', LOG_LEVEL='WARNING'
+    )
+    command = [sys.executable, os.path.abspath(__file__), '--child'] + (['--fork'] if args.fork else [])
+    results = {stage: [] for stage in STAGES}
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        run = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True)
+        if run.returncode:
+            sys.exit(run.stderr)
+        output = run.stdout
+        results['process'].append(time.perf_counter() - start)
+        for stage, duration in json.loads(output.splitlines()[-1]).items():
+            results[stage].append(duration)
+
+    summary = {}
+    for stage in STAGES:
+        if results[stage]:
+            summary[stage] = {'p50': percentile(results[stage], 50), 'p90': percentile(results[stage], 90)}
+            print(f"{stage:>20}  p50 {summary[stage]['p50'] * 1000:7.1f}ms  p90 {summary[stage]['p90'] * 1000:7.1f}ms")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+# Request metrics of the roleplaychat backend, rendered in the Prometheus text format by GET /metrics.
+# Histograms and counters are kept in memory per process, without a client library: with several server
+# workers, each one exposes its own and Prometheus sums them.
+# The statistics of the request being handled (database queries) live in a context variable, so they follow
+# the request in its thread (api.py) and in its tasks (api_async.py), while background jobs are not counted in.
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Upper bounds of the histogram buckets: durations in seconds, and counts (e.g. queries per request)
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 34, 55)
+
+registry = []  # Metrics in the order they are rendered
+
+
+def escape(value):
+    """
+    Escapes a label value for the text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    """
+    Returns the {name="value",...} part of a sample, or an empty string without labels.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    """
+    Returns a sample value as the text format writes it.
+    """
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    A named metric with a value per combination of label values, registered for rendering.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}  # Label values -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.extend(self.samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as a number of tokens.
+    """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, key, value):
+        return [f'{self.name}{format_labels(self.labels, key)} {format_value(value)}']
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets, with their sum and count.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts = [count + (value <= bound) for count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = [
+            f'{self.name}_bucket{format_labels(self.labels, key, [("le", format_value(bound))])} {count}'
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}')
+        lines.append(f'{self.name}_count{format_labels(self.labels, key)} {counts[-1]}')
+        return lines
+
+
+def render():
+    """
+    Returns all the metrics in the Prometheus text format.
+    """
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+# --- METRICS ---
+
+REQUEST_DURATION = Histogram(
+    'roleplaychat_request_duration_seconds', 'Time to handle a request.', ('method', 'endpoint', 'status')
+)
+REQUEST_QUERIES = Histogram(
+    'roleplaychat_request_db_queries', 'Database queries run by a request.', ('endpoint',), COUNT_BUCKETS
+)
+STAGE_DURATION = Histogram(
+    'roleplaychat_stage_duration_seconds',
+    'Time spent in a stage of request handling (auth, history, generation, storage, summary).', ('stage',)
+)
+DB_QUERY_DURATION = Histogram('roleplaychat_db_query_duration_seconds', 'Time to run a database query.')
+DB_POOL_WAIT = Histogram('roleplaychat_db_pool_wait_seconds', 'Time waiting for a database connection from the pool.')
+MODEL_TOKENS = Counter(
+    'roleplaychat_model_tokens_total', 'Estimated model tokens sent (in) and generated (out).', ('model', 'direction')
+)
+MODEL_CALLS = Counter(
+    'roleplaychat_model_calls_total', 'Model requests by route, model and outcome (ok, error), hedges and retries included.',
+    ('route', 'model', 'outcome')
+)
+MODEL_HEDGES = Counter('roleplaychat_model_hedges_total', 'Duplicate model requests sent for slow attempts.', ('route', 'model'))
+MODEL_TIMEOUTS = Counter('roleplaychat_model_timeouts_total', 'Model attempts abandoned after their timeout.', ('route', 'model'))
+
+
+# --- REQUEST STATISTICS ---
+
+class RequestStats:
+    """
+    Statistics of the request being handled.
+    """
+    __slots__ = ('start', 'queries')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+
+
+current_request = ContextVar('current_request', default=None)
+
+
+def start_request():
+    """
+    Starts collecting the statistics of a request in the current context, and returns them.
+    """
+    stats = RequestStats()
+    current_request.set(stats)
+    return stats
+
+
+def finish_request(stats, method, endpoint, status):
+    """
+    Records the duration and query count of a finished request.
+    """
+    endpoint = endpoint or 'unknown'
+    REQUEST_DURATION.observe(time.perf_counter() - stats.start, method=method, endpoint=endpoint, status=status)
+    REQUEST_QUERIES.observe(stats.queries, endpoint=endpoint)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Records the time spent in the block (or decorated function) as a stage of request handling.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - start, stage=stage)
+
+
+def count_model_tokens(model, tokens_in, tokens_out):
+    """
+    Records the estimated tokens of a model call.
+    """
+    MODEL_TOKENS.inc(tokens_in, model=model, direction='in')
+    MODEL_TOKENS.inc(tokens_out, model=model, direction='out')
+
+
+def instrument_engine(engine):
+    """
+    Times the queries of a (sync) SQLAlchemy engine and its connection pool checkouts, and counts the queries
+    of the current request. For an async engine, pass its sync_engine.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_DURATION.observe(time.perf_counter() - conn.info['query_start'].pop())
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('query_start'):
+            context.connection.info['query_start'].pop()
+
+    instrument_pool(engine)
+
+
+def instrument_pool(engine):
+    """
+    Times the connection pool checkouts of a (sync) SQLAlchemy engine. Called again when the engine gets a new
+    pool, e.g. after dispose().
+    """
+    # The pool has no event before a checkout, so its public connect() is timed instead
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - start)
+
+    pool.connect = timed_connect
@@ -0,0 +1,4 @@
+-- Supports the windowed history queries of campaign_chat, which read the oldest
+-- and the most recent chat rows of a single campaign.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "Chat_campaignId_createdAt_idx"
+    ON "Chat" ("campaignId", "createdAt");
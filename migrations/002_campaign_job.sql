@@ -0,0 +1,12 @@
+-- Durable queue of background work per campaign (e.g. history summaries).
+-- A campaign has at most one job of each kind, which makes enqueuing idempotent.
+CREATE TABLE IF NOT EXISTS "CampaignJob" (
+    "campaignId" UUID NOT NULL REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY ("campaignId", kind)
+);
+
+CREATE INDEX IF NOT EXISTS "CampaignJob_status_idx" ON "CampaignJob" (status);
@@ -0,0 +1,34 @@
+-- Campaign prompts are stored once, keyed by the SHA-256 of their content, and referenced by campaigns.
+-- The prompt is sent as the model system instruction, so it is no longer copied as the first chat of every campaign.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS "Prompt" (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE "Campaign" ADD COLUMN IF NOT EXISTS "promptHash" TEXT REFERENCES "Prompt"(hash);
+ALTER TABLE "Campaign" ALTER COLUMN prompt DROP NOT NULL;
+
+-- Move the prompts copied in every campaign into "Prompt", one row per distinct content
+INSERT INTO "Prompt" (hash, content)
+SELECT DISTINCT encode(sha256(convert_to(prompt, 'UTF8')), 'hex'), prompt
+FROM "Campaign"
+WHERE prompt IS NOT NULL
+ON CONFLICT (hash) DO NOTHING;
+
+UPDATE "Campaign"
+SET "promptHash" = encode(sha256(convert_to(prompt, 'UTF8')), 'hex'), prompt = NULL
+WHERE prompt IS NOT NULL;
+
+-- Drop the copy of the default prompt stored as the first chat of every campaign
+DELETE FROM "Chat"
+WHERE response = 'Understood'
+AND id IN (
+    SELECT DISTINCT ON ("campaignId") id
+    FROM "Chat"
+    ORDER BY "campaignId", "createdAt" ASC, id ASC
+);
+
+COMMIT;
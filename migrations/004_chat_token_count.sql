@@ -0,0 +1,3 @@
+-- Estimated model tokens of each chat row (message and response), computed once when the row is written.
+-- Rows written before this migration keep NULL and are estimated when read.
+ALTER TABLE "Chat" ADD COLUMN IF NOT EXISTS "tokenCount" INTEGER;
@@ -0,0 +1,7 @@
+-- Leases serializing the chat turns of a campaign across server workers.
+-- A row exists while a turn is in progress; an expired lease can be taken over.
+CREATE TABLE IF NOT EXISTS "TurnLock" (
+    "campaignId" UUID PRIMARY KEY REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    token TEXT NOT NULL,
+    "expiresAt" TIMESTAMP(3) NOT NULL
+);
@@ -0,0 +1,11 @@
+-- Opening messages generated ahead of time, per prompt and model, and taken by new campaigns.
+-- Rows are deleted when taken or once older than OPENING_POOL_TTL.
+CREATE TABLE IF NOT EXISTS "OpeningPool" (
+    id SERIAL PRIMARY KEY,
+    "promptHash" TEXT NOT NULL,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS "OpeningPool_promptHash_model_createdAt_idx" ON "OpeningPool" ("promptHash", model, "createdAt");
@@ -0,0 +1,16 @@
+-- Requests sent with an Idempotency-Key header, per API key. A row is 'running' while the first request
+-- is in progress and 'done' with its stored response afterwards; expired rows can be taken over or deleted.
+CREATE TABLE IF NOT EXISTS "IdempotencyKey" (
+    "apiKeyId" UUID NOT NULL REFERENCES "ApiKey"(id) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    "statusCode" INTEGER,
+    body TEXT,
+    headers TEXT,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "expiresAt" TIMESTAMP(3) NOT NULL,
+    PRIMARY KEY ("apiKeyId", key)
+);
+
+CREATE INDEX IF NOT EXISTS "IdempotencyKey_expiresAt_idx" ON "IdempotencyKey" ("expiresAt");
@@ -0,0 +1,17 @@
+-- Per API key rate limits. NULL uses the server default (RATE_LIMIT_* variables), 0 disables the limit.
+-- "RateLimitBucket" holds the token buckets shared by all workers when RATE_LIMIT_BACKEND=database.
+BEGIN;
+
+ALTER TABLE "ApiKey" ADD COLUMN IF NOT EXISTS "requestsPerMinute" INTEGER;
+ALTER TABLE "ApiKey" ADD COLUMN IF NOT EXISTS "tokensPerMinute" INTEGER;
+ALTER TABLE "ApiKey" ADD COLUMN IF NOT EXISTS "maxConcurrent" INTEGER;
+
+CREATE TABLE IF NOT EXISTS "RateLimitBucket" (
+    "apiKeyId" UUID NOT NULL REFERENCES "ApiKey"(id) ON DELETE CASCADE,
+    bucket TEXT NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    "updatedAt" DOUBLE PRECISION NOT NULL,  -- Unix time in seconds
+    PRIMARY KEY ("apiKeyId", bucket)
+);
+
+COMMIT;
@@ -0,0 +1,15 @@
+-- Chat turns folded into a summary, moved out of "Chat" by storeSummary and keeping their id.
+-- Searched (through an in-memory index per campaign) for turns relevant to a new message.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS "ChatArchive" (
+    id INTEGER PRIMARY KEY,
+    "campaignId" UUID NOT NULL REFERENCES "Campaign"(id) ON DELETE CASCADE,
+    message TEXT NOT NULL,
+    response TEXT NOT NULL,
+    "createdAt" TIMESTAMP(3) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "ChatArchive_campaignId_id_idx" ON "ChatArchive" ("campaignId", id);
+
+COMMIT;
@@ -0,0 +1,4 @@
+-- Supports the keyset pages of GET /campaigns, which read the campaigns of an API key
+-- ordered by ("createdAt", id) after a cursor.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "Campaign_apiKeyId_createdAt_idx"
+    ON "Campaign" ("apiKeyId", "createdAt", id);
@@ -0,0 +1,4 @@
+-- Supports the ETag of GET /chats, which reads the latest id of a campaign's chat rows
+-- from the end of this index instead of counting them.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS "Chat_campaignId_id_idx"
+    ON "Chat" ("campaignId", id);
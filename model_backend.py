@@ -0,0 +1,806 @@
+# Model backends of the API, selected with GENAI_BACKEND.
+# A backend is any object exposing the small part of the genai.Client interface used by api.py and api_async.py:
+# client.models.generate_content(model, contents, config) and client.models.generate_content_stream(...),
+# client.caches.create(model, config) and client.caches.delete(name), plus the same methods awaitable on
+# client.aio. New backends are added with register_backend.
+# The 'fake' backend is a deterministic local stand-in, used to run the API offline (tests, benchmarks, development).
+# ContextCache registers the system instruction (prompt) of a context with the backend once and references it afterwards.
+# ModelRouter makes the model calls of each route (chat, summary, opening) with a deadline, retries, hedging
+# and a fallback model.
+import asyncio
+import hashlib
+import math
+import random
+import threading
+import time
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+from google.genai import types
+
+from metrics import MODEL_CALLS, MODEL_HEDGES, MODEL_TIMEOUTS
+
+
+def content_text(content):
+    """
+    Returns the text of a content, or of a plain string (system instructions may be either).
+    """
+    if content is None:
+        return ''
+    if isinstance(content, str):
+        return content
+    return ''.join(part.text or '' for part in content.parts)
+
+def last_user_text(contents):
+    """
+    Returns the text of the last user message of the contents, or '' if there is none.
+    """
+    for content in reversed(contents or []):
+        if content.role == 'user':
+            return content_text(content)
+    return ''
+
+
+class FakeModelError(Exception):
+    """
+    Error of a fake model call, like a server error of the real API.
+    """
+    code = 503
+
+
+class FakeModels:
+    """
+    Deterministic replacement for client.models.
+    Each response depends only on the last user message, and is split into word chunks when streamed.
+    The bytes of context sent with each request are counted, so prefix caching can be measured offline.
+    """
+
+    def __init__(self, latency=0.0, chunk_delay=0.0, words=40, failure=None):
+        self.latency = latency  # Seconds before the first token, or a function returning them (e.g. a random distribution)
+        self.chunk_delay = chunk_delay  # Seconds between two streamed chunks
+        self.words = words  # Number of words of each response
+        self.failure = failure  # Function of the model name returning True when a call should fail (e.g. a random draw)
+        self.caches = {}  # Cache name -> (system instruction, contents, expiry)
+        self.bytes_sent = 0  # Bytes of system instructions and contents received, including cache creations
+        self.lock = threading.Lock()
+
+    def receive(self, contents, config):
+        """
+        Counts the bytes of a request and returns its full contents, with the cached prefix it references.
+        Raises LookupError if the referenced cache does not exist or expired, like the real API.
+        """
+        name = getattr(config, 'cached_content', None)
+        sent = sum(len(content_text(content).encode()) for content in contents or [])
+        if name is None:
+            sent += len(content_text(getattr(config, 'system_instruction', None)).encode())
+        with self.lock:
+            self.bytes_sent += sent
+            cached = self.caches.get(name) if name else None
+        if name is None:
+            return contents
+        if cached is None or cached[2] < time.monotonic():
+            raise LookupError(f"Cached content {name} not found")
+        return cached[1] + list(contents)
+
+    def delay(self, model):
+        """
+        Returns the seconds to wait before the first token of a response.
+        Raises FakeModelError instead if the call should fail.
+        """
+        if self.failure and self.failure(model):
+            raise FakeModelError(f"{model} is unavailable")
+        return self.latency() if callable(self.latency) else self.latency
+
+    def reply(self, contents):
+        """
+        Builds the response text for the given contents.
+        """
+        prompt = last_user_text(contents)[:80]
+        filler = ' '.join(f'word{i}' for i in range(self.words))
+        return f'The game master answers "{prompt}": {filler}.'
+
+    def generate_content(self, model, contents, config=None):
+        contents = self.receive(contents, config)
+        time.sleep(self.delay(model) + self.chunk_delay * self.words)
+        return SimpleNamespace(text=self.reply(contents))
+
+    def generate_content_stream(self, model, contents, config=None):
+        contents = self.receive(contents, config)
+        time.sleep(self.delay(model))
+        words = self.reply(contents).split(' ')
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.chunk_delay)
+            yield SimpleNamespace(text=word if i == 0 else ' ' + word)
+
+
+class AsyncFakeModels:
+    """
+    Asynchronous counterpart of FakeModels, replacing client.aio.models.
+    Waiting is done with asyncio.sleep, so concurrent calls do not block each other.
+    """
+
+    def __init__(self, models):
+        self.sync = models
+
+    async def generate_content(self, model, contents, config=None):
+        contents = self.sync.receive(contents, config)
+        await asyncio.sleep(self.sync.delay(model) + self.sync.chunk_delay * self.sync.words)
+        return SimpleNamespace(text=self.sync.reply(contents))
+
+    async def generate_content_stream(self, model, contents, config=None):
+        contents = self.sync.receive(contents, config)
+
+        async def stream():
+            await asyncio.sleep(self.sync.delay(model))
+            words = self.sync.reply(contents).split(' ')
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(self.sync.chunk_delay)
+                yield SimpleNamespace(text=word if i == 0 else ' ' + word)
+        return stream()
+
+
+class FakeCaches:
+    """
+    Replacement for client.caches, storing the cached prefixes in the FakeModels they are used with.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.created = 0
+
+    def create(self, model, config):
+        contents = list(config.contents or [])
+        ttl = float(str(config.ttl or '3600s').rstrip('s'))
+        with self.models.lock:
+            self.created += 1
+            name = f'cachedContents/fake-{self.created}'
+            self.models.caches[name] = (config.system_instruction, contents, time.monotonic() + ttl)
+            self.models.bytes_sent += len(content_text(config.system_instruction).encode())
+            self.models.bytes_sent += sum(len(content_text(content).encode()) for content in contents)
+        return SimpleNamespace(name=name)
+
+    def delete(self, name, config=None):
+        with self.models.lock:
+            self.models.caches.pop(name, None)
+
+
+class AsyncFakeCaches:
+    """
+    Asynchronous counterpart of FakeCaches, replacing client.aio.caches.
+    """
+
+    def __init__(self, caches):
+        self.sync = caches
+
+    async def create(self, model, config):
+        return self.sync.create(model=model, config=config)
+
+    async def delete(self, name, config=None):
+        self.sync.delete(name)
+
+
+class FakeClient:
+    """
+    Drop-in replacement for genai.Client backed by FakeModels.
+    """
+
+    def __init__(self, latency=0.0, chunk_delay=0.0, words=40, failure=None):
+        self.models = FakeModels(latency=latency, chunk_delay=chunk_delay, words=words, failure=failure)
+        self.caches = FakeCaches(self.models)
+        self.aio = SimpleNamespace(models=AsyncFakeModels(self.models), caches=AsyncFakeCaches(self.caches))
+
+
+# --- CONTEXT CACHE ---
+
+class ContextCache:
+    """
+    Sends the prefix of a request to the backend's context cache once per model, and references it in later
+    requests so only the rest of the contents is sent. The prefix is the system instruction (e.g. the campaign
+    prompt) followed by the first contents of the request the caller marks as stable, such as the opening and
+    summary of a campaign: those are cached per owner (the campaign) and dropped with invalidate once they change.
+    Without stable contents the cache of a system instruction is shared by every request using it.
+    One request creates the cache of a prefix, concurrent ones send in full meanwhile. Any cache error falls
+    back to a full send.
+    """
+
+    def __init__(self, get_client, ttl=600, min_tokens=1024, estimate=None, max_entries=1024):
+        self.get_client = get_client  # Returns the backend client, looked up on each call so it can be swapped
+        self.ttl = ttl  # Seconds a prefix stays cached, 0 disables caching
+        self.min_tokens = min_tokens  # Smaller prefixes are sent in full (the backend has a minimum)
+        self.estimate = estimate or (lambda text: len(text) // 4)  # Token estimate of a text
+        self.max_entries = max_entries
+        self.entries = {}  # Prefix key -> (cache name, expiry, owner)
+        self.creating = set()  # Prefix keys whose cache is being created
+        self.lock = threading.Lock()
+
+    def prefix_text(self, config, head):
+        """
+        Returns the text of a prefix: the system instruction and the stable contents, with their roles.
+        """
+        return content_text(config.system_instruction) + ''.join(f"\n{content.role}: {content_text(content)}" for content in head)
+
+    def prefix_key(self, model, config, head=()):
+        """
+        Returns the key identifying a prefix, from the model and the exact text of the prefix.
+        """
+        return hashlib.sha256(f"{model}|{self.prefix_text(config, head)}".encode()).hexdigest()
+
+    def lookup(self, model, config, head=()):
+        """
+        Returns (key, cache name) for the prefix of the request, the name being None if the caller is to create
+        the cache, or None if the prefix is not worth caching or its cache is being created by another request.
+        """
+        if not self.ttl or config is None or (config.system_instruction is None and not head):
+            return None
+        if self.estimate(self.prefix_text(config, head)) < self.min_tokens:
+            return None
+        key = self.prefix_key(model, config, head)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] < time.monotonic():
+                self.entries.pop(key)
+                entry = None
+            if entry:
+                return key, entry[0]
+            if key in self.creating:
+                return None
+            self.creating.add(key)
+        return key, None
+
+    def store(self, key, name, owner=None):
+        """
+        Remembers the cache created for a prefix, expiring it locally a little before the backend does.
+        Deletes the cache it evicts, if any.
+        """
+        evicted = None
+        with self.lock:
+            self.creating.discard(key)
+            if key not in self.entries and len(self.entries) >= self.max_entries:
+                evicted = self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = (name, time.monotonic() + self.ttl * 0.9, owner)
+        if evicted:
+            self.delete(evicted[0])
+
+    def abandon(self, key):
+        """
+        Lets another request create the cache of a prefix, after a failed creation.
+        """
+        with self.lock:
+            self.creating.discard(key)
+
+    def forget(self, key):
+        """
+        Drops a cached prefix the backend no longer knows.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, owner):
+        """
+        Drops and deletes the cached prefixes of an owner, once its stable contents changed (e.g. a new summary).
+        """
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if entry[2] == owner]
+            names = [self.entries.pop(key)[0] for key in keys]
+        for name in names:
+            self.delete(name)
+
+    def delete(self, name):
+        """
+        Deletes a cache from the backend.
+        """
+        try:
+            self.get_client().caches.delete(name=name)
+        except Exception:
+            pass  # The cache expires on its own
+
+    def cache_config(self, config, head):
+        """
+        Returns the config creating the cache of a request prefix.
+        """
+        return types.CreateCachedContentConfig(
+            system_instruction=config.system_instruction, contents=list(head) or None, ttl=f'{int(self.ttl)}s'
+        )
+
+    def cached_config(self, config, name):
+        """
+        Returns the config of a request referencing a cached prefix, keeping its other settings.
+        """
+        return config.model_copy(update={'system_instruction': None, 'cached_content': name})
+
+    def prepare(self, model, config, head=(), owner=None):
+        """
+        Returns (key, config) of a request: a config referencing the cached prefix, or the config unchanged
+        (key None) when the prefix is not cached.
+        """
+        found = self.lookup(model, config, head)
+        if found is None:
+            return None, config
+        key, name = found
+        if name is None:
+            try:
+                name = self.get_client().caches.create(model=model, config=self.cache_config(config, head)).name
+            except Exception:
+                self.abandon(key)
+                return None, config
+            self.store(key, name, owner)
+        return key, self.cached_config(config, name)
+
+    async def prepare_async(self, model, config, head=(), owner=None):
+        """
+        Asynchronous counterpart of prepare, creating the cache with client.aio.
+        """
+        found = self.lookup(model, config, head)
+        if found is None:
+            return None, config
+        key, name = found
+        if name is None:
+            try:
+                name = (await self.get_client().aio.caches.create(model=model, config=self.cache_config(config, head))).name
+            except Exception:
+                self.abandon(key)
+                return None, config
+            except BaseException:
+                # Cancelled (e.g. a hedged attempt that lost), another request can create the cache
+                self.abandon(key)
+                raise
+            self.store(key, name, owner)
+        return key, self.cached_config(config, name)
+
+    def generate_content(self, model, contents, config, prefix=0, owner=None):
+        """
+        client.models.generate_content with the prefix served from the cache: the system instruction and the
+        first prefix contents, which belong to owner.
+        """
+        key, cached_config = self.prepare(model, config, contents[:prefix], owner)
+        if key is not None:
+            try:
+                return self.get_client().models.generate_content(model=model, contents=contents[prefix:], config=cached_config)
+            except Exception:
+                self.forget(key)
+        return self.get_client().models.generate_content(model=model, contents=contents, config=config)
+
+    def generate_content_stream(self, model, contents, config, prefix=0, owner=None):
+        """
+        client.models.generate_content_stream with the prefix served from the cache, see generate_content.
+        Falls back to a full send if the cached request fails before its first chunk.
+        """
+        key, cached_config = self.prepare(model, config, contents[:prefix], owner)
+        if key is not None:
+            try:
+                stream = iter(self.get_client().models.generate_content_stream(model=model, contents=contents[prefix:], config=cached_config))
+                first = next(stream, None)
+            except Exception:
+                self.forget(key)
+            else:
+                if first is not None:
+                    yield first
+                yield from stream
+                return
+        yield from self.get_client().models.generate_content_stream(model=model, contents=contents, config=config)
+
+    async def generate_content_async(self, model, contents, config, prefix=0, owner=None):
+        """
+        client.aio.models.generate_content with the prefix served from the cache, see generate_content.
+        """
+        key, cached_config = await self.prepare_async(model, config, contents[:prefix], owner)
+        if key is not None:
+            try:
+                return await self.get_client().aio.models.generate_content(model=model, contents=contents[prefix:], config=cached_config)
+            except Exception:
+                self.forget(key)
+        return await self.get_client().aio.models.generate_content(model=model, contents=contents, config=config)
+
+    async def generate_content_stream_async(self, model, contents, config, prefix=0, owner=None):
+        """
+        client.aio.models.generate_content_stream with the prefix served from the cache, see generate_content.
+        """
+        key, cached_config = await self.prepare_async(model, config, contents[:prefix], owner)
+        if key is not None:
+            try:
+                stream = await self.get_client().aio.models.generate_content_stream(model=model, contents=contents[prefix:], config=cached_config)
+                first = await anext(stream, None)
+            except Exception:
+                self.forget(key)
+            else:
+                if first is not None:
+                    yield first
+                async for chunk in stream:
+                    yield chunk
+                return
+        async for chunk in await self.get_client().aio.models.generate_content_stream(model=model, contents=contents, config=config):
+            yield chunk
+
+
+# --- MODEL ROUTER ---
+
+class ModelUnavailable(Exception):
+    """
+    Raised when no model of a route answered, every attempt having failed.
+    """
+
+
+class ModelTimeout(ModelUnavailable):
+    """
+    Raised when the deadline of a route passed before a model answered.
+    """
+
+
+class AttemptTimeout(Exception):
+    """
+    Raised when an attempt did not answer within the timeout of its route.
+    """
+
+
+def retryable(error):
+    """
+    Returns False for the errors a retry of the same model cannot fix, i.e. client errors of the API
+    (4xx) other than timeouts and rate limits.
+    """
+    code = getattr(error, 'code', None)
+    return not (isinstance(code, int) and 400 <= code < 500 and code not in (408, 429))
+
+
+class Route:
+    """
+    How the model calls of a route (e.g. chat) are made. A call tries `model` up to `attempts` times, then
+    `fallback` as many times, each attempt abandoned after `timeout` seconds and retried after a jittered
+    exponential backoff, all within `deadline` seconds. With `hedge`, a duplicate request is sent when an
+    attempt is slower than the p95 latency of the model on this route (`hedge_delay` seconds until enough
+    latencies are known), and the first answer wins.
+    """
+
+    def __init__(self, model, fallback=None, deadline=60.0, timeout=30.0, attempts=2, backoff=0.25,
+                 backoff_max=2.0, hedge=False, hedge_delay=2.0):
+        self.model = model
+        self.fallback = fallback
+        self.deadline = deadline
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+
+    def models(self):
+        """
+        Returns the models to try in order.
+        """
+        return [self.model] + ([self.fallback] if self.fallback and self.fallback != self.model else [])
+
+    def retry_delay(self, attempt):
+        """
+        Returns the seconds to wait before the given retry (1 for the first), with full jitter.
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** (attempt - 1)))
+
+
+class StartedStream:
+    """
+    A streamed response whose first chunk has been received, iterating over all its chunks.
+    """
+
+    def __init__(self, stream):
+        self.stream = iter(stream)
+        self.first = next(self.stream, None)
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        yield from self.stream
+
+    def close(self):
+        close = getattr(self.stream, 'close', None)
+        if close:
+            close()
+
+
+class AsyncStartedStream:
+    """
+    Asynchronous counterpart of StartedStream, created with `await AsyncStartedStream.start(stream)`.
+    """
+
+    def __init__(self, stream, first):
+        self.stream = stream
+        self.first = first
+
+    @classmethod
+    async def start(cls, stream):
+        stream = await stream if asyncio.iscoroutine(stream) else stream
+        return cls(stream, await anext(stream, None))
+
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.stream:
+            yield chunk
+
+    async def close(self):
+        close = getattr(self.stream, 'aclose', None)
+        if close:
+            await close()
+
+
+class ModelRouter:
+    """
+    Makes the model calls of named routes according to their Route. The caller passes a function of the
+    model name making one request (e.g. through the ContextCache), which may run several times: retries,
+    hedges and the fallback. Synchronous calls run on a thread pool so they can be abandoned; an abandoned
+    call keeps its thread until the backend answers, and its answer is discarded.
+    """
+
+    def __init__(self, routes, workers=64, window=1000, min_samples=20):
+        self.routes = routes  # Route name -> Route
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='model')  # Threads start on first use
+        self.window = window  # Latencies kept per route and model for the hedge delay
+        self.min_samples = min_samples  # Latencies needed before the p95 is trusted
+        self.latencies = {}  # (route, model) -> latencies of the recent successful calls
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        """
+        Replaces the thread pool and lock inherited from the parent of a forked process, whose threads do not
+        exist in the child.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='model')
+        self.lock = threading.Lock()
+
+    def observe(self, route, model, latency):
+        with self.lock:
+            self.latencies.setdefault((route, model), deque(maxlen=self.window)).append(latency)
+
+    def hedge_delay(self, route, model):
+        """
+        Returns the seconds after which an attempt of the model is hedged: the p95 of its recent latencies.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies.get((route, model), ()))
+        if len(latencies) < self.min_samples:
+            return self.routes[route].hedge_delay
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def measured(self, route, model, start):
+        """
+        Returns a function running start(model) and recording its outcome and latency.
+        """
+        def call():
+            begin = time.monotonic()
+            try:
+                result = start(model)
+            except Exception:
+                MODEL_CALLS.inc(route=route, model=model, outcome='error')
+                raise
+            self.observe(route, model, time.monotonic() - begin)
+            MODEL_CALLS.inc(route=route, model=model, outcome='ok')
+            return result
+        return call
+
+    def submit(self, call):
+        """
+        Runs a call on the thread pool, or in the calling thread once the interpreter is exiting
+        (e.g. a background job finishing at shutdown), then without timeout or hedging.
+        """
+        try:
+            return self.executor.submit(call)
+        except RuntimeError:
+            future = Future()
+            try:
+                future.set_result(call())
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+    def run(self, route, start):
+        """
+        Calls start(model) for the models of the route, with retries, hedging and the deadline.
+        Returns (result, model), raises ModelTimeout or ModelUnavailable.
+        """
+        config = self.routes[route]
+        deadline = time.monotonic() + config.deadline
+        error = None
+        for model in config.models():
+            for attempt in range(config.attempts):
+                if attempt:
+                    time.sleep(min(config.retry_delay(attempt), max(0.0, deadline - time.monotonic())))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ModelTimeout(f"No answer from the {route} model within {config.deadline}s") from error
+                try:
+                    return self.attempt(route, model, start, min(config.timeout, remaining)), model
+                except Exception as e:
+                    error = e
+                    if not retryable(e):
+                        break
+        if isinstance(error, AttemptTimeout):
+            raise ModelTimeout(f"No answer from the {route} model within {config.deadline}s") from error
+        raise ModelUnavailable(f"The {route} model is unavailable: {error}") from error
+
+    def attempt(self, route, model, start, timeout):
+        """
+        Runs start(model) once, hedged if the route asks for it, and returns the first successful result.
+        """
+        config = self.routes[route]
+        begin = time.monotonic()
+        hedge_at = begin + self.hedge_delay(route, model) if config.hedge else math.inf
+        end = begin + timeout
+        pending = {self.submit(self.measured(route, model, start))}
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, min(end, hedge_at) - time.monotonic()), return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                self.discard((done - {winner}) | pending)
+                return winner.result()
+            if done:
+                error = next(iter(done)).exception()
+                continue
+            if time.monotonic() >= end:
+                self.discard(pending)
+                MODEL_TIMEOUTS.inc(route=route, model=model)
+                raise AttemptTimeout(f"{model} did not answer within {timeout:.1f}s")
+            if time.monotonic() >= hedge_at:
+                hedge_at = math.inf
+                MODEL_HEDGES.inc(route=route, model=model)
+                pending.add(self.submit(self.measured(route, model, start)))
+        raise error
+
+    @staticmethod
+    def discard(futures):
+        """
+        Abandons calls whose result is not needed, closing it (e.g. a stream) whenever it arrives.
+        """
+        def close(future):
+            if not future.cancelled() and future.exception() is None:
+                close = getattr(future.result(), 'close', None)
+                if close:
+                    close()
+        for future in futures:
+            future.cancel()
+            future.add_done_callback(close)
+
+    def generate(self, route, call):
+        """
+        Returns (response, model) of call(model), e.g. a generate_content request.
+        """
+        return self.run(route, call)
+
+    def stream(self, route, call):
+        """
+        Returns (chunks, model) of call(model), a streamed request. Retries and hedges only happen before
+        the first chunk; an error after it reaches the caller.
+        """
+        return self.run(route, lambda model: StartedStream(call(model)))
+
+    def measured_async(self, route, model, start):
+        async def call():
+            begin = time.monotonic()
+            try:
+                result = await start(model)
+            except Exception:
+                MODEL_CALLS.inc(route=route, model=model, outcome='error')
+                raise
+            self.observe(route, model, time.monotonic() - begin)
+            MODEL_CALLS.inc(route=route, model=model, outcome='ok')
+            return result
+        return call()
+
+    async def run_async(self, route, start):
+        """
+        Asynchronous counterpart of run, with start(model) returning an awaitable.
+        """
+        config = self.routes[route]
+        deadline = time.monotonic() + config.deadline
+        error = None
+        for model in config.models():
+            for attempt in range(config.attempts):
+                if attempt:
+                    await asyncio.sleep(min(config.retry_delay(attempt), max(0.0, deadline - time.monotonic())))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ModelTimeout(f"No answer from the {route} model within {config.deadline}s") from error
+                try:
+                    return await self.attempt_async(route, model, start, min(config.timeout, remaining)), model
+                except Exception as e:
+                    error = e
+                    if not retryable(e):
+                        break
+        if isinstance(error, AttemptTimeout):
+            raise ModelTimeout(f"No answer from the {route} model within {config.deadline}s") from error
+        raise ModelUnavailable(f"The {route} model is unavailable: {error}") from error
+
+    async def attempt_async(self, route, model, start, timeout):
+        """
+        Asynchronous counterpart of attempt, cancelling the calls that lost or timed out.
+        """
+        config = self.routes[route]
+        begin = time.monotonic()
+        hedge_at = begin + self.hedge_delay(route, model) if config.hedge else math.inf
+        end = begin + timeout
+        pending = {asyncio.ensure_future(self.measured_async(route, model, start))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, min(end, hedge_at) - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    for task in done - {winner}:
+                        await self.close_async(task.result())
+                    return winner.result()
+                if done:
+                    error = next(iter(done)).exception()
+                    continue
+                if time.monotonic() >= end:
+                    MODEL_TIMEOUTS.inc(route=route, model=model)
+                    raise AttemptTimeout(f"{model} did not answer within {timeout:.1f}s")
+                if time.monotonic() >= hedge_at:
+                    hedge_at = math.inf
+                    MODEL_HEDGES.inc(route=route, model=model)
+                    pending.add(asyncio.ensure_future(self.measured_async(route, model, start)))
+            raise error
+        finally:
+            # Also when the request itself is cancelled (client gone)
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    async def close_async(result):
+        close = getattr(result, 'close', None)
+        if close:
+            await close()
+
+    async def generate_async(self, route, call):
+        """
+        Asynchronous counterpart of generate, with call(model) returning an awaitable.
+        """
+        return await self.run_async(route, call)
+
+    async def stream_async(self, route, call):
+        """
+        Asynchronous counterpart of stream, with call(model) returning an async iterator (or an awaitable of one).
+        """
+        return await self.run_async(route, lambda model: AsyncStartedStream.start(call(model)))
+
+
+# --- BACKENDS ---
+
+BACKENDS = {}  # Name -> function(api_key) returning a client
+
+def register_backend(name, factory):
+    """
+    Makes a model backend available under a GENAI_BACKEND name.
+    """
+    BACKENDS[name] = factory
+
+def create_client(name, api_key):
+    """
+    Returns the client of the named backend, raises ValueError for an unknown name.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown GENAI_BACKEND: {name} (available: {', '.join(sorted(BACKENDS))})")
+    return BACKENDS[name](api_key)
+
+def google_client(api_key):
+    """
+    Returns the Google GenAI client.
+    """
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+def fake_client(api_key):
+    """
+    Returns the fake client, configured by FAKE_MODEL_LATENCY, FAKE_MODEL_CHUNK_DELAY and FAKE_MODEL_ERROR_RATE.
+    """
+    error_rate = float(os.environ.get('FAKE_MODEL_ERROR_RATE', 0))
+    return FakeClient(
+        latency=float(os.environ.get('FAKE_MODEL_LATENCY', 0)),
+        chunk_delay=float(os.environ.get('FAKE_MODEL_CHUNK_DELAY', 0)),
+        failure=(lambda model: random.random() < error_rate) if error_rate else None
+    )
+
+register_backend('google', google_client)
+register_backend('fake', fake_client)
@@ -0,0 +1,96 @@
+# Local lexical retrieval over the archived chat turns of a campaign, without any external service.
+# ArchiveIndex is a BM25 inverted index kept in memory and extended as turns are archived. Its postings are
+# compact arrays (document numbers and precomputed term weights), so a query only adds up a few short arrays:
+# terms found in a large share of the documents carry almost no weight and are skipped.
+import heapq
+import math
+import re
+import threading
+from array import array
+from collections import Counter
+
+# Words of a text, the units of the index
+WORD_PATTERN = re.compile(r"[^\W_]+")
+# Frequent English words, not indexed
+STOPWORDS = frozenset("""
+    a about above after again against all am an and any are as at be because been before being below between both but
+    by can could did do does doing down during each few for from further had has have having he her here hers herself
+    him himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or
+    other our ours ourselves out over own same she should so some such than that the their theirs them themselves then
+    there these they this those through to too under until up very was we were what when where which while who whom why
+    will with would you your yours yourself yourselves
+""".split())
+
+
+def tokenize(text):
+    """
+    Returns the indexed terms of a text: lowercase words of at least 2 characters, stopwords excluded.
+    """
+    return [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+
+class ArchiveIndex:
+    """
+    BM25 index of archived turns, searched with the text of a new message.
+    Documents are added in increasing id order; last_id is the highest one, to catch up from, and documents
+    up to it are ignored if added again (by turns catching up concurrently).
+    """
+
+    def __init__(self, k1=1.2, b=0.75, max_df=0.05, min_skipped=1000, max_terms=16):
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df  # Share of the documents above which a term is skipped by queries...
+        self.min_skipped = min_skipped  # ...once it is in more documents than this
+        self.max_terms = max_terms  # Query terms used at most, the rarest ones
+        self.ids = array('q')  # Document number -> archived chat id
+        self.total_length = 0  # Terms of all the documents
+        self.postings = {}  # Term -> (document numbers, term weights)
+        self.last_id = 0
+        self.synced = None  # Marker of the history the index is up to date with, see api.py
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, doc_id, text):
+        """
+        Indexes the text of a document. The term weights use the average document length at this time,
+        which settles quickly as documents are added.
+        """
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        with self.lock:
+            if doc_id <= self.last_id:
+                return
+            doc = len(self.ids)
+            self.ids.append(doc_id)
+            self.total_length += length
+            self.last_id = doc_id
+            norm = self.k1 * (1 - self.b + self.b * length / (self.total_length / len(self.ids) or 1))
+            for term, count in counts.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array('I'), array('f'))
+                posting[0].append(doc)
+                posting[1].append(count * (self.k1 + 1) / (count + norm))
+
+    def search(self, query, limit):
+        """
+        Returns up to `limit` (doc_id, score) pairs of the documents best matching the query, best first.
+        """
+        with self.lock:
+            count = len(self.ids)
+            if not count:
+                return []
+            postings = [(len(posting[0]), posting) for posting in map(self.postings.get, set(tokenize(query))) if posting]
+            cutoff = max(self.min_skipped, self.max_df * count)
+            scores = {}
+            for df, (docs, weights) in sorted(postings, key=lambda item: item[0])[:self.max_terms]:
+                if df > cutoff:
+                    continue
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                get = scores.get
+                for doc, weight in zip(docs, weights):
+                    scores[doc] = get(doc, 0.0) + idf * weight
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+            return [(self.ids[doc], score) for doc, score in best]